@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# Offline benchmarks for the public entry points of irods_python_ci_utilities.
+#
+# Every external command the library runs (sudo, the package managers, rpm, git, wget, ...) is replaced
+# by a stub on PATH that records its invocation and sleeps for a simulated latency, and /etc/os-release
+# is faked for each supported distribution. Each (distribution, entry point) pair runs in a fresh
+# interpreter, which reports wall time, the number of processes spawned and peak RSS.
+#
+#   python benchmarks/benchmark.py --output before.json
+#   python benchmarks/benchmark.py --output after.json --compare before.json
+#
+# --compare exits with status 1 if an entry point fails where it succeeded in the baseline, or spawns more
+# processes, or takes more than --wall-time-tolerance longer, than in the baseline.
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# os-release NAME and VERSION_ID producing each distribution name the library dispatches on
+distributions = {
+    'Ubuntu': ('Ubuntu', '22.04', 'jammy'),
+    'Debian gnu_linux': ('Debian GNU/Linux', '12', 'bookworm'),
+    'Centos': ('CentOS', '7', ''),
+    'Centos linux': ('CentOS Linux', '7', ''),
+    'Almalinux': ('AlmaLinux', '8.9', ''),
+    'Rocky linux': ('Rocky Linux', '9.3', ''),
+    'Opensuse ': ('openSUSE ', '15.5', ''),
+    'Opensuse leap': ('openSUSE Leap', '15.5', ''),
+}
+
+# Simulated seconds per invocation of each stubbed command
+stub_latencies = {
+    'sudo': 0.0,
+    'apt-get': 0.2,
+    'apt': 0.2,
+    'dnf': 0.2,
+    'yum': 0.2,
+    'zypper': 0.2,
+    'rpm': 0.02,
+    'dpkg-query': 0.01,
+    'dpkg-deb': 0.01,
+    'git': 0.05,
+    'wget': 0.05,
+    'gpg': 0.01,
+    'install': 0.0,
+    'su': 0.01,
+    'service': 0.05,
+    'systemctl': 0.05,
+    'pg_isready': 0.0,
+    'mysqladmin': 0.0,
+    'mysql': 0.0,
+    'lsb_release': 0.0,
+}
+
+stub_behaviours = {
+    # Privileged commands without a stub are recorded and skipped, never run for real. The privileged
+    # helper runs in a sandbox that redirects its file operations below $IRODS_BENCHMARK_ROOT.
+    'sudo': '''
+case "$*" in
+    *privileged_helper.py*)
+        for last in "$@"; do :; done
+        exec "$1" "$IRODS_BENCHMARK_STUB_DIRECTORY/privileged_helper_sandbox.py" "$last" ;;
+esac
+if [ -x "$IRODS_BENCHMARK_STUB_DIRECTORY/$1" ]; then
+    exec "$@"
+fi
+exit 0
+''',
+    # Nothing is installed
+    'dpkg-query': '''
+exit 1
+''',
+    'rpm': '''
+case " $* " in
+    *" --package "*|*" -qp "*|*" --import "*|*" --rebuilddb "*) exit 0 ;;
+esac
+status=0
+for arg in "$@"; do
+    case "$arg" in
+        -*|%*) ;;
+        *) echo "package $arg is not installed"; status=1 ;;
+    esac
+done
+exit $status
+''',
+    'git': '''
+case "$1" in
+    clone) for last in "$@"; do :; done; mkdir -p "$last" ;;
+    init) mkdir -p .git/objects/info ;;
+esac
+exit 0
+''',
+}
+
+# Runs privileged_helper.py, passed as its argument, with the paths of its file operations moved below
+# $IRODS_BENCHMARK_ROOT; commands it runs are the stubs on PATH
+privileged_helper_sandbox = '''
+import os
+import runpy
+import sys
+
+helper = runpy.run_path(sys.argv[1])
+root = os.environ['IRODS_BENCHMARK_ROOT']
+
+def sandboxed(handler, key):
+    def handle(request):
+        request = dict(request)
+        request[key] = os.path.join(root, request[key].lstrip('/'))
+        os.makedirs(os.path.dirname(request[key]), exist_ok=True)
+        return handler(request)
+    return handle
+
+for op, key in [('write_file', 'path'), ('edit_file', 'path'), ('makedirs', 'path'), ('symlink', 'link_name')]:
+    helper['handlers'][op] = sandboxed(helper['handlers'][op], key)
+helper['serve'](sys.stdin.buffer, sys.stdout.buffer)
+'''
+
+entry_points = ['install_os_packages', 'install_database', 'install_irods_dev_and_runtime_packages', 'git_clone', 'gather_files_satisfying_predicate', 'gather_files']
+
+def write_stubs(stub_directory, latency_scale):
+    for name, latency in stub_latencies.items():
+        path = os.path.join(stub_directory, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n')
+            f.write('printf "%s\\t%s\\n" "{0}" "$*" >> "$IRODS_BENCHMARK_CALL_LOG"\n'.format(name))
+            if latency * latency_scale > 0:
+                f.write('sleep {0:.3f}\n'.format(latency * latency_scale))
+            f.write(stub_behaviours.get(name, 'exit 0\n'))
+        os.chmod(path, 0o755)
+    with open(os.path.join(stub_directory, 'privileged_helper_sandbox.py'), 'w') as f:
+        f.write(privileged_helper_sandbox)
+
+def write_os_release(path, distribution):
+    name, version_id, codename = distributions[distribution]
+    with open(path, 'w') as f:
+        f.write('NAME="{0}"\nVERSION_ID="{1}"\nVERSION_CODENAME={2}\n'.format(name, version_id, codename))
+
+def write_gather_source(work_directory):
+    source = os.path.join(work_directory, 'source')
+    # Subdirectories are not gathered, but still have to be skipped
+    for i in range(50):
+        os.makedirs(os.path.join(source, 'd{0}'.format(i)))
+    for i in range(2000):
+        with open(os.path.join(source, 'f{0}.{1}'.format(i, 'log' if i % 2 else 'txt')), 'wb') as f:
+            f.write(os.urandom(8192))
+    with open(os.path.join(source, 'large.log'), 'wb') as f:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(64):
+            f.write(chunk)
+    return source
+
+def prepare_entry_point(utilities, entry_point, work_directory):
+    # Returns (function, args) for one iteration of entry_point
+    if entry_point == 'install_os_packages':
+        return utilities.install_os_packages, (['gcc', 'make', 'python3'],)
+    if entry_point == 'install_database':
+        from irods_python_ci_utilities import readiness
+        socket_path = os.path.join(work_directory, 'database.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        listener.listen(16)
+        readiness.postgres_socket_paths[:] = [socket_path]
+        readiness.mysql_socket_paths[:] = [socket_path]
+        prepare_entry_point.listener = listener
+        return utilities.install_database, ('postgres',)
+    if entry_point == 'install_irods_dev_and_runtime_packages':
+        packages_root = os.path.join(work_directory, 'packages')
+        packages_directory = utilities.append_os_specific_directory(packages_root)
+        os.makedirs(packages_directory)
+        suffix = utilities.get_package_suffix()
+        arch = utilities.artifact_index.native_architectures(suffix)[0]
+        for name in ['irods-runtime', 'irods-dev', 'irods-server', 'irods-icommands']:
+            if suffix == 'deb':
+                basename = '{0}_4.3.1-0_{1}.deb'.format(name, arch)
+            else:
+                basename = '{0}-4.3.1-0.{1}.rpm'.format(name.replace('irods-dev', 'irods-devel'), arch)
+            with open(os.path.join(packages_directory, basename), 'wb') as f:
+                f.write(b'\0' * 4096)
+        return utilities.install_irods_dev_and_runtime_packages, (packages_root,)
+    if entry_point == 'git_clone':
+        counter = iter(range(1000000))
+        def clone():
+            return utilities.git_clone('file:///nonexistent/irods.git', 'main', os.path.join(work_directory, 'clone-{0}'.format(next(counter))))
+        return clone, ()
+    if entry_point == 'gather_files_satisfying_predicate':
+        source = write_gather_source(work_directory)
+        counter = iter(range(1000000))
+        def gather():
+            return utilities.gather_files_satisfying_predicate(source, os.path.join(work_directory, 'out-{0}'.format(next(counter))), lambda x: x.endswith('.log'))
+        return gather, ()
+    if entry_point == 'gather_files':
+        # Gathers into the same directory again, hardlinked and then copied over the hardlinks, which must
+        # leave the source files intact
+        source = write_gather_source(work_directory)
+        sizes = dict((x, os.path.getsize(os.path.join(source, x))) for x in os.listdir(source) if x.endswith('.log'))
+        output = os.path.join(work_directory, 'out')
+        def gather():
+            for allow_hardlink in [True, False]:
+                for gathered_file in utilities.gather_files(source, output, lambda x: x.endswith('.log'), allow_hardlink=allow_hardlink):
+                    if gathered_file.error is not None:
+                        raise gathered_file.error
+            changed = [x for x, size in sizes.items() if os.path.getsize(os.path.join(source, x)) != size]
+            if changed:
+                raise RuntimeError('gathering changed {0} source files, e.g. {1}'.format(len(changed), changed[0]))
+        return gather, ()
+    raise ValueError('unknown entry point [{0}]'.format(entry_point))
+
+def count_stub_calls():
+    # Every stubbed command the library runs, directly or through sudo, is a line of the call log
+    with open(os.environ['IRODS_BENCHMARK_CALL_LOG']) as f:
+        return sum(1 for _ in f)
+
+def run_child(distribution, entry_point, iterations, work_directory):
+    # Runs in the benchmark's child interpreter; prints a JSON result on the last line of stdout
+    import irods_python_ci_utilities as utilities
+    function, args = prepare_entry_point(utilities, entry_point, work_directory)
+    calls_before = count_stub_calls()
+    start = time.monotonic()
+    error = None
+    try:
+        for _ in range(iterations):
+            function(*args)
+    except Exception as e:
+        error = '{0}: {1}'.format(type(e).__name__, e).splitlines()[0]
+    wall_time = time.monotonic() - start
+    spawns = count_stub_calls() - calls_before
+    result = {
+        'distribution': distribution,
+        'entry_point': entry_point,
+        'iterations': iterations,
+        'wall_time': wall_time,
+        'spawns': spawns,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'error': error,
+    }
+    print('\n' + json.dumps(result))
+
+def run_case(distribution, entry_point, iterations, latency_scale):
+    work_directory = tempfile.mkdtemp(prefix='irods_benchmark_')
+    try:
+        stub_directory = os.path.join(work_directory, 'stubs')
+        os.makedirs(stub_directory)
+        write_stubs(stub_directory, latency_scale)
+        os_release = os.path.join(work_directory, 'os-release')
+        write_os_release(os_release, distribution)
+        call_log = os.path.join(work_directory, 'calls.log')
+        open(call_log, 'w').close()
+        env = dict(os.environ)
+        env.update({
+            'PATH': stub_directory + os.pathsep + os.environ.get('PATH', ''),
+            'HOME': work_directory,
+            'PYTHONPATH': REPOSITORY_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''),
+            'IRODS_PYTHON_CI_UTILITIES_OS_RELEASE': os_release,
+            'IRODS_PYTHON_CI_UTILITIES_CACHE_DIR': os.path.join(work_directory, 'cache'),
+            'IRODS_BENCHMARK_STUB_DIRECTORY': stub_directory,
+            'IRODS_BENCHMARK_CALL_LOG': call_log,
+            'IRODS_BENCHMARK_ROOT': os.path.join(work_directory, 'root'),
+        })
+        env.pop('IRODS_PYTHON_CI_UTILITIES_TRACE', None)
+        args = [sys.executable, os.path.abspath(__file__), '--child', distribution, entry_point, str(iterations), work_directory]
+        p = subprocess.run(args, env=env, cwd=work_directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lines = p.stdout.decode('utf-8', 'replace').strip().splitlines()
+        if p.returncode != 0 or not lines:
+            raise RuntimeError('benchmark child failed for {0} {1}:\n{2}'.format(distribution, entry_point, p.stderr.decode('utf-8', 'replace')))
+        result = json.loads(lines[-1])
+        calls = {}
+        with open(call_log) as f:
+            for line in f:
+                command = line.split('\t', 1)[0]
+                calls[command] = calls.get(command, 0) + 1
+        result['stub_calls'] = calls
+        return result
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+def result_key(result):
+    return '{0}/{1}'.format(result['distribution'], result['entry_point'])
+
+def compare(results, baseline, wall_time_tolerance):
+    # Returns list of regression descriptions
+    baseline_results = dict((result_key(x), x) for x in baseline['results'])
+    regressions = []
+    print('\n{0:<60} {1:>14} {2:>18}'.format('case', 'spawns', 'wall time (s)'))
+    for result in results:
+        key = result_key(result)
+        before = baseline_results.get(key)
+        if before is None:
+            continue
+        print('{0:<60} {1:>6} -> {2:<5} {3:>8.3f} -> {4:<8.3f}'.format(key, before['spawns'], result['spawns'], before['wall_time'], result['wall_time']))
+        if result['error'] and not before['error']:
+            regressions.append('{0}: fails with {1}'.format(key, result['error']))
+            continue
+        if result['spawns'] > before['spawns']:
+            regressions.append('{0}: spawns {1} -> {2}'.format(key, before['spawns'], result['spawns']))
+        if result['wall_time'] > before['wall_time'] * (1 + wall_time_tolerance) + 0.05:
+            regressions.append('{0}: wall time {1:.3f}s -> {2:.3f}s'.format(key, before['wall_time'], result['wall_time']))
+    return regressions
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        distribution, entry_point, iterations, work_directory = sys.argv[2:6]
+        run_child(distribution, entry_point, int(iterations), work_directory)
+        return 0
+
+    parser = argparse.ArgumentParser(description='Offline benchmarks for irods_python_ci_utilities')
+    parser.add_argument('--distribution', action='append', choices=sorted(distributions), help='distribution to run (default: all)')
+    parser.add_argument('--entry-point', action='append', choices=entry_points, help='entry point to run (default: all)')
+    parser.add_argument('--iterations', type=int, default=3, help='calls of each entry point per case')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiplier for the simulated command latencies')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='baseline results JSON to compare against')
+    parser.add_argument('--wall-time-tolerance', type=float, default=0.25, help='allowed relative wall time increase over the baseline')
+    args = parser.parse_args()
+
+    results = []
+    print('{0:<60} {1:>7} {2:>10} {3:>12}'.format('case', 'spawns', 'wall (s)', 'peak RSS kB'))
+    for distribution in args.distribution or sorted(distributions):
+        for entry_point in args.entry_point or entry_points:
+            result = run_case(distribution, entry_point, args.iterations, args.latency_scale)
+            results.append(result)
+            line = '{0:<60} {1:>7} {2:>10.3f} {3:>12}'.format(result_key(result), result['spawns'], result['wall_time'], result['peak_rss_kb'])
+            if result['error']:
+                line += '  ' + result['error']
+            print(line)
+
+    if args.output:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+        with open(args.output, 'w') as f:
+            json.dump({'commit': commit, 'iterations': args.iterations, 'latency_scale': args.latency_scale, 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.wall_time_tolerance)
+        if regressions:
+            print('\nregressions:\n  ' + '\n  '.join(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
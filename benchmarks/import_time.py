@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Import-time budget for irods_python_ci_utilities.
+#
+# Imports the package in fresh interpreters under -X importtime and checks the fastest cumulative time
+# against a budget, and that none of the modules the package loads lazily were imported eagerly.
+#
+#   python benchmarks/import_time.py
+#   python benchmarks/import_time.py --budget-ms 40 --runs 10
+#
+# Exits with status 1 if the budget is exceeded or a lazy module was loaded by the import; CI runs it
+# as a check, and tests/test_import_time.py runs the same checks under pytest.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Allowed cumulative import time, in milliseconds, of the fastest run
+default_budget_ms = 50.0
+
+# Standard library modules that only the functions needing them import
+lazily_loaded_modules = ['asyncio', 'ssl', 'logging', 'concurrent.futures', 'tempfile', 'shlex', 'socket', 'hashlib', 'http.client', 'pwd', 'shutil']
+
+child_code = '''
+import json, sys
+import irods_python_ci_utilities
+print(json.dumps(sorted(sys.modules)))
+'''
+
+def measure_import():
+    # Returns (cumulative import time in microseconds, names of the modules loaded)
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', child_code], cwd=REPOSITORY_ROOT,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    cumulative = None
+    for line in p.stderr.decode('utf-8').splitlines():
+        fields = [x.strip() for x in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'irods_python_ci_utilities':
+            cumulative = int(fields[1])
+    if cumulative is None:
+        raise RuntimeError('no import time reported for irods_python_ci_utilities:\n{0}'.format(p.stderr.decode('utf-8')))
+    return cumulative, json.loads(p.stdout.decode('utf-8'))
+
+def check_lazy_names():
+    # The names __init__ exports lazily must be exactly those in each lazy submodule's __all__
+    sys.path.insert(0, REPOSITORY_ROOT)
+    import importlib
+    import irods_python_ci_utilities
+    problems = []
+    for submodule, names in irods_python_ci_utilities.lazy_submodules.items():
+        module = importlib.import_module('irods_python_ci_utilities.' + submodule)
+        if sorted(names) != sorted(module.__all__):
+            problems.append('lazy names for {0} differ from its __all__: {1}'.format(submodule, sorted(set(names) ^ set(module.__all__))))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time budget for irods_python_ci_utilities')
+    parser.add_argument('--budget-ms', type=float, default=default_budget_ms, help='allowed cumulative import time of the fastest run')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters to import the package in')
+    args = parser.parse_args()
+
+    measurements = [measure_import() for _ in range(args.runs)]
+    fastest = min(x[0] for x in measurements) / 1000.0
+    loaded = set(measurements[0][1])
+    print('import irods_python_ci_utilities: {0:.1f} ms (fastest of {1}, budget {2:.1f} ms)'.format(fastest, args.runs, args.budget_ms))
+
+    problems = []
+    if fastest > args.budget_ms:
+        problems.append('import time {0:.1f} ms exceeds budget of {1:.1f} ms'.format(fastest, args.budget_ms))
+    for module in lazily_loaded_modules:
+        if module in loaded:
+            problems.append('{0} is imported eagerly'.format(module))
+    problems.extend(check_lazy_names())
+    if problems:
+        print('\nproblems:\n  ' + '\n  '.join(problems))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
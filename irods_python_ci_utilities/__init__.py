@@ -1,2 +1,49 @@
+import importlib
+
 from .irods_python_ci_utilities import *
 from .copied_from_ansible import *
+from .readiness import *
+from .tracing import *
+from .privileged_helper import *
+from .resource_accounting import *
+from .config_files import *
+
+# Submodules whose names are exported here but which are only imported on first use, since they pull in
+# heavy parts of the standard library (asyncio, concurrent.futures) or are rarely needed.
+# Each maps to the names in its __all__; see benchmarks/import_time.py for the import-time budget.
+lazy_submodules = {
+    'artifact_index': ['ArtifactPackage', 'ArtifactIndex', 'get_artifact_index', 'compare_debian_versions', 'compare_rpm_versions'],
+    'artifact_sync': ['SyncResult', 'hash_file', 'build_manifest', 'sync_files', 'load_manifest', 'verify_manifest'],
+    'local_repository': ['update_local_repository', 'register_local_repository'],
+    'step_graph': ['StepGraph', 'StepGraphError', 'StepResult'],
+    'package_prefetch': ['PackagePrefetch', 'PrefetchProgress', 'prefetch_os_packages', 'prefetch_released_irods_dev_and_runtime_packages'],
+    'database_snapshots': ['enable_database_snapshots', 'disable_database_snapshots', 'clear_database_snapshots', 'initialize_database_from_snapshot'],
+    'asynchronous': [
+        'async_subprocess_get_output',
+        'run_blocking',
+        'async_install_os_packages',
+        'async_install_os_packages_from_files',
+        'async_install_irods_packages_repository',
+        'async_install_irods_core_dev_repository',
+        'async_install_irods_dev_and_runtime_packages',
+        'async_install_released_irods_dev_and_runtime_packages',
+        'async_install_database',
+        'async_git_clone',
+    ],
+}
+
+lazy_names = dict((name, submodule) for submodule, names in lazy_submodules.items() for name in names)
+
+__all__ = [x for x in globals().keys() if not x.startswith('_') and x not in ['importlib', 'lazy_submodules', 'lazy_names']] + list(lazy_names)
+
+def __getattr__(name):
+    if name in lazy_submodules:
+        return importlib.import_module('.' + name, __name__)
+    if name in lazy_names:
+        value = getattr(importlib.import_module('.' + lazy_names[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(lazy_names))
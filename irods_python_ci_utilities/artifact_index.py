@@ -0,0 +1,427 @@
+import collections
+import hashlib
+import io
+import os
+import platform
+import struct
+
+from .irods_python_ci_utilities import get_cache_directory, load_json_manifest, write_json_manifest
+
+# Indexes a directory of built .deb or .rpm files, e.g. the one returned by append_os_specific_directory(),
+# so that packages can be chosen by name and version instead of by file name substring. The index is kept
+# in a manifest under the cache directory and only rebuilt when the directory's mtime changes.
+
+__all__ = [
+    'ArtifactPackage',
+    'ArtifactIndex',
+    'get_artifact_index',
+    'compare_debian_versions',
+    'compare_rpm_versions',
+]
+
+# depends and provides are tuples of package names, or None if the package's headers were not read
+ArtifactPackage = collections.namedtuple('ArtifactPackage', ['path', 'name', 'version', 'arch', 'depends', 'provides'])
+
+# Bump when the manifest layout changes
+MANIFEST_FORMAT = 1
+
+# platform.machine() -> package architecture names
+debian_architectures = {'x86_64': 'amd64', 'aarch64': 'arm64', 'ppc64le': 'ppc64el', 's390x': 's390x', 'i686': 'i386'}
+
+def split_debian_version(version):
+    # Returns (epoch, upstream_version, debian_revision)
+    epoch, _, rest = version.rpartition(':')
+    upstream, _, revision = rest.rpartition('-')
+    if not upstream:
+        upstream, revision = revision, ''
+    return int(epoch or 0), upstream, revision
+
+def debian_character_order(c):
+    if c == '~':
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+def compare_debian_version_parts(a, b):
+    # dpkg's verrevcmp: alternating non-digit and digit runs; '~' sorts before everything, even the end
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = debian_character_order(a[i]) if i < len(a) and not a[i].isdigit() else 0
+            bc = debian_character_order(b[j]) if j < len(b) and not b[j].isdigit() else 0
+            if ac != bc:
+                return -1 if ac < bc else 1
+            i += 1
+            j += 1
+        start_i, start_j = i, j
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        an = int(a[start_i:i] or 0)
+        bn = int(b[start_j:j] or 0)
+        if an != bn:
+            return -1 if an < bn else 1
+    return 0
+
+def compare_debian_versions(a, b):
+    # Returns -1, 0 or 1 as dpkg --compare-versions would order a and b
+    a_epoch, a_upstream, a_revision = split_debian_version(a)
+    b_epoch, b_upstream, b_revision = split_debian_version(b)
+    if a_epoch != b_epoch:
+        return -1 if a_epoch < b_epoch else 1
+    return compare_debian_version_parts(a_upstream, b_upstream) or compare_debian_version_parts(a_revision, b_revision)
+
+def rpmvercmp(a, b):
+    # rpm's rpmvercmp: alphanumeric segments, numeric ones newer than alphabetic ones; '~' sorts before
+    # the end of the string and '^' after it
+    if a == b:
+        return 0
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while i < len(a) and not a[i].isalnum() and a[i] not in '~^':
+            i += 1
+        while j < len(b) and not b[j].isalnum() and b[j] not in '~^':
+            j += 1
+        a_tilde = i < len(a) and a[i] == '~'
+        b_tilde = j < len(b) and b[j] == '~'
+        if a_tilde or b_tilde:
+            if not a_tilde:
+                return 1
+            if not b_tilde:
+                return -1
+            i += 1
+            j += 1
+            continue
+        a_caret = i < len(a) and a[i] == '^'
+        b_caret = j < len(b) and b[j] == '^'
+        if a_caret or b_caret:
+            if i >= len(a):
+                return -1
+            if j >= len(b):
+                return 1
+            if not a_caret:
+                return 1
+            if not b_caret:
+                return -1
+            i += 1
+            j += 1
+            continue
+        if i >= len(a) or j >= len(b):
+            break
+        numeric = a[i].isdigit()
+        start_i, start_j = i, j
+        same_kind = str.isdigit if numeric else str.isalpha
+        while i < len(a) and same_kind(a[i]):
+            i += 1
+        while j < len(b) and same_kind(b[j]):
+            j += 1
+        a_segment, b_segment = a[start_i:i], b[start_j:j]
+        if not b_segment:
+            return 1 if numeric else -1
+        if numeric:
+            a_segment = a_segment.lstrip('0')
+            b_segment = b_segment.lstrip('0')
+            if len(a_segment) != len(b_segment):
+                return -1 if len(a_segment) < len(b_segment) else 1
+        if a_segment != b_segment:
+            return -1 if a_segment < b_segment else 1
+    if i >= len(a) and j >= len(b):
+        return 0
+    return 1 if i < len(a) else -1
+
+def compare_rpm_versions(a, b):
+    # Returns -1, 0 or 1 ordering [epoch:]version[-release] strings as rpm would
+    a_epoch, a_version, a_release = split_debian_version(a)
+    b_epoch, b_version, b_release = split_debian_version(b)
+    if a_epoch != b_epoch:
+        return -1 if a_epoch < b_epoch else 1
+    return rpmvercmp(a_version, b_version) or rpmvercmp(a_release, b_release)
+
+def parse_package_file_name(basename):
+    # Returns (name, version, arch) from name_version_arch.deb or name-version-release.arch.rpm, or None
+    if basename.endswith('.deb'):
+        fields = basename[:-len('.deb')].split('_')
+        if len(fields) != 3:
+            return None
+        return fields[0], fields[1].replace('%3a', ':').replace('%3A', ':'), fields[2]
+    if basename.endswith('.rpm') and not basename.endswith('.src.rpm'):
+        nvr, _, arch = basename[:-len('.rpm')].rpartition('.')
+        fields = nvr.rsplit('-', 2)
+        if len(fields) != 3 or not arch:
+            return None
+        return fields[0], '{0}-{1}'.format(fields[1], fields[2]), arch
+    return None
+
+# Package headers
+
+def read_ar_members(f):
+    # Yields (name, content) for each member of the ar archive open as f
+    if f.read(8) != b'!<arch>\n':
+        raise ValueError('not an ar archive')
+    while True:
+        header = f.read(60)
+        if len(header) < 60:
+            return
+        name = header[:16].decode('ascii').strip().rstrip('/')
+        size = int(header[48:58].decode('ascii'))
+        content = f.read(size)
+        if size % 2:
+            f.read(1)
+        yield name, content
+
+def decompress_tar_member(name, content):
+    # Returns the uncompressed tar bytes of a .deb member such as control.tar.xz
+    if name.endswith('.gz'):
+        import gzip
+        return gzip.decompress(content)
+    if name.endswith('.xz'):
+        import lzma
+        return lzma.decompress(content)
+    if name.endswith('.zst'):
+        try:
+            from compression import zstd
+        except ImportError:
+            raise ValueError('cannot decompress {0}: zstd is not supported by this Python'.format(name))
+        return zstd.decompress(content)
+    if name.endswith('.bz2'):
+        import bz2
+        return bz2.decompress(content)
+    return content
+
+def parse_control_paragraph(text):
+    # Returns OrderedDict of the fields of a deb822 paragraph; continuation lines are kept
+    fields = collections.OrderedDict()
+    key = None
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and key is not None:
+            fields[key] += '\n' + line
+        elif ':' in line:
+            key, _, value = line.partition(':')
+            key = key.strip()
+            fields[key] = value.strip()
+    return fields
+
+def read_deb_control(path):
+    # Returns OrderedDict of the fields of the control file of the .deb at path
+    import tarfile
+    with open(path, 'rb') as f:
+        for name, content in read_ar_members(f):
+            if name.startswith('control.tar'):
+                with tarfile.open(fileobj=io.BytesIO(decompress_tar_member(name, content))) as tar:
+                    for member in tar.getmembers():
+                        if member.name.lstrip('./') == 'control':
+                            return parse_control_paragraph(tar.extractfile(member).read().decode('utf-8'))
+    raise ValueError('no control file in {0}'.format(path))
+
+def parse_debian_relationships(value):
+    # Returns the package names in a Depends-style field, alternatives included
+    names = []
+    for alternatives in value.split(','):
+        for relation in alternatives.split('|'):
+            name = relation.strip().split(' ')[0].split('(')[0].split(':')[0]
+            if name:
+                names.append(name)
+    return names
+
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+
+# Header tags; see rpmtag.h
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIRENAME = 1049
+
+def read_rpm_header_structure(f):
+    # Returns ({tag: value}, size in bytes) of the header structure at the current position of f
+    preamble = f.read(16)
+    if len(preamble) != 16 or preamble[:4] != RPM_HEADER_MAGIC:
+        raise ValueError('bad rpm header magic')
+    count, data_size = struct.unpack('>II', preamble[8:16])
+    index = f.read(16 * count)
+    data = f.read(data_size)
+    tags = {}
+    for n in range(count):
+        tag, kind, offset, item_count = struct.unpack('>IIII', index[16 * n:16 * n + 16])
+        if kind == 6:
+            tags[tag] = data[offset:data.index(b'\0', offset)].decode('utf-8', 'replace')
+        elif kind in (8, 9):
+            items = []
+            for _ in range(item_count):
+                end = data.index(b'\0', offset)
+                items.append(data[offset:end].decode('utf-8', 'replace'))
+                offset = end + 1
+            tags[tag] = items
+        elif kind in (2, 3, 4, 5):
+            width, code = {2: (1, 'B'), 3: (2, 'H'), 4: (4, 'I'), 5: (8, 'Q')}[kind]
+            tags[tag] = list(struct.unpack('>{0}{1}'.format(item_count, code), data[offset:offset + width * item_count]))
+        elif kind == 7:
+            tags[tag] = data[offset:offset + item_count]
+    return tags, 16 + 16 * count + data_size
+
+def read_rpm_header(path):
+    # Returns ({tag: value}, (start, end)) of the main header of the rpm at path; start and end are its byte
+    # offsets in the file. Strings are str, string arrays lists of str and integers lists of int.
+    with open(path, 'rb') as f:
+        lead = f.read(RPM_LEAD_SIZE)
+        if len(lead) != RPM_LEAD_SIZE or lead[:4] != b'\xed\xab\xee\xdb':
+            raise ValueError('{0} is not an rpm'.format(path))
+        _, signature_size = read_rpm_header_structure(f)
+        # The signature header is padded to a multiple of 8 bytes
+        start = RPM_LEAD_SIZE + signature_size + (-signature_size % 8)
+        f.seek(start)
+        tags, size = read_rpm_header_structure(f)
+    return tags, (start, start + size)
+
+def read_package_headers(path):
+    # Returns dict with name, version, arch, depends and provides read from the package's own metadata
+    if path.endswith('.deb'):
+        control = read_deb_control(path)
+        depends = []
+        for field in ['Pre-Depends', 'Depends']:
+            depends.extend(parse_debian_relationships(control.get(field, '')))
+        return {
+            'name': control['Package'],
+            'version': control['Version'],
+            'arch': control.get('Architecture'),
+            'depends': depends,
+            'provides': parse_debian_relationships(control.get('Provides', '')),
+        }
+    tags, _ = read_rpm_header(path)
+    version = '{0}-{1}'.format(tags[RPMTAG_VERSION], tags[RPMTAG_RELEASE])
+    if tags.get(RPMTAG_EPOCH):
+        version = '{0}:{1}'.format(tags[RPMTAG_EPOCH][0], version)
+    return {
+        'name': tags[RPMTAG_NAME],
+        'version': version,
+        'arch': tags.get(RPMTAG_ARCH),
+        'depends': [x for x in tags.get(RPMTAG_REQUIRENAME, []) if not x.startswith(('rpmlib(', '/'))],
+        'provides': tags.get(RPMTAG_PROVIDENAME, []),
+    }
+
+# Index
+
+def native_architectures(package_suffix):
+    machine = platform.machine()
+    if package_suffix == 'deb':
+        return [debian_architectures.get(machine, machine), 'all']
+    return [machine, 'noarch']
+
+def version_matches(version, requested):
+    # requested may be a full version, or one without the epoch and/or the release, e.g. '4.3.1'
+    without_epoch = version.partition(':')[2] or version
+    return requested in (version, without_epoch) or without_epoch.startswith(requested + '-')
+
+class ArtifactIndex(object):
+    def __init__(self, directory, packages):
+        self.directory = directory
+        self.packages = packages
+        self.by_name = collections.defaultdict(list)
+        for package in packages:
+            self.by_name[package.name].append(package)
+
+    def compare_versions(self, a, b):
+        if self.packages and self.packages[0].path.endswith('.deb'):
+            return compare_debian_versions(a, b)
+        return compare_rpm_versions(a, b)
+
+    def find(self, name, version=None, architectures=None):
+        # Returns the newest package named name, or the newest of the given version, or None.
+        # Packages for one of architectures, if given, are preferred.
+        candidates = self.by_name.get(name, [])
+        if version is not None:
+            candidates = [x for x in candidates if version_matches(x.version, version)]
+        if architectures:
+            native = [x for x in candidates if x.arch in architectures]
+            candidates = native or candidates
+        newest = None
+        for candidate in candidates:
+            if newest is None or self.compare_versions(candidate.version, newest.version) > 0:
+                newest = candidate
+        return newest
+
+    def select(self, names, version=None, architectures=None):
+        # Returns the packages for names, each the newest or the one of version, ordered so that
+        # every package comes after the selected packages it depends on. Raises RuntimeError if any
+        # name has no matching package.
+        selected = []
+        for name in names:
+            package = self.find(name, version, architectures)
+            if package is None:
+                raise RuntimeError('no package [{0}]{1} in [{2}]'.format(name, ' of version [{0}]'.format(version) if version else '', self.directory))
+            selected.append(package)
+        return order_by_dependencies(selected)
+
+def order_by_dependencies(packages):
+    # Packages whose dependencies are unknown, or lie outside packages, keep their relative order; so do cycles
+    provided_by = {}
+    for package in packages:
+        for name in [package.name] + list(package.provides or []):
+            provided_by.setdefault(name, package)
+    ordered = []
+    visiting = set()
+    def visit(package):
+        if package in ordered or package in visiting:
+            return
+        visiting.add(package)
+        for dependency in package.depends or []:
+            provider = provided_by.get(dependency)
+            if provider is not None and provider is not package:
+                visit(provider)
+        visiting.discard(package)
+        ordered.append(package)
+    for package in packages:
+        visit(package)
+    return ordered
+
+def get_manifest_path(directory):
+    return get_cache_directory('artifact_index', hashlib.sha256(os.path.realpath(directory).encode('utf-8')).hexdigest() + '.json')
+
+def build_manifest(directory, directory_mtime_ns, read_headers, previous):
+    # Entries of unchanged files are carried over from previous, so only new or modified files are read
+    previous_files = previous['files'] if previous else {}
+    files = {}
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(('.deb', '.rpm')) or not entry.is_file():
+            continue
+        st = entry.stat()
+        old = previous_files.get(entry.name)
+        if old and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns and (old['headers_read'] or not read_headers):
+            files[entry.name] = old
+            continue
+        fields = None
+        if read_headers:
+            try:
+                fields = read_package_headers(entry.path)
+            except (ValueError, KeyError, IndexError, struct.error):
+                fields = None
+        headers_read = fields is not None
+        if fields is None:
+            parsed = parse_package_file_name(entry.name)
+            if parsed is None:
+                continue
+            fields = {'name': parsed[0], 'version': parsed[1], 'arch': parsed[2], 'depends': None, 'provides': None}
+        fields.update(size=st.st_size, mtime_ns=st.st_mtime_ns, headers_read=headers_read)
+        files[entry.name] = fields
+    return {'directory_mtime_ns': directory_mtime_ns, 'read_headers': read_headers, 'files': files}
+
+def get_artifact_index(directory, read_headers=False):
+    # Returns the ArtifactIndex of directory. With read_headers, each package's control file or rpm header
+    # is read for its name, version and dependencies; otherwise they come from the file name.
+    directory_mtime_ns = os.stat(directory).st_mtime_ns
+    manifest_path = get_manifest_path(directory)
+    manifest = load_json_manifest(manifest_path, MANIFEST_FORMAT)
+    if manifest is None or manifest['directory_mtime_ns'] != directory_mtime_ns or (read_headers and not manifest['read_headers']):
+        manifest = build_manifest(directory, directory_mtime_ns, read_headers, manifest)
+        write_json_manifest(manifest_path, manifest, MANIFEST_FORMAT)
+    packages = []
+    for basename, fields in sorted(manifest['files'].items()):
+        depends = tuple(fields['depends']) if fields['depends'] is not None else None
+        provides = tuple(fields['provides']) if fields['provides'] is not None else None
+        packages.append(ArtifactPackage(os.path.join(directory, basename), fields['name'], fields['version'], fields['arch'], depends, provides))
+    return ArtifactIndex(directory, packages)
@@ -0,0 +1,194 @@
+import collections
+import concurrent.futures
+import hashlib
+import mmap
+import os
+
+from .irods_python_ci_utilities import copy_files, get_cache_directory, load_json_manifest, mkdir_p, scan_files, write_json_manifest
+from .tracing import traced
+
+# Incremental copies of artifact directories between CI stages. Each synced directory holds a manifest of
+# size, mtime and SHA-256 per file; files whose content the destination already has are not copied again,
+# and a later stage can check the manifest against the files without re-hashing them.
+#
+#   result = sync_files('build', 'artifacts', lambda x: x.endswith('.deb'))
+#   ...
+#   problems = verify_manifest('artifacts')
+
+__all__ = [
+    'SyncResult',
+    'hash_file',
+    'build_manifest',
+    'sync_files',
+    'load_manifest',
+    'verify_manifest',
+]
+
+# Files synced into a directory are recorded in this file there
+MANIFEST_BASENAME = '.irods_python_ci_utilities_manifest.json'
+
+# Bump when the manifest layout changes
+MANIFEST_FORMAT = 1
+
+# Files at least this large are hashed through mmap rather than read()
+MMAP_THRESHOLD = 1024 * 1024
+
+# manifest maps paths relative to the destination to {'size', 'mtime_ns', 'sha256'}; copied holds a
+# GatheredFile per file copied, with any error; unchanged holds the relative paths not copied
+SyncResult = collections.namedtuple('SyncResult', ['manifest', 'copied', 'unchanged'])
+
+def hash_file(path):
+    # Returns hex SHA-256 of the file at path. hashlib releases the GIL on large buffers, so calls
+    # from several threads hash in parallel.
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(m)
+        else:
+            for chunk in iter(lambda: f.read(256 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def get_default_jobs():
+    return min(32, os.cpu_count() or 1)
+
+def file_entry(st, sha256):
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256}
+
+def entry_matches_stat(entry, st):
+    return entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+
+def build_manifest(directory, predicate=lambda x: True, recursive=True, jobs=None, previous=None):
+    # Returns manifest files dict for the files in directory satisfying predicate. Digests in previous
+    # whose size and mtime still match are reused; the rest are computed on jobs threads.
+    previous = previous or {}
+    files = {}
+    to_hash = []
+    for fullpath, relative_path in scan_files(directory, predicate, recursive):
+        if os.path.basename(relative_path) == MANIFEST_BASENAME:
+            continue
+        st = os.stat(fullpath)
+        if entry_matches_stat(previous.get(relative_path), st):
+            files[relative_path] = previous[relative_path]
+        else:
+            to_hash.append((fullpath, relative_path, st))
+    hash_entries(to_hash, files, jobs)
+    return files
+
+def hash_entries(to_hash, files, jobs):
+    # Adds an entry to files for each (fullpath, relative path, stat result) in to_hash
+    def hash_one(candidate):
+        fullpath, relative_path, st = candidate
+        return relative_path, file_entry(st, hash_file(fullpath))
+    jobs = jobs or get_default_jobs()
+    if jobs <= 1 or len(to_hash) <= 1:
+        files.update(hash_one(x) for x in to_hash)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        files.update(executor.map(hash_one, to_hash))
+
+def read_manifest_file(path):
+    manifest = load_json_manifest(path, MANIFEST_FORMAT)
+    return manifest['files'] if manifest is not None else {}
+
+def write_manifest_file(path, files):
+    write_json_manifest(path, {'algorithm': 'sha256', 'files': files}, MANIFEST_FORMAT)
+
+def get_source_digest_cache_path(source_directory):
+    return get_cache_directory('artifact_sync', hashlib.sha256(os.path.realpath(source_directory).encode('utf-8')).hexdigest() + '.json')
+
+def load_manifest(directory):
+    # Returns the manifest files dict recorded in directory by sync_files(), or {} if there is none
+    return read_manifest_file(os.path.join(directory, MANIFEST_BASENAME))
+
+@traced
+def sync_files(source_directory, output_directory, predicate=lambda x: True, recursive=False, jobs=None, allow_hardlink=False):
+    # Copies the files in source_directory satisfying predicate to output_directory, skipping those whose
+    # content the output directory's manifest shows it already has, and returns a SyncResult.
+    # Source digests are cached under the cache directory and reused while a file's size and mtime are unchanged;
+    # a file the destination already holds with the same size and mtime is not hashed at all.
+    # Copy errors are reported in the result, not raised.
+    mkdir_p(output_directory)
+    manifest_path = os.path.join(output_directory, MANIFEST_BASENAME)
+    destination_files = read_manifest_file(manifest_path)
+    digest_cache_path = get_source_digest_cache_path(source_directory)
+    cached_digests = read_manifest_file(digest_cache_path)
+
+    source_files = {}
+    to_hash = []
+    for fullpath, relative_path in scan_files(source_directory, predicate, recursive):
+        if os.path.basename(relative_path) == MANIFEST_BASENAME:
+            continue
+        st = os.stat(fullpath)
+        if entry_matches_stat(cached_digests.get(relative_path), st):
+            source_files[relative_path] = cached_digests[relative_path]
+        elif entry_matches_stat(destination_files.get(relative_path), st):
+            # copy_file_fast() preserves mtime, so this is the file an earlier sync copied
+            source_files[relative_path] = destination_files[relative_path]
+        else:
+            to_hash.append((fullpath, relative_path, st))
+    hash_entries(to_hash, source_files, jobs)
+
+    to_copy = []
+    unchanged = []
+    for relative_path, entry in sorted(source_files.items()):
+        destination = os.path.join(output_directory, relative_path)
+        recorded = destination_files.get(relative_path)
+        try:
+            st = os.stat(destination)
+        except OSError:
+            st = None
+        if recorded is not None and recorded['sha256'] == entry['sha256'] and st is not None and entry_matches_stat(recorded, st):
+            unchanged.append(relative_path)
+        else:
+            to_copy.append(relative_path)
+
+    copied = copy_files([(os.path.join(source_directory, x), os.path.join(output_directory, x)) for x in to_copy],
+                        jobs or get_default_jobs(), allow_hardlink)
+
+    # Files synced earlier from elsewhere stay in the manifest while they are untouched
+    files = {}
+    for relative_path, recorded in destination_files.items():
+        try:
+            if entry_matches_stat(recorded, os.stat(os.path.join(output_directory, relative_path))):
+                files[relative_path] = recorded
+        except OSError:
+            pass
+    for relative_path in unchanged:
+        files[relative_path] = source_files[relative_path]
+    for relative_path, gathered_file in zip(to_copy, copied):
+        if gathered_file.error is None:
+            st = os.stat(gathered_file.destination)
+            files[relative_path] = file_entry(st, source_files[relative_path]['sha256'])
+        else:
+            files.pop(relative_path, None)
+
+    write_manifest_file(manifest_path, files)
+    write_manifest_file(digest_cache_path, dict(cached_digests, **source_files))
+    return SyncResult(files, copied, unchanged)
+
+def verify_manifest(directory, files=None, rehash=False, jobs=None):
+    # Returns sorted relative paths of the files in the manifest (by default the one sync_files() left in
+    # directory) that are missing or differ from it. Size and mtime are compared; with rehash, digests too.
+    if files is None:
+        files = load_manifest(directory)
+    problems = []
+    to_hash = []
+    for relative_path, entry in files.items():
+        fullpath = os.path.join(directory, relative_path)
+        try:
+            st = os.stat(fullpath)
+        except OSError:
+            problems.append(relative_path)
+            continue
+        if entry['size'] != st.st_size or (not rehash and entry['mtime_ns'] != st.st_mtime_ns):
+            problems.append(relative_path)
+        elif rehash:
+            to_hash.append((fullpath, relative_path, st))
+    rehashed = {}
+    hash_entries(to_hash, rehashed, jobs)
+    problems.extend(x for x, entry in rehashed.items() if entry['sha256'] != files[x]['sha256'])
+    return sorted(problems)
@@ -0,0 +1,118 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import shlex
+import subprocess
+
+from . import irods_python_ci_utilities as utilities
+from .tracing import set_span_attribute, trace_span
+
+__all__ = [
+    'async_subprocess_get_output',
+    'run_blocking',
+    'async_install_os_packages',
+    'async_install_os_packages_from_files',
+    'async_install_irods_packages_repository',
+    'async_install_irods_core_dev_repository',
+    'async_install_irods_dev_and_runtime_packages',
+    'async_install_released_irods_dev_and_runtime_packages',
+    'async_install_database',
+    'async_git_clone',
+]
+
+async def terminate_process(p):
+    # SIGTERM, which sudo relays to its command, then SIGKILL if p outlives the grace period
+    try:
+        p.terminate()
+        await asyncio.wait_for(p.wait(), utilities.SUBPROCESS_TERMINATION_GRACE_PERIOD)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        p.kill()
+        await p.wait()
+
+async def async_subprocess_get_output(*args, **kwargs):
+    # asyncio counterpart of subprocess_get_output() with the same check_rc and data keywords.
+    # A string command, or shell=True, runs through the shell. If timeout (seconds) expires or the
+    # awaiting task is cancelled, the child is terminated; the former raises asyncio.TimeoutError.
+    check_rc = kwargs.pop('check_rc', False)
+    data = kwargs.pop('data', None)
+    timeout = kwargs.pop('timeout', None)
+    shell = kwargs.pop('shell', False)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    kwargs['stdout'] = subprocess.PIPE
+    kwargs['stderr'] = subprocess.PIPE
+    kwargs['stdin'] = subprocess.PIPE if data is not None else None
+    command = args[0] if args else kwargs.pop('args')
+
+    with trace_span('subprocess', argv=[command] if isinstance(command, str) else list(command), cwd=kwargs.get('cwd')):
+        if shell or isinstance(command, str):
+            p = await asyncio.create_subprocess_shell(command if isinstance(command, str) else shlex.join(command), **kwargs)
+        else:
+            p = await asyncio.create_subprocess_exec(*command, **kwargs)
+        try:
+            out_b, err_b = await asyncio.wait_for(p.communicate(data), timeout)
+        except BaseException:
+            if p.returncode is None:
+                await terminate_process(p)
+            raise
+        set_span_attribute('returncode', p.returncode)
+
+    out = out_b.decode('utf-8') if out_b else ''
+    err = err_b.decode('utf-8') if err_b else ''
+    if out:
+        print(out)
+    if err:
+        print(err)
+    if check_rc:
+        if p.returncode != 0:
+            raise RuntimeError('''async_subprocess_get_output() failed
+args: {0}
+kwargs: {1}
+returncode: {2}
+stdout: {3}
+stderr: {4}
+'''.format(args, kwargs, p.returncode, out, err))
+    return p.returncode, out, err
+
+# Runs the blocking installers; their threads spend nearly all their time waiting on child processes
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='irods_python_ci_utilities')
+
+async def run_blocking(function, *args, **kwargs):
+    # Runs function(*args, **kwargs) on the executor and awaits it. If timeout (seconds) expires or
+    # the awaiting task is cancelled, the child processes started by function are terminated, no new
+    # ones can be started, and its waits for the package database lock or for another caller's package
+    # manager transaction end, so the worker thread unwinds promptly. function runs in a copy of the task's
+    # context, so its spans nest under the task's.
+    timeout = kwargs.pop('timeout', None)
+    scope = utilities.SubprocessScope()
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    future = loop.run_in_executor(executor, functools.partial(context.run, scope.run, function, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except BaseException:
+        scope.cancel()
+        try:
+            await future
+        except Exception:
+            pass
+        raise
+
+def make_async(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(function, *args, **kwargs)
+    wrapper.__name__ = wrapper.__qualname__ = 'async_' + function.__name__
+    return wrapper
+
+async_install_os_packages = make_async(utilities.install_os_packages)
+async_install_os_packages_from_files = make_async(utilities.install_os_packages_from_files)
+async_install_irods_packages_repository = make_async(utilities.install_irods_packages_repository)
+async_install_irods_core_dev_repository = make_async(utilities.install_irods_core_dev_repository)
+async_install_irods_dev_and_runtime_packages = make_async(utilities.install_irods_dev_and_runtime_packages)
+async_install_released_irods_dev_and_runtime_packages = make_async(utilities.install_released_irods_dev_and_runtime_packages)
+async_install_database = make_async(utilities.install_database)
+async_git_clone = make_async(utilities.git_clone)
@@ -0,0 +1,72 @@
+import errno
+
+from .privileged_helper import PrivilegedHelper, apply_config_edits, edit_file_request, get_privileged_helper
+from .tracing import traced
+
+# Edits of root-owned config files, applied per file in one atomic write and for a whole set of files in
+# one privileged operation: a request to the privileged helper when it is enabled, otherwise a one-shot
+# helper started through sudo. Files that already hold the result of their edits are not written, and
+# if the current user can read them all, nothing privileged runs.
+#
+#   edit_config_files({
+#       '/etc/mysql/conf.d/irods.cnf': [config_ini_option('mysqld', 'log_bin_trust_function_creators', '1')],
+#       '/etc/environment': [config_key_value('ORACLE_HOME', '/usr/lib/oracle/11.2/client64')],
+#   })
+
+__all__ = [
+    'config_content',
+    'config_line',
+    'config_key_value',
+    'config_ini_option',
+    'edit_config_files',
+]
+
+def config_content(content):
+    # The whole file is content
+    return {'kind': 'content', 'content': content}
+
+def config_line(line):
+    # line is appended unless the file has it
+    return {'kind': 'line', 'line': line}
+
+def config_key_value(key, value, separator='='):
+    # Every uncommented assignment of key is set to value; one is appended if there is none
+    return {'kind': 'key_value', 'key': key, 'value': str(value), 'separator': separator}
+
+def config_ini_option(section, option, value):
+    # option is set to value in [section], which is appended if missing
+    return {'kind': 'ini_option', 'section': section, 'option': option, 'value': str(value)}
+
+@traced
+def edit_config_files(files, mode=0o644):
+    # files maps paths to lists of edits, applied in order; mode applies to files the edits create.
+    # Existing files keep their owner and mode. Returns the paths written.
+    requests = []
+    for path, edits in files.items():
+        try:
+            with open(path, 'rb') as f:
+                current = f.read().decode('utf-8')
+        except IOError as e:
+            if e.errno not in [errno.ENOENT, errno.EACCES]:
+                raise
+        else:
+            if apply_config_edits(current, edits) == current:
+                continue
+        requests.append(edit_file_request(path, edits, mode))
+    if not requests:
+        return []
+
+    helper = get_privileged_helper()
+    if helper is not None:
+        responses = helper.batch(requests)
+    else:
+        helper = PrivilegedHelper()
+        try:
+            responses = helper.batch(requests)
+        finally:
+            helper.close()
+
+    errors = ['{0}: {1}'.format(x['path'], response['error']) for x, response in zip(requests, responses) if 'error' in response]
+    if errors:
+        raise RuntimeError('edit_config_files() failed\n' + '\n'.join(errors))
+    return [x['path'] for x, response in zip(requests, responses) if response['changed']]
@@ -0,0 +1,149 @@
+import os
+import platform
+import shutil
+import time
+
+from . import irods_python_ci_utilities as utilities
+from .tracing import set_span_attribute, traced
+
+# Optional cache of initialized database data directories. The first run on a platform initializes the
+# database as usual and archives its data directory; later runs restore the archive instead of running
+# initdb and the setup statements. A snapshot is kept per distribution, major version, architecture and
+# database type, and is replaced when the server version differs from the one it was taken with.
+#
+#   enable_database_snapshots()
+#   install_database('postgres')
+#
+# Archives are compressed with zstd when it is installed, otherwise with gzip -1, and are checked against
+# the size and SHA-256 recorded when they were taken before being restored.
+
+__all__ = [
+    'enable_database_snapshots',
+    'disable_database_snapshots',
+    'clear_database_snapshots',
+    'initialize_database_from_snapshot',
+]
+
+# Bump when the snapshot layout changes
+SNAPSHOT_FORMAT = 1
+
+MANIFEST_BASENAME = 'manifest.json'
+
+snapshot_state = {
+    'enabled': False,
+}
+
+# Compressors by preference, as tar --use-compress-program arguments, with their archive suffixes
+snapshot_compressors = [
+    ('zstd', 'zstd -1 -T0', '.tar.zst'),
+    ('gzip', 'gzip -1', '.tar.gz'),
+]
+
+def enable_database_snapshots():
+    snapshot_state['enabled'] = True
+
+def disable_database_snapshots():
+    snapshot_state['enabled'] = False
+
+def clear_database_snapshots():
+    shutil.rmtree(utilities.get_cache_directory('database_snapshots'), ignore_errors=True)
+
+def get_snapshot_directory(database_type):
+    platform_name = '_'.join([utilities.get_distribution(), utilities.get_distribution_version_major(), platform.machine()])
+    return utilities.get_cache_directory('database_snapshots', '{0}_{1}'.format(platform_name, database_type))
+
+def get_snapshot_compressor():
+    for program, command, suffix in snapshot_compressors:
+        if shutil.which(program):
+            return command, suffix
+    raise RuntimeError('no compressor for database snapshots found; tried {0}'.format([x[0] for x in snapshot_compressors]))
+
+def check_snapshot(snapshot_directory, manifest, server_version):
+    # Returns None if the snapshot can be restored, otherwise why not
+    from .artifact_sync import hash_file
+    if manifest['server_version'] != server_version:
+        return 'taken with server version [{0}]'.format(manifest['server_version'])
+    archive = os.path.join(snapshot_directory, manifest['archive'])
+    try:
+        size = os.path.getsize(archive)
+    except OSError:
+        return 'archive is missing'
+    if size != manifest['size'] or hash_file(archive) != manifest['sha256']:
+        return 'archive does not match its manifest'
+    return None
+
+def empty_data_directory(data_directory):
+    utilities.subprocess_get_output(['sudo', 'mkdir', '-p', data_directory], check_rc=True)
+    utilities.subprocess_get_output(['sudo', 'find', data_directory, '-mindepth', '1', '-delete'], check_rc=True)
+
+def restore_snapshot(snapshot_directory, manifest, data_directory):
+    # Returns True if data_directory now holds the snapshot
+    empty_data_directory(data_directory)
+    rc, _, _ = utilities.subprocess_get_output(['sudo', 'tar', '--extract', '--same-owner', '--same-permissions', '--numeric-owner',
+                                                '--use-compress-program', manifest['compressor'],
+                                                '--file', os.path.join(snapshot_directory, manifest['archive']),
+                                                '--directory', data_directory])
+    if rc != 0:
+        empty_data_directory(data_directory)
+        return False
+    return True
+
+def save_snapshot(snapshot_directory, data_directory, server_version):
+    from .artifact_sync import hash_file
+    compressor, suffix = get_snapshot_compressor()
+    utilities.mkdir_p(snapshot_directory)
+    archive = os.path.join(snapshot_directory, 'data' + suffix)
+    utilities.subprocess_get_output(['sudo', 'tar', '--create', '--numeric-owner', '--use-compress-program', compressor,
+                                     '--file', archive + '.tmp', '--directory', data_directory, '.'], check_rc=True)
+    os.replace(archive + '.tmp', archive)
+    manifest = {
+        'server_version': server_version,
+        'data_directory': data_directory,
+        'archive': os.path.basename(archive),
+        'compressor': compressor,
+        'size': os.path.getsize(archive),
+        'sha256': hash_file(archive),
+        'created': time.time(),
+    }
+    # Written last: its presence marks a complete snapshot
+    utilities.write_json_manifest(os.path.join(snapshot_directory, MANIFEST_BASENAME), manifest, SNAPSHOT_FORMAT)
+
+@traced
+def initialize_database_from_snapshot(database_type, get_server_version, data_directory, initialize, stop=None, start=None):
+    # Leaves data_directory initialized, returning True if it was restored from a snapshot. Without a usable
+    # snapshot, calls initialize() and snapshots data_directory, between stop() and start() if given, which
+    # must leave the server stopped and running. A restore also runs between them. With snapshots disabled
+    # this is initialize(); get_server_version() is only called when they are enabled.
+    if not snapshot_state['enabled']:
+        initialize()
+        return False
+    server_version = get_server_version()
+    snapshot_directory = get_snapshot_directory(database_type)
+    with utilities.file_lock(snapshot_directory + '.lock'):
+        manifest = utilities.load_json_manifest(os.path.join(snapshot_directory, MANIFEST_BASENAME), SNAPSHOT_FORMAT)
+        problem = check_snapshot(snapshot_directory, manifest, server_version) if manifest is not None else 'no snapshot'
+        if problem is None:
+            if stop is not None:
+                stop()
+            if restore_snapshot(snapshot_directory, manifest, data_directory):
+                set_span_attribute('snapshot', 'restored')
+                if start is not None:
+                    start()
+                return True
+            problem = 'archive could not be extracted'
+        if manifest is not None:
+            print('discarding {0} data directory snapshot: {1}'.format(database_type, problem))
+            shutil.rmtree(snapshot_directory, ignore_errors=True)
+        set_span_attribute('snapshot', problem)
+        initialize()
+        if stop is not None:
+            stop()
+        try:
+            save_snapshot(snapshot_directory, data_directory, server_version)
+        except (RuntimeError, OSError) as e:
+            # The database is set up either way; the next run tries again
+            print('could not snapshot {0} data directory: {1}'.format(database_type, e))
+            shutil.rmtree(snapshot_directory, ignore_errors=True)
+        if start is not None:
+            start()
+    return False
@@ -0,0 +1,166 @@
+import collections
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from .irods_python_ci_utilities import get_cache_directory, write_file_atomically
+
+# Cached content younger than this many seconds is used without contacting the server
+default_max_age = 3600
+
+default_timeout = 30
+
+# Threads fetch_urls() fetches with, one server's urls at a time
+default_max_workers = 8
+
+connections = threading.local()
+
+def get_connection(scheme, netloc, timeout):
+    # One persistent connection per thread and server, reused across fetches
+    pool = connections.__dict__.setdefault('pool', {})
+    key = (scheme, netloc)
+    if key not in pool:
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        pool[key] = connection_class(netloc, timeout=timeout)
+    return pool[key]
+
+def close_connections():
+    for connection in connections.__dict__.pop('pool', {}).values():
+        connection.close()
+
+def http_get(url, headers, timeout, redirects=5):
+    # Returns (status, headers, body) for url, following redirects
+    for _ in range(redirects + 1):
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        for attempt in range(2):
+            connection = get_connection(parsed.scheme, parsed.netloc, timeout)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have closed an idle keep-alive connection; retry once on a fresh one
+                connection.close()
+                connections.pool.pop((parsed.scheme, parsed.netloc), None)
+                if attempt:
+                    raise
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            url = urllib.parse.urljoin(url, response.getheader('Location'))
+            continue
+        return response.status, response, body
+    raise RuntimeError('too many redirects fetching {0}'.format(url))
+
+def get_entry_path(cache_directory, url):
+    return os.path.join(cache_directory, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+def get_object_path(cache_directory, digest):
+    return os.path.join(cache_directory, 'objects', digest[:2], digest)
+
+def load_entry(cache_directory, url):
+    try:
+        with open(get_entry_path(cache_directory, url)) as f:
+            entry = json.load(f)
+        with open(get_object_path(cache_directory, entry['sha256']), 'rb') as f:
+            content = f.read()
+    except (IOError, ValueError, KeyError):
+        return None, None
+    if hashlib.sha256(content).hexdigest() != entry['sha256']:
+        return None, None
+    return entry, content
+
+def store_entry(cache_directory, url, entry, content):
+    if content is not None:
+        object_path = get_object_path(cache_directory, entry['sha256'])
+        if not os.path.exists(object_path):
+            write_file_atomically(object_path, content)
+    write_file_atomically(get_entry_path(cache_directory, url), json.dumps(entry))
+
+def fetch_url(url, max_age=None, cache_directory=None, timeout=None):
+    # Returns the content of url, served from the content-addressed cache when it is younger than
+    # max_age seconds, and otherwise revalidated with If-None-Match/If-Modified-Since.
+    # If the server cannot be reached, stale cached content is returned instead of failing.
+    if max_age is None:
+        max_age = default_max_age
+    if cache_directory is None:
+        cache_directory = get_cache_directory('fetch')
+    if timeout is None:
+        timeout = default_timeout
+    entry, content = load_entry(cache_directory, url)
+    if entry is not None and time.time() - entry['fetched_at'] < max_age:
+        return content
+
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        status, response, body = http_get(url, headers, timeout)
+    except (OSError, http.client.HTTPException) as e:
+        if entry is None:
+            raise
+        print('using cached copy of {0} after fetch failed: {1}'.format(url, e))
+        return content
+
+    if status >= 500 and entry is not None:
+        print('using cached copy of {0} after fetch failed with HTTP status {1}'.format(url, status))
+        return content
+    if status == 304 and entry is not None:
+        entry['fetched_at'] = time.time()
+        store_entry(cache_directory, url, entry, None)
+        return content
+    if status != 200:
+        raise RuntimeError('fetching {0} failed with HTTP status {1}'.format(url, status))
+    entry = {
+        'url': url,
+        'sha256': hashlib.sha256(body).hexdigest(),
+        'etag': response.getheader('ETag'),
+        'last_modified': response.getheader('Last-Modified'),
+        'fetched_at': time.time(),
+    }
+    store_entry(cache_directory, url, entry, body)
+    return body
+
+def fetch_urls(urls, max_age=None, cache_directory=None, timeout=None, max_workers=None):
+    # Fetches urls, a server's urls one after another over one keep-alive connection and
+    # different servers concurrently; returns their contents in the same order
+    servers = collections.OrderedDict()
+    for i, url in enumerate(urls):
+        parsed = urllib.parse.urlsplit(url)
+        servers.setdefault((parsed.scheme, parsed.netloc), []).append(i)
+    if len(servers) < 2:
+        return [fetch_url(url, max_age, cache_directory, timeout) for url in urls]
+    if max_workers is None:
+        max_workers = default_max_workers
+
+    # The connection pools of the workers, closed once all urls are fetched
+    pools = []
+    pools_lock = threading.Lock()
+    def start_worker():
+        with pools_lock:
+            pools.append(connections.__dict__.setdefault('pool', {}))
+
+    contents = [None] * len(urls)
+    def fetch(indexes):
+        for i in indexes:
+            contents[i] = fetch_url(urls[i], max_age, cache_directory, timeout)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(servers), max_workers), initializer=start_worker) as executor:
+            for future in [executor.submit(fetch, indexes) for indexes in servers.values()]:
+                future.result()
+    finally:
+        for pool in pools:
+            for connection in pool.values():
+                connection.close()
+    return contents
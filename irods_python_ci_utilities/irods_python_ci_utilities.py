@@ -1,34 +1,143 @@
+import collections
 import contextlib
 import errno
+import fcntl
+import functools
 import json
 import os
-import pwd
-import shutil
 import subprocess
 import sys
-import tempfile
+import threading
 import time
-import urllib.request
-from pathlib import Path
 
 from . import copied_from_ansible
+from . import resource_accounting
+from .config_files import config_content, config_ini_option, config_key_value, config_line, edit_config_files
+from .privileged_helper import get_privileged_helper
+from .readiness import wait_for_mysql, wait_for_postgres
+from .tracing import set_span_attribute, trace_span, traced
+
+# Path of an alternate os-release file, e.g. for provisioning a chroot or faking a distribution.
+OS_RELEASE_ENVIRONMENT_VARIABLE = 'IRODS_PYTHON_CI_UTILITIES_OS_RELEASE'
+
+PlatformFacts = collections.namedtuple('PlatformFacts', ['distribution', 'distribution_version', 'id', 'id_like', 'version_codename'])
+
+def unquote_os_release_value(value):
+    # Values may be single or double quoted, with backslash escapes inside double quotes
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        quote = value[0]
+        value = value[1:-1]
+        if quote == '"':
+            characters = []
+            escaped = False
+            for c in value:
+                if escaped or c != '\\':
+                    characters.append(c)
+                    escaped = False
+                else:
+                    escaped = True
+            value = ''.join(characters)
+    return value
+
+def parse_os_release(path):
+    # Returns dict of the KEY=value assignments in an os-release(5) file
+    fields = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            fields[key] = unquote_os_release_value(value)
+    return fields
+
+@functools.lru_cache(maxsize=None)
+def get_platform_facts():
+    # Resolved once per process; call reset_platform_facts() to re-read
+    candidates = ['/etc/os-release', '/usr/lib/os-release']
+    if os.environ.get(OS_RELEASE_ENVIRONMENT_VARIABLE):
+        candidates = [os.environ[OS_RELEASE_ENVIRONMENT_VARIABLE]]
+    for path in candidates:
+        try:
+            fields = parse_os_release(path)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        # Capitalized like the distribution names reported by copied_from_ansible
+        return PlatformFacts(
+            distribution=fields.get('NAME', '').capitalize(),
+            distribution_version=fields.get('VERSION_ID', ''),
+            id=fields.get('ID', ''),
+            id_like=tuple(fields.get('ID_LIKE', '').split()),
+            version_codename=fields.get('VERSION_CODENAME', '') or fields.get('UBUNTU_CODENAME', ''))
+    return PlatformFacts(
+        distribution=copied_from_ansible.get_distribution() or '',
+        distribution_version=copied_from_ansible.get_distribution_version() or '',
+        id='',
+        id_like=(),
+        version_codename='')
+
+def reset_platform_facts():
+    get_platform_facts.cache_clear()
+    get_package_manager_backend.cache_clear()
 
 def get_distribution(slash_substitute_character='_'):
-    return copied_from_ansible.get_distribution().replace('/', slash_substitute_character)
+    return get_platform_facts().distribution.replace('/', slash_substitute_character)
 
 def get_distribution_version_major():
-    return copied_from_ansible.get_distribution_version().split('.')[0]
+    return get_platform_facts().distribution_version.split('.')[0]
 
 def get_irods_platform_string():
     return get_distribution() + '_' + get_distribution_version_major()
 
+def get_distribution_codename():
+    codename = get_platform_facts().version_codename
+    if not codename:
+        _, out, _ = subprocess_get_output(['lsb_release', '-sc'], check_rc=True, stream=False)
+        codename = out.strip()
+    return codename
+
+# Root of the persistent caches kept between runs; defaults to $XDG_CACHE_HOME/irods_python_ci_utilities
+CACHE_DIRECTORY_ENVIRONMENT_VARIABLE = 'IRODS_PYTHON_CI_UTILITIES_CACHE_DIR'
+
+def get_cache_directory(*subdirectories):
+    root = os.environ.get(CACHE_DIRECTORY_ENVIRONMENT_VARIABLE)
+    if not root:
+        root = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'irods_python_ci_utilities')
+    return os.path.join(root, *subdirectories)
+
 def raise_not_implemented_for_distribution():
     raise NotImplementedError('not implemented for distribution [{0}]'.format(get_distribution()), sys.exc_info()[2])
 
 def raise_not_implemented_for_distribution_major_version():
     raise NotImplementedError('not implemented for distribution [{0}] major version [{1}]'.format(get_distribution(), get_distribution_version_major()), sys.exc_info()[2])
 
+# Defaults for subprocess_get_output() calls that do not pass stream=; see enable_subprocess_output_streaming()
+subprocess_streaming_defaults = {
+    'stream': False,
+    'log_file': None,
+    'tail_lines': 200,
+}
+
+def enable_subprocess_output_streaming(log_file=None, tail_lines=200):
+    # Makes every subprocess_get_output() call, including those made by the installers, stream by default
+    subprocess_streaming_defaults.update(stream=True, log_file=log_file, tail_lines=tail_lines)
+
+def disable_subprocess_output_streaming():
+    subprocess_streaming_defaults.update(stream=False, log_file=None, tail_lines=200)
+
 def subprocess_get_output(*args, **kwargs):
+    # stream=True forwards output line by line as it arrives, optionally appending it to log_file,
+    # and keeps only the last tail_lines lines of each stream for the returned out and err.
+    # stream=False (the default) captures everything and prints it once the process exits.
+    # Callers that parse out or err pass stream=False, since enable_subprocess_output_streaming() changes the default.
+    stream = kwargs.pop('stream', subprocess_streaming_defaults['stream'])
+    log_file = kwargs.pop('log_file', subprocess_streaming_defaults['log_file'])
+    tail_lines = kwargs.pop('tail_lines', subprocess_streaming_defaults['tail_lines'])
     kwargs['stdout'] = subprocess.PIPE
     kwargs['stderr'] = subprocess.PIPE
     check_rc = False
@@ -40,9 +149,166 @@ def subprocess_get_output(*args, **kwargs):
         kwargs['stdin'] = subprocess.PIPE
         data = kwargs['data']
         del kwargs['data']
-    p = subprocess.Popen(*args, **kwargs)
-    out_b, err_b = p.communicate(data)
+    argv = args[0] if args else kwargs.get('args')
+    with trace_span('subprocess', argv=[argv] if isinstance(argv, (str, bytes)) else list(argv), cwd=kwargs.get('cwd')):
+        # The helper neither streams nor can be cancelled, and runs one command at a time; commands that
+        # stream, run in a SubprocessScope, or would wait for another command of the helper spawn sudo
+        helper = get_privileged_helper()
+        if helper is not None and not stream and can_run_in_privileged_helper(argv, kwargs):
+            result = run_in_privileged_helper(helper, argv, kwargs.get('cwd') or os.getcwd(), data)
+            if result is not None:
+                returncode, out_b, err_b = result
+                set_span_attribute('returncode', returncode)
+                return report_subprocess_output(args, kwargs, returncode, out_b, err_b, check_rc)
+        if stream:
+            return subprocess_get_output_streaming(args, kwargs, data, check_rc, log_file, tail_lines)
+        return subprocess_get_output_captured(args, kwargs, data, check_rc)
+
+def run_in_privileged_helper(helper, argv, cwd, data):
+    # Returns (returncode, stdout bytes, stderr bytes), or None if the helper is busy
+    if not resource_accounting.is_enabled():
+        return helper.run(argv[1:], cwd=cwd, data=data, blocking=False)
+    result = helper.run(argv[1:], cwd=cwd, data=data, with_usage=True, blocking=False)
+    if result is None:
+        return None
+    returncode, out_b, err_b, usage = result
+    if usage is not None:
+        set_span_usage_attributes(resource_accounting.record_command(argv, **usage))
+    return returncode, out_b, err_b
+
+def can_run_in_privileged_helper(argv, kwargs):
+    # Plain 'sudo command ...' argument lists; sudo options, shell strings and unusual Popen arguments still spawn sudo
+    if isinstance(argv, (str, bytes)) or kwargs.get('shell'):
+        return False
+    argv = list(argv)
+    if len(argv) < 2 or argv[0] != 'sudo' or argv[1].startswith('-'):
+        return False
+    if getattr(SubprocessScope.current, 'scope', None) is not None:
+        return False
+    return set(kwargs) <= set(['stdout', 'stderr', 'stdin', 'cwd'])
 
+# Seconds a cancelled child process has to exit after SIGTERM before it is sent SIGKILL
+SUBPROCESS_TERMINATION_GRACE_PERIOD = 5
+
+# Seconds between the checks for cancellation of a thread waiting for another's package manager transaction
+SUBPROCESS_SCOPE_CANCELLATION_CHECK_INTERVAL = 0.5
+
+class SubprocessScope(object):
+    # Tracks the child processes that subprocess_get_output starts in a thread running inside run(),
+    # so that another thread can kill them, e.g. when the asyncio task waiting for that work is cancelled.
+    # Waits of that thread between commands, for the package database lock or for another thread's
+    # package manager transaction, end early on cancellation as well.
+    current = threading.local()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.cancelled = threading.Event()
+
+    def run(self, function, *args, **kwargs):
+        previous = getattr(SubprocessScope.current, 'scope', None)
+        SubprocessScope.current.scope = self
+        try:
+            return function(*args, **kwargs)
+        finally:
+            SubprocessScope.current.scope = previous
+
+    def cancel(self):
+        # Children get SIGTERM first, which sudo relays to its command, e.g. apt-get, so that it can release
+        # its locks; those still running after SUBPROCESS_TERMINATION_GRACE_PERIOD seconds are killed
+        with self.lock:
+            self.cancelled.set()
+            self.signal('terminate')
+        timer = threading.Timer(SUBPROCESS_TERMINATION_GRACE_PERIOD, self.kill)
+        timer.daemon = True
+        timer.start()
+
+    def kill(self):
+        with self.lock:
+            self.signal('kill')
+
+    def signal(self, method):
+        for p in self.processes:
+            try:
+                getattr(p, method)()
+            except OSError:
+                pass
+
+    def start(self, args, kwargs):
+        with self.lock:
+            if self.cancelled.is_set():
+                raise RuntimeError('subprocess_get_output() cancelled\nargs: {0}'.format(args))
+            p = subprocess.Popen(*args, **kwargs)
+            self.processes.add(p)
+            return p
+
+    def finish(self, p):
+        with self.lock:
+            self.processes.discard(p)
+
+def subprocess_scope_cancelled():
+    # True if the calling thread runs in a SubprocessScope that has been cancelled
+    scope = getattr(SubprocessScope.current, 'scope', None)
+    return scope is not None and scope.cancelled.is_set()
+
+def sleep_unless_cancelled(seconds):
+    # time.sleep(seconds), raising RuntimeError as soon as the calling thread's SubprocessScope is cancelled
+    scope = getattr(SubprocessScope.current, 'scope', None)
+    if scope is None:
+        time.sleep(seconds)
+    elif scope.cancelled.wait(seconds):
+        raise RuntimeError('sleep cancelled')
+
+@contextlib.contextmanager
+def started_process(args, kwargs):
+    scope = getattr(SubprocessScope.current, 'scope', None)
+    if scope is None:
+        yield subprocess.Popen(*args, **kwargs)
+        return
+    p = scope.start(args, kwargs)
+    try:
+        yield p
+    finally:
+        scope.finish(p)
+
+def subprocess_get_output_captured(args, kwargs, data, check_rc):
+    with started_process(args, kwargs) as p:
+        if resource_accounting.is_enabled():
+            out_b, err_b = communicate_and_account(p, data, args[0] if args else kwargs.get('args'))
+        else:
+            out_b, err_b = p.communicate(data)
+    set_span_attribute('returncode', p.returncode)
+    return report_subprocess_output(args, kwargs, p.returncode, out_b, err_b, check_rc)
+
+def communicate_and_account(p, data, argv):
+    # p.communicate(data), but reaping p through resource_accounting so that its usage is recorded
+    start_time = resource_accounting.started(p)
+    outputs = {}
+    def read(name, pipe):
+        outputs[name] = pipe.read()
+        pipe.close()
+    readers = [threading.Thread(target=read, args=('out', p.stdout)), threading.Thread(target=read, args=('err', p.stderr))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    if p.stdin is not None:
+        try:
+            if data:
+                p.stdin.write(data)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+    for reader in readers:
+        reader.join()
+    set_span_usage_attributes(resource_accounting.reap(p, argv, start_time))
+    return outputs['out'], outputs['err']
+
+def set_span_usage_attributes(usage):
+    set_span_attribute('user_cpu', usage.user_cpu)
+    set_span_attribute('system_cpu', usage.system_cpu)
+    set_span_attribute('max_rss_kb', usage.max_rss_kb)
+
+def report_subprocess_output(args, kwargs, returncode, out_b, err_b, check_rc):
     if out_b:
         out = out_b.decode('utf-8') if isinstance(out_b, bytes) else out_b
         try:
@@ -62,222 +328,709 @@ def subprocess_get_output(*args, **kwargs):
         err = ''
 
     if check_rc:
-        if p.returncode != 0:
+        if returncode != 0:
             raise RuntimeError('''subprocess_get_output() failed
 args: {0}
 kwargs: {1}
 returncode: {2}
 stdout: {3}
 stderr: {4}
-'''.format(args, kwargs, p.returncode, out, err))
+'''.format(args, kwargs, returncode, out, err))
+    return returncode, out, err
+
+def subprocess_get_output_streaming(args, kwargs, data, check_rc, log_file, tail_lines):
+    # Pipes are read as bytes and decoded per line regardless of text mode
+    for key in ['universal_newlines', 'text', 'encoding', 'errors']:
+        kwargs.pop(key, None)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    close_log = False
+    log_lock = threading.Lock()
+    if isinstance(log_file, (str, bytes, os.PathLike)):
+        log_file = open(log_file, 'ab')
+        close_log = True
+
+    def forward(pipe, sink, tail):
+        for line_b in iter(pipe.readline, b''):
+            line = line_b.decode('utf-8', errors='replace')
+            tail.append(line)
+            with log_lock:
+                try:
+                    sink.write(line)
+                except UnicodeEncodeError:
+                    sink.write(repr(line_b) + '\n')
+                sink.flush()
+                if log_file is not None:
+                    log_file.write(line_b if 'b' in getattr(log_file, 'mode', '') else line)
+        pipe.close()
+
+    out_tail = collections.deque(maxlen=tail_lines)
+    err_tail = collections.deque(maxlen=tail_lines)
+    try:
+        with started_process(args, kwargs) as p:
+            accounting = resource_accounting.is_enabled()
+            if accounting:
+                start_time = resource_accounting.started(p)
+            readers = [
+                threading.Thread(target=forward, args=(p.stdout, sys.stdout, out_tail)),
+                threading.Thread(target=forward, args=(p.stderr, sys.stderr, err_tail)),
+            ]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+            if p.stdin is not None:
+                try:
+                    if data:
+                        p.stdin.write(data)
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
+            for reader in readers:
+                reader.join()
+            if accounting:
+                set_span_usage_attributes(resource_accounting.reap(p, args[0] if args else kwargs.get('args'), start_time))
+            else:
+                p.wait()
+            set_span_attribute('returncode', p.returncode)
+    finally:
+        if close_log:
+            log_file.close()
+
+    out = ''.join(out_tail)
+    err = ''.join(err_tail)
+    if check_rc:
+        if p.returncode != 0:
+            raise RuntimeError('''subprocess_get_output() failed
+args: {0}
+kwargs: {1}
+returncode: {2}
+stdout (last {5} lines): {3}
+stderr (last {5} lines): {4}
+'''.format(args, kwargs, p.returncode, out, err, tail_lines))
     return p.returncode, out, err
 
-def install_os_packages_apt(packages):
+# Package metadata refreshed less than this many seconds ago is not refreshed again before installing
+package_metadata_defaults = {
+    'max_age': 3600,
+}
+
+def set_package_metadata_max_age(seconds):
+    package_metadata_defaults['max_age'] = seconds
+
+apt_metadata_refreshed_at = {'time': 0}
+
+# Touched after each successful apt-get update of this library. The lists themselves are no guide to when
+# they were fetched: apt sets their mtimes to the server's Last-Modified time.
+def get_apt_update_stamp_path():
+    return get_cache_directory('apt', 'update-success-stamp')
+
+# Touched by APT::Periodic (update-notifier-common) after its own successful updates
+apt_periodic_update_stamp = '/var/lib/apt/periodic/update-success-stamp'
+
+def apt_package_lists_are_fresh(max_age):
+    # Lists emptied with rm -rf /var/lib/apt/lists/*, as container images do, are never fresh
+    import glob
+    if not glob.glob('/var/lib/apt/lists/*_Packages') and not glob.glob('/var/lib/apt/lists/*_Packages.*'):
+        return False
+    refreshed_at = apt_metadata_refreshed_at['time']
+    for stamp in [get_apt_update_stamp_path(), apt_periodic_update_stamp]:
+        try:
+            refreshed_at = max(refreshed_at, os.stat(stamp).st_mtime)
+        except OSError:
+            pass
+    if time.time() - refreshed_at > max_age:
+        return False
+    # A source added or changed since the last refresh invalidates the lists
+    sources = ['/etc/apt/sources.list']
+    if os.path.isdir('/etc/apt/sources.list.d'):
+        sources.extend(os.path.join('/etc/apt/sources.list.d', x) for x in os.listdir('/etc/apt/sources.list.d'))
+    for source in sources:
+        try:
+            if os.stat(source).st_mtime > refreshed_at:
+                return False
+        except OSError:
+            pass
+    return True
+
+@traced
+def refresh_package_metadata_apt(max_age=None):
+    if max_age is None:
+        max_age = package_metadata_defaults['max_age']
+    if apt_package_lists_are_fresh(max_age):
+        return
     subprocess_get_output(['sudo', 'apt-get', 'update'], check_rc=True)
-    args = ['sudo', 'apt-get', 'install', '-y'] + list(packages)
+    apt_metadata_refreshed_at['time'] = time.time()
+    try:
+        write_file_atomically(get_apt_update_stamp_path(), '')
+    except OSError:
+        # Only later processes miss it; they refresh again
+        pass
+
+def query_installed_packages_apt(names):
+    # Returns dict of package name to installed version, from a single dpkg-query call
+    if not names:
+        return {}
+    args = ['dpkg-query', '--show', '--showformat=${Package}\t${Version}\t${db:Status-Status}\n'] + list(names)
+    try:
+        _, out, _ = subprocess_get_output(args, stream=False)
+    except OSError:
+        return {}
+    installed = {}
+    for line in out.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 3 and fields[2] == 'installed':
+            installed[fields[0]] = fields[1]
+    return installed
+
+def filter_satisfied_packages_apt(packages):
+    # Returns the packages, in the form name[:arch][=version], that are not installed at the requested version.
+    # Anything that is not a plain package name, e.g. a release pin or a pattern, is never considered satisfied.
+    import fnmatch
+    requested = []
+    for package in packages:
+        name, _, version = package.partition('=')
+        requested.append((package, name.partition(':')[0], version))
+    installed = query_installed_packages_apt([name for _, name, _ in requested if not set('/*?[~^') & set(name)])
+    remaining = []
+    for package, name, version in requested:
+        if name not in installed:
+            remaining.append(package)
+        elif version and not fnmatch.fnmatchcase(installed[name], version):
+            remaining.append(package)
+    return remaining
+
+def filter_satisfied_package_files_apt(files):
+    requested = []
+    for f in files:
+        try:
+            _, out, _ = subprocess_get_output(['dpkg-deb', '--show', '--showformat=${Package}\t${Version}', f], stream=False)
+        except OSError:
+            out = ''
+        name, _, version = out.strip().partition('\t')
+        requested.append((f, name, version))
+    installed = query_installed_packages_apt([name for _, name, _ in requested if name])
+    return [f for f, name, version in requested if not name or installed.get(name) != version]
+
+def filter_satisfied_packages_rpm(packages):
+    # rpm matches name, name-version and name-version-release itself; anything else it reports as not installed
+    if not packages:
+        return []
+    env = dict(os.environ, LC_ALL='C')
+    try:
+        _, out, _ = subprocess_get_output(['rpm', '--query', '--queryformat', '%{NAME}\n'] + list(packages), env=env, stream=False)
+    except OSError:
+        return list(packages)
+    not_installed = set()
+    for line in out.splitlines():
+        if line.startswith('package ') and line.endswith(' is not installed'):
+            not_installed.add(line[len('package '):-len(' is not installed')])
+    return [package for package in packages if package in not_installed]
+
+def filter_satisfied_package_files_rpm(files):
+    if not files:
+        return []
+    try:
+        _, out, _ = subprocess_get_output(['rpm', '--query', '--package', '--queryformat', '%{NAME}-%{VERSION}-%{RELEASE}\n'] + list(files), stream=False)
+    except OSError:
+        return list(files)
+    labels = out.splitlines()
+    if len(labels) != len(files):
+        return list(files)
+    remaining_labels = set(filter_satisfied_packages_rpm(labels))
+    return [f for f, label in zip(files, labels) if label in remaining_labels]
+
+# Held around every package manager transaction this process runs
+package_manager_lock = threading.RLock()
+
+# How long a transaction keeps retrying while another process, e.g. unattended-upgrades, holds the
+# system package database lock; see set_system_package_lock_timeout()
+system_package_lock_defaults = {
+    'timeout': 600,
+    'initial_delay': 0.5,
+    'max_delay': 10,
+}
+
+def set_system_package_lock_timeout(seconds):
+    system_package_lock_defaults['timeout'] = seconds
+
+# Output of apt-get, dpkg, yum, dnf, rpm and zypper when another process holds the package database lock
+system_package_lock_messages = [
+    'Could not get lock',
+    'Unable to acquire the dpkg frontend lock',
+    'Unable to lock the administration directory',
+    'Unable to lock directory',
+    'holding the yum lock',
+    "can't create transaction lock",
+    'System management is locked',
+]
+
+def run_waiting_for_system_package_lock(function, packages, files, metadata_max_age):
+    # Runs function(packages, files, metadata_max_age), retrying with exponential backoff while it
+    # fails because another process holds the system package database lock
+    deadline = time.monotonic() + system_package_lock_defaults['timeout']
+    delay = system_package_lock_defaults['initial_delay']
+    with package_manager_lock:
+        while True:
+            try:
+                return function(packages, files, metadata_max_age)
+            except RuntimeError as e:
+                now = time.monotonic()
+                if now >= deadline or not any(x in str(e) for x in system_package_lock_messages):
+                    raise
+                print('package database is locked by another process; retrying in {0:.1f} seconds'.format(delay))
+                sleep_unless_cancelled(min(delay, deadline - now))
+                delay = min(delay * 2, system_package_lock_defaults['max_delay'])
+
+class PackageManagerRequest(object):
+    def __init__(self, function, packages, files, metadata_max_age):
+        self.function = function
+        self.packages = list(packages)
+        self.files = list(files)
+        self.metadata_max_age = metadata_max_age
+        self.done = False
+        self.result = None
+        self.error = None
+        # Set when the caller stopped waiting for the request, cancelled
+        self.abandoned = False
+
+class PackageManagerBroker(object):
+    # Serializes the package manager transactions of this process. Requests made while a transaction
+    # runs are queued, and merged into one follow-up transaction run by the first of their callers to
+    # wake up. Requests with package files are only merged with each other, since installing files
+    # skips signature checks and, on yum, rebuilds the rpm database and updates the system first. Every caller gets the result of the transaction covering its request; if a merged
+    # transaction fails, each of its requests is retried alone so a caller only sees its own error.
+    # A caller cancelled through its SubprocessScope stops waiting; if it was running the transaction,
+    # the requests of the other callers are queued again for one of them to run.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = []
+        self.leader = None
+
+    def install(self, function, packages, files, metadata_max_age=None):
+        # Nested calls from within a running transaction run directly
+        if self.leader is threading.current_thread():
+            return run_waiting_for_system_package_lock(function, packages, files, metadata_max_age)
+        request = PackageManagerRequest(function, packages, files, metadata_max_age)
+        with self.condition:
+            self.pending.append(request)
+            while not request.done and self.leader is not None:
+                self.condition.wait(SUBPROCESS_SCOPE_CANCELLATION_CHECK_INTERVAL)
+                if not request.done and subprocess_scope_cancelled():
+                    request.abandoned = True
+                    if request in self.pending:
+                        self.pending.remove(request)
+                    raise RuntimeError('package manager transaction cancelled\npackages: {0}\nfiles: {1}'.format(packages, files))
+            if not request.done:
+                self.leader = threading.current_thread()
+                batch = [x for x in self.pending if x.function is function and bool(x.files) == bool(files)]
+                self.pending = [x for x in self.pending if x not in batch]
+        if not request.done:
+            try:
+                self.run_batch(batch, request)
+            finally:
+                with self.condition:
+                    self.leader = None
+                    self.condition.notify_all()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def run_batch(self, batch, own_request):
+        packages = []
+        files = []
+        for request in batch:
+            packages.extend(x for x in request.packages if x not in packages)
+            files.extend(x for x in request.files if x not in files)
+        max_ages = [x.metadata_max_age for x in batch if x.metadata_max_age is not None]
+        try:
+            with trace_span('package_manager_transaction', requests=len(batch)):
+                try:
+                    result = run_waiting_for_system_package_lock(batch[0].function, packages, files, min(max_ages) if max_ages else None)
+                    for request in batch:
+                        request.result = result
+                except Exception as e:
+                    if subprocess_scope_cancelled():
+                        own_request.error = e
+                    elif len(batch) == 1:
+                        batch[0].error = e
+                    else:
+                        for request in batch:
+                            if subprocess_scope_cancelled():
+                                break
+                            try:
+                                request.result = run_waiting_for_system_package_lock(request.function, request.packages, request.files, request.metadata_max_age)
+                            except Exception as request_error:
+                                if request is own_request or not subprocess_scope_cancelled():
+                                    request.error = request_error
+        except BaseException as e:
+            for request in batch:
+                if request.result is None and request.error is None:
+                    request.error = e
+            raise
+        finally:
+            if own_request.result is None and own_request.error is None:
+                own_request.error = RuntimeError('package manager transaction cancelled\npackages: {0}\nfiles: {1}'.format(own_request.packages, own_request.files))
+            with self.condition:
+                for request in batch:
+                    if request.result is None and request.error is None:
+                        # Left unfinished by the cancellation of this caller
+                        if not request.abandoned:
+                            self.pending.append(request)
+                    else:
+                        request.done = True
+
+package_manager_broker = PackageManagerBroker()
+
+def through_package_manager_broker(function):
+    # function(packages, files, metadata_max_age=None) runs as a PackageManagerBroker transaction
+    @functools.wraps(function)
+    def wrapper(packages, files, metadata_max_age=None):
+        return package_manager_broker.install(function, packages, files, metadata_max_age)
+    return wrapper
+
+@through_package_manager_broker
+def install_os_packages_and_files_apt(packages, files, metadata_max_age=None):
+    packages = filter_satisfied_packages_apt(packages)
+    files = filter_satisfied_package_files_apt(files)
+    if not packages and not files:
+        return 0, '', ''
+    refresh_package_metadata_apt(metadata_max_age)
+    # If several package files are present, they should be installed simultaneously, ie.
+    # within the same command, so that possible dependencies between them are recognized.
+    args = ['sudo', 'apt-get', 'install', '-fy' if files else '-y'] + list(packages) + list(files)
     return subprocess_get_output(args, check_rc=True)
 
-def install_os_packages_yum(packages):
-    args = ['sudo', 'yum', 'install', '-y'] + list(packages)
+@through_package_manager_broker
+def install_os_packages_and_files_yum(packages, files, metadata_max_age=None):
+    packages = filter_satisfied_packages_rpm(packages)
+    files = filter_satisfied_package_files_rpm(files)
+    if not packages and not files:
+        return 0, '', ''
+    if files:
+        subprocess_get_output(['sudo', 'rpm', '--rebuilddb'], check_rc=True)
+        subprocess_get_output(['sudo', 'yum', 'update', '-y'], check_rc=True)
+        args = ['sudo', 'yum', 'install', '-y', '--nogpgcheck'] + list(packages) + list(files)
+    else:
+        args = ['sudo', 'yum', 'install', '-y'] + list(packages)
     return subprocess_get_output(args, check_rc=True)
 
-def install_os_packages_dnf(packages):
-    args = ['sudo', 'dnf', 'install', '-y'] + list(packages)
+@through_package_manager_broker
+def install_os_packages_and_files_dnf(packages, files, metadata_max_age=None):
+    packages = filter_satisfied_packages_rpm(packages)
+    files = filter_satisfied_package_files_rpm(files)
+    if not packages and not files:
+        return 0, '', ''
+    args = ['sudo', 'dnf', 'install', '-y'] + (['--nogpgcheck'] if files else []) + list(packages) + list(files)
     return subprocess_get_output(args, check_rc=True)
 
-def install_os_packages_zypper(packages):
-    args = ['sudo', 'zypper', '--non-interactive', 'install'] + list(packages)
+@through_package_manager_broker
+def install_os_packages_and_files_zypper(packages, files, metadata_max_age=None):
+    packages = filter_satisfied_packages_rpm(packages)
+    files = filter_satisfied_package_files_rpm(files)
+    if not packages and not files:
+        return 0, '', ''
+    args = ['sudo', 'zypper'] + (['--no-gpg-checks'] if files else []) + ['--non-interactive', 'install'] + list(packages) + list(files)
     return subprocess_get_output(args, check_rc=True)
 
+def install_os_packages_apt(packages):
+    return install_os_packages_and_files_apt(packages, [])
+
+def install_os_packages_yum(packages):
+    return install_os_packages_and_files_yum(packages, [])
+
+def install_os_packages_dnf(packages):
+    return install_os_packages_and_files_dnf(packages, [])
+
+def install_os_packages_zypper(packages):
+    return install_os_packages_and_files_zypper(packages, [])
+
+@traced
 def install_os_packages(packages):
-    dispatch_map = {
-        'Ubuntu': install_os_packages_apt,
-        'Debian gnu_linux': install_os_packages_apt,
-        'Centos': install_os_packages_yum,
-        'Centos linux': install_os_packages_yum,
-        'Almalinux': install_os_packages_dnf,
-        'Rocky linux': install_os_packages_dnf,
-        'Opensuse ': install_os_packages_zypper,
-        'Opensuse leap': install_os_packages_zypper,
-    }
-    try:
-        return dispatch_map[get_distribution()](packages)
-    except KeyError:
-        raise_not_implemented_for_distribution()
+    return get_package_manager_backend().install_os_packages(packages)
 
 def install_os_packages_from_files_apt(files):
     if len(files) > 0:
-        subprocess_get_output(['sudo', 'apt-get', 'update'], check_rc=True)
-        # If several package files are present, they should be installed simultaneously, ie.
-        # within the same command, so that possible dependencies between them are recognized.
-        args = ['sudo', 'apt', 'install', '-fy'] + list(files)
-        subprocess_get_output(args, check_rc=True)
+        install_os_packages_and_files_apt([], files)
 
 def install_os_packages_from_files_dnf(files):
-    args = ['sudo', 'dnf', 'localinstall', '-y', '--nogpgcheck'] + list(files)
-    subprocess_get_output(args, check_rc=True)
+    if len(files) > 0:
+        install_os_packages_and_files_dnf([], files)
 
 def install_os_packages_from_files_yum(files):
-    subprocess_get_output(['sudo', 'rpm', '--rebuilddb'], check_rc=True)
-    subprocess_get_output(['sudo', 'yum', 'update', '-y'], check_rc=True)
-    args = ['sudo', 'yum', 'localinstall', '-y', '--nogpgcheck'] + list(files)
-    subprocess_get_output(args, check_rc=True)
+    if len(files) > 0:
+        install_os_packages_and_files_yum([], files)
 
 def install_os_packages_from_files_zypper(files):
-    args = ['sudo', 'zypper', '--no-gpg-checks', '--non-interactive', 'install'] + list(files)
-    subprocess_get_output(args, check_rc=True)
+    if len(files) > 0:
+        install_os_packages_and_files_zypper([], files)
 
+@traced
 def install_os_packages_from_files(files):
-    dispatch_map = {
-        'Ubuntu': install_os_packages_from_files_apt,
-        'Debian gnu_linux': install_os_packages_from_files_apt,
-        'Centos': install_os_packages_from_files_yum,
-        'Centos linux': install_os_packages_from_files_yum,
-        'Almalinux': install_os_packages_from_files_dnf,
-        'Rocky linux': install_os_packages_from_files_dnf,
-        'Opensuse ': install_os_packages_from_files_zypper,
-        'Opensuse leap': install_os_packages_from_files_zypper,
-    }
+    get_package_manager_backend().install_os_packages_from_files(files)
+
+class PackageTransaction(object):
+    # Collects repository packages and local package files, and installs them all with at most
+    # one metadata refresh and one package manager invocation per flush(). Used as a context
+    # manager, the transaction is flushed when the block exits without an exception.
+    def __init__(self, metadata_max_age=None):
+        self.metadata_max_age = metadata_max_age
+        self.packages = []
+        self.files = []
+
+    def add_packages(self, packages):
+        for package in packages:
+            if package not in self.packages:
+                self.packages.append(package)
+
+    def add_files(self, files):
+        for f in files:
+            if f not in self.files:
+                self.files.append(f)
+
+    @traced
+    def flush(self):
+        if not self.packages and not self.files:
+            return None
+        packages, files = self.packages, self.files
+        self.packages, self.files = [], []
+        return get_package_manager_backend().install_os_packages_and_files(packages, files, self.metadata_max_age)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+# Servers the iRODS package repositories and signing keys are fetched from
+irods_repository_urls = {
+    'packages': 'https://packages.irods.org',
+    'core-dev': 'https://core-dev.irods.org',
+}
+
+def write_file_as_root_if_changed(path, content, mode='0644'):
+    # Returns True if the file was written; files already holding content are left untouched
+    import tempfile
+    if isinstance(content, str):
+        content = content.encode('utf-8')
     try:
-        dispatch_map[get_distribution()](files)
-    except KeyError:
-        raise_not_implemented_for_distribution()
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except IOError as e:
+        if e.errno not in [errno.ENOENT, errno.EACCES]:
+            raise
+    helper = get_privileged_helper()
+    if helper is not None:
+        return helper.write_file(path, content, int(mode, 8))
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(content)
+        f.flush()
+        subprocess_get_output(['sudo', 'install', '-D', '-m', mode, f.name, path], check_rc=True)
+    return True
 
-def install_irods_packages_repository_apt():
-    install_os_packages_apt(['ca-certificates', 'gnupg', 'lsb-release'])
-    gpg_cmd = [
-        'sudo',
-        'gpg',
-        '--no-options',
-        '--no-default-keyring',
-        '--no-auto-check-trustdb',
-        '--homedir', '/dev/null',
-        '--no-keyring',
-        '--import-options', 'import-export',
-        '--output', '/etc/apt/keyrings/renci-irods-archive-keyring.pgp',
-        '--import',
-    ]
-    with urllib.request.urlopen('https://packages.irods.org/irods-signing-key.asc') as gpg_keys:
-        subprocess_get_output(gpg_cmd, data=gpg_keys.read(), check_rc=True)
-    subprocess_get_output('echo "deb [signed-by=/etc/apt/keyrings/renci-irods-archive-keyring.pgp arch=amd64] https://packages.irods.org/apt/ $(lsb_release -sc) main" | sudo tee /etc/apt/sources.list.d/renci-irods.list', shell=True, check_rc=True)
+def fetch_irods_repository_files(repository, filenames):
+    from . import fetch_cache
+    base_url = irods_repository_urls[repository]
+    return fetch_cache.fetch_urls(['{0}/{1}'.format(base_url, x) for x in filenames])
 
-def install_irods_core_dev_repository_apt():
+def get_signing_key_stamp_path(keyring_path):
+    return get_cache_directory('signing_keys', keyring_path.strip('/').replace('/', '_') + '.sha256')
+
+def install_irods_repository_apt(repository, signing_key_filename, keyring_basename, list_basename):
+    import hashlib
+    import tempfile
     install_os_packages_apt(['ca-certificates', 'gnupg', 'lsb-release'])
+    signing_key, = fetch_irods_repository_files(repository, [signing_key_filename])
+    keyring_path = os.path.join('/etc/apt/keyrings', keyring_basename)
+    # The keyring is only regenerated when the signing key differs from the one it was made from
+    signing_key_digest = hashlib.sha256(signing_key).hexdigest()
+    stamp_path = get_signing_key_stamp_path(keyring_path)
+    try:
+        with open(stamp_path) as f:
+            keyring_is_current = f.read() == signing_key_digest and os.path.exists(keyring_path)
+    except IOError:
+        keyring_is_current = False
+    if not keyring_is_current:
+        with tempfile.TemporaryDirectory() as d:
+            keyring_tmp = os.path.join(d, keyring_basename)
+            gpg_cmd = [
+                'gpg',
+                '--no-options',
+                '--no-default-keyring',
+                '--no-auto-check-trustdb',
+                '--homedir', '/dev/null',
+                '--no-keyring',
+                '--import-options', 'import-export',
+                '--output', keyring_tmp,
+                '--import',
+            ]
+            subprocess_get_output(gpg_cmd, data=signing_key, check_rc=True)
+            with open(keyring_tmp, 'rb') as f:
+                write_file_as_root_if_changed(keyring_path, f.read())
+        write_file_atomically(stamp_path, signing_key_digest)
+    source = 'deb [signed-by={0} arch=amd64] {1}/apt/ {2} main\n'.format(keyring_path, irods_repository_urls[repository], get_distribution_codename())
+    write_file_as_root_if_changed(os.path.join('/etc/apt/sources.list.d', list_basename), source)
 
-    # Ensure directory exists for the following gpg command
-    Path('/etc/apt/keyrings').mkdir(parents=True, exist_ok=True)
-
-    gpg_cmd = [
-        'sudo',
-        'gpg',
-        '--no-options',
-        '--no-default-keyring',
-        '--no-auto-check-trustdb',
-        '--homedir', '/dev/null',
-        '--no-keyring',
-        '--import-options', 'import-export',
-        '--output', '/etc/apt/keyrings/renci-irods-core-dev-archive-keyring.pgp',
-        '--import',
-    ]
-    with urllib.request.urlopen('https://core-dev.irods.org/irods-core-dev-signing-key.asc') as gpg_keys:
-        subprocess_get_output(gpg_cmd, data=gpg_keys.read(), check_rc=True)
-    subprocess_get_output('echo "deb [signed-by=/etc/apt/keyrings/renci-irods-core-dev-archive-keyring.pgp arch=amd64] https://core-dev.irods.org/apt/ $(lsb_release -sc) main" | sudo tee /etc/apt/sources.list.d/renci-irods-core-dev.list', shell=True, check_rc=True)
+def install_irods_repository_rpm(repository, signing_key_filename, repo_filename, repos_directory):
+    signing_key, repo_file = fetch_irods_repository_files(repository, [signing_key_filename, repo_filename])
+    # A copy of the key kept with the system's rpm keys records what was last imported
+    signing_key_path = os.path.join('/etc/pki/rpm-gpg', signing_key_filename)
+    if write_file_as_root_if_changed(signing_key_path, signing_key):
+        subprocess_get_output(['sudo', 'rpm', '--import', signing_key_path], check_rc=True)
+    write_file_as_root_if_changed(os.path.join(repos_directory, repo_filename), repo_file)
+
+def install_irods_packages_repository_apt():
+    install_irods_repository_apt('packages', 'irods-signing-key.asc', 'renci-irods-archive-keyring.pgp', 'renci-irods.list')
+
+def install_irods_core_dev_repository_apt():
+    install_irods_repository_apt('core-dev', 'irods-core-dev-signing-key.asc', 'renci-irods-core-dev-archive-keyring.pgp', 'renci-irods-core-dev.list')
 
 def install_irods_packages_repository_yum():
-    subprocess_get_output(['sudo', 'rpm', '--import', 'https://packages.irods.org/irods-signing-key.asc'], check_rc=True)
-    subprocess_get_output('wget -qO - https://packages.irods.org/renci-irods.yum.repo | sudo tee /etc/yum.repos.d/renci-irods.yum.repo', shell=True, check_rc=True)
+    install_irods_repository_rpm('packages', 'irods-signing-key.asc', 'renci-irods.yum.repo', '/etc/yum.repos.d')
 
 def install_irods_core_dev_repository_yum():
-    subprocess_get_output(['sudo', 'rpm', '--import', 'https://core-dev.irods.org/irods-core-dev-signing-key.asc'], check_rc=True)
-    subprocess_get_output('wget -qO - https://core-dev.irods.org/renci-irods-core-dev.yum.repo | sudo tee /etc/yum.repos.d/renci-irods-core-dev.yum.repo', shell=True, check_rc=True)
+    install_irods_repository_rpm('core-dev', 'irods-core-dev-signing-key.asc', 'renci-irods-core-dev.yum.repo', '/etc/yum.repos.d')
 
 def install_irods_packages_repository_zypper():
-    subprocess_get_output(['sudo', 'rpm', '--import', 'https://packages.irods.org/irods-signing-key.asc'], check_rc=True)
-    subprocess_get_output('wget -qO - https://packages.irods.org/renci-irods.zypp.repo | sudo tee /etc/zypp/repos.d/renci-irods.zypp.repo', shell=True, check_rc=True)
+    install_irods_repository_rpm('packages', 'irods-signing-key.asc', 'renci-irods.zypp.repo', '/etc/zypp/repos.d')
 
 def install_irods_core_dev_repository_zypper():
-    subprocess_get_output(['sudo', 'rpm', '--import', 'https://core-dev.irods.org/irods-core-dev-signing-key.asc'], check_rc=True)
-    subprocess_get_output('wget -qO - https://core-dev.irods.org/renci-irods-core-dev.zypp.repo | sudo tee /etc/zypp/repos.d/renci-irods-core-dev.zypp.repo', shell=True, check_rc=True)
+    install_irods_repository_rpm('core-dev', 'irods-core-dev-signing-key.asc', 'renci-irods-core-dev.zypp.repo', '/etc/zypp/repos.d')
 
+@traced
 def install_irods_packages_repository():
-    dispatch_map = {
-        'Ubuntu': install_irods_packages_repository_apt,
-        'Debian gnu_linux': install_irods_packages_repository_apt,
-        'Almalinux': install_irods_packages_repository_yum,
-        'Rocky linux': install_irods_packages_repository_yum,
-        'Opensuse ': install_irods_packages_repository_zypper,
-        'Opensuse leap': install_irods_packages_repository_zypper,
-    }
-    try:
-        dispatch_map[get_distribution()]()
-    except KeyError:
-        raise_not_implemented_for_distribution()
+    get_package_manager_backend().install_irods_packages_repository()
 
+@traced
 def install_irods_core_dev_repository():
-    dispatch_map = {
-        'Ubuntu': install_irods_core_dev_repository_apt,
-        'Debian gnu_linux': install_irods_core_dev_repository_apt,
-        'Centos': install_irods_core_dev_repository_yum,
-        'Centos linux': install_irods_core_dev_repository_yum,
-        'Almalinux': install_irods_core_dev_repository_yum,
-        'Rocky linux': install_irods_core_dev_repository_yum,
-        'Opensuse ': install_irods_core_dev_repository_zypper,
-        'Opensuse leap': install_irods_core_dev_repository_zypper,
-    }
+    get_package_manager_backend().install_irods_core_dev_repository()
+
+@functools.lru_cache(maxsize=None)
+def get_package_manager_backend():
     try:
-        dispatch_map[get_distribution()]()
+        return package_manager_backends[distribution_package_managers[get_distribution()]]
     except KeyError:
         raise_not_implemented_for_distribution()
 
 def get_package_suffix():
-    d = get_distribution()
-    if d in ['Ubuntu', 'Debian gnu_linux']:
-        return 'deb'
-    if d in ['Centos', 'Centos linux', 'Opensuse ', 'Opensuse leap', 'Almalinux', 'Rocky linux']:
-        return 'rpm'
-    raise_not_implemented_for_distribution()
+    return get_package_manager_backend().package_suffix
 
-def get_irods_version():
-    # Returns irods version as tuple of int's
-    version = get_irods_version_from_json()
-    if version:
-        return version
-    version = get_irods_version_from_bash()
-    if version:
-        return version
-    raise RuntimeError('Unable to determine iRODS version')
+InstalledIrods = collections.namedtuple('InstalledIrods', [
+    'version',
+    'commit_id',
+    'catalog_schema_version',
+    'configuration_schema_version',
+    'home_directory',
+    'config_directory',
+    'version_file',
+])
 
-def get_irods_version_from_json():
-    try:
-        with open('/var/lib/irods/VERSION.json.dist') as f:
-            version_string = json.load(f)['irods_version']
-    except IOError as e1:
-        if e1.errno != 2:
-            raise
-        try:
-            with open('/var/lib/irods/VERSION.json') as f:
-                version_string = json.load(f)['irods_version']
-        except IOError as e2:
-            if e2.errno != 2:
-                raise
-            return None
+IRODS_HOME_DIRECTORY = '/var/lib/irods'
+IRODS_CONFIG_DIRECTORY = '/etc/irods'
+
+# Most preferred first; the bash VERSION file predates iRODS 4
+irods_version_json_basenames = ['VERSION.json.dist', 'VERSION.json']
+irods_version_bash_basename = 'VERSION'
+
+# home directory -> (InstalledIrods, stat signatures it was read under)
+installed_irods_cache = {}
+
+def parse_irods_version(version_string):
     return tuple(map(int, version_string.split('.')))
 
-def get_irods_version_from_bash():
+def read_irods_version_file(path):
+    # Returns (dict of the file's fields, stat signature) for a VERSION.json[.dist] or bash VERSION file,
+    # or (None, None) if it does not exist. The signature is taken before reading, so a later write changes it.
     try:
-        with open('/var/lib/irods/VERSION') as f:
-            for line in f:
-                key, _, value = line.rstrip('\n').partition('=')
-                if key == 'IRODSVERSION':
-                    return tuple(map(int, value.split('.')))
-            return None
+        with open(path) as f:
+            st = os.fstat(f.fileno())
+            if os.path.basename(path) == irods_version_bash_basename:
+                fields = {}
+                for line in f:
+                    key, _, value = line.rstrip('\n').partition('=')
+                    fields[key] = value
+            else:
+                fields = json.load(f)
     except IOError as e:
-        if e.errno != 2:
+        if e.errno != errno.ENOENT:
             raise
+        return None, None
+    return fields, (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+def installed_irods_from_fields(fields, home_directory, version_file):
+    version_string = fields.get('irods_version', fields.get('IRODSVERSION'))
+    if not version_string:
+        return None
+    catalog_schema_version = fields.get('catalog_schema_version', fields.get('CATALOG_SCHEMA_VERSION'))
+    configuration_schema_version = fields.get('configuration_schema_version')
+    return InstalledIrods(
+        version=parse_irods_version(version_string),
+        commit_id=fields.get('commit_id'),
+        catalog_schema_version=int(catalog_schema_version) if catalog_schema_version is not None else None,
+        configuration_schema_version=int(configuration_schema_version) if configuration_schema_version is not None else None,
+        home_directory=home_directory,
+        config_directory=IRODS_CONFIG_DIRECTORY,
+        version_file=version_file,
+    )
+
+def read_installed_irods(home_directory, basenames):
+    # Returns (InstalledIrods, stat signature) from the first of basenames naming an iRODS version file, or (None, None)
+    for basename in basenames:
+        path = os.path.join(home_directory, basename)
+        fields, signature = read_irods_version_file(path)
+        if fields is not None:
+            facts = installed_irods_from_fields(fields, home_directory, path)
+            if facts is not None:
+                return facts, signature
+    return None, None
+
+def stat_signature(path):
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+def get_installed_irods(home_directory=IRODS_HOME_DIRECTORY):
+    # Returns InstalledIrods for the installation under home_directory, or None if there is none.
+    # The version file is parsed once; later calls only stat it, re-reading it if its inode, mtime or size changed.
+    # Facts read from a fallback file also stat home_directory, so a preferred file appearing is noticed.
+    cached = installed_irods_cache.get(home_directory)
+    if cached is not None:
+        facts, signatures = cached
+        try:
+            if all(stat_signature(path) == signature for path, signature in signatures):
+                return facts
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    facts, signature = read_installed_irods(home_directory, irods_version_json_basenames + [irods_version_bash_basename])
+    if facts is None:
+        installed_irods_cache.pop(home_directory, None)
         return None
+    signatures = [(facts.version_file, signature)]
+    if os.path.basename(facts.version_file) != irods_version_json_basenames[0]:
+        signatures.append((home_directory, stat_signature(home_directory)))
+    installed_irods_cache[home_directory] = (facts, signatures)
+    return facts
+
+def get_irods_version():
+    # Returns irods version as tuple of int's
+    facts = get_installed_irods()
+    if facts is None:
+        raise RuntimeError('Unable to determine iRODS version')
+    return facts.version
+
+def get_irods_version_from_json():
+    facts, _ = read_installed_irods(IRODS_HOME_DIRECTORY, irods_version_json_basenames)
+    return facts.version if facts is not None else None
+
+def get_irods_version_from_bash():
+    facts, _ = read_installed_irods(IRODS_HOME_DIRECTORY, [irods_version_bash_basename])
+    return facts.version if facts is not None else None
 
 @contextlib.contextmanager
 def euid_and_egid_set(name):
+    import pwd
     initial_euid = os.geteuid()
     initial_egid = os.getegid()
     pw = pwd.getpwnam(name)
@@ -291,102 +1044,190 @@ def euid_and_egid_set(name):
         os.seteuid(initial_euid)
         os.setegid(initial_egid)
 
-def git_clone(repository, commitish=None, local_dir=None):
+@contextlib.contextmanager
+def file_lock(path):
+    mkdir_p(os.path.dirname(path))
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+@traced
+def update_git_mirror(repository):
+    # Returns path of a bare mirror of repository kept under the cache directory, creating or updating it
+    import hashlib
+    import re
+    mirror_root = get_cache_directory('git')
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', repository.rstrip('/').rsplit('/', 1)[-1])
+    mirror = os.path.join(mirror_root, '{0}-{1}'.format(hashlib.sha256(repository.encode('utf-8')).hexdigest()[:16], name))
+    with file_lock(mirror + '.lock'):
+        if os.path.isdir(mirror):
+            subprocess_get_output(['git', 'fetch', '--prune', '--tags', 'origin'], cwd=mirror, check_rc=True)
+        else:
+            subprocess_get_output(['git', 'clone', '--mirror', repository, mirror], check_rc=True)
+    return mirror
+
+@traced
+def git_clone(repository, commitish=None, local_dir=None, depth=None, filter_spec=None, use_mirror_cache=False, jobs=8):
     # Returns checkout directory
+    # depth and filter_spec (e.g. 'blob:none') make a shallow or partial clone. use_mirror_cache borrows
+    # objects from a persistent local mirror of repository via --reference/--dissociate.
+    # A branch or tag commitish is cloned directly; a commit id is fetched on its own where the server allows it,
+    # and anything else git checkout accepts is checked out of a full clone.
+    import re
+    import tempfile
     if local_dir is None:
         local_dir = tempfile.mkdtemp()
-    subprocess_get_output(['git', 'clone', '--recursive', repository, local_dir], check_rc=True)
-    if commitish is not None:
-        subprocess_get_output(['git', 'checkout', commitish], cwd=local_dir, check_rc=True)
-    subprocess_get_output(['git', 'submodule', 'update', '--init', '--recursive'], cwd=local_dir, check_rc=True)
+    history_options = []
+    if depth is not None:
+        history_options += ['--depth', str(depth)]
+    if filter_spec is not None:
+        history_options += ['--filter={0}'.format(filter_spec)]
+    reference = update_git_mirror(repository) if use_mirror_cache else None
+
+    if commitish is not None and re.match(r'^[0-9a-fA-F]{7,40}$', commitish):
+        git_fetch_commit(repository, commitish, local_dir, history_options, reference)
+    else:
+        reference_options = ['--reference', reference, '--dissociate'] if reference is not None else []
+        branch_options = ['--branch', commitish] if commitish is not None else []
+        rc, _, _ = subprocess_get_output(['git', 'clone'] + history_options + branch_options + reference_options + [repository, local_dir], check_rc=commitish is None)
+        if rc != 0:
+            # Not a branch or tag (e.g. origin/foo, HEAD~1 or a short commit id); resolve it in the full history
+            full_history_options = [x for x in history_options if x.startswith('--filter=')]
+            subprocess_get_output(['git', 'clone'] + full_history_options + reference_options + [repository, local_dir], check_rc=True)
+            subprocess_get_output(['git', 'checkout', '--quiet', commitish], cwd=local_dir, check_rc=True)
+
+    args = ['git', 'submodule', 'update', '--init', '--recursive']
+    if jobs:
+        args += ['--jobs', str(jobs)]
+    subprocess_get_output(args, cwd=local_dir, check_rc=True)
     return local_dir
 
+def git_fetch_commit(repository, commit, local_dir, history_options, reference):
+    mkdir_p(local_dir)
+    subprocess_get_output(['git', 'init', '--quiet'], cwd=local_dir, check_rc=True)
+    subprocess_get_output(['git', 'remote', 'add', 'origin', repository], cwd=local_dir, check_rc=True)
+    alternates = os.path.join(local_dir, '.git', 'objects', 'info', 'alternates')
+    if reference is not None:
+        with open(alternates, 'w') as f:
+            f.write(os.path.join(reference, 'objects') + '\n')
+    rc, _, _ = subprocess_get_output(['git', 'fetch'] + history_options + ['origin', commit], cwd=local_dir)
+    if rc == 0:
+        subprocess_get_output(['git', 'checkout', '--quiet', 'FETCH_HEAD'], cwd=local_dir, check_rc=True)
+    else:
+        # Abbreviated ids, and servers that refuse unadvertised commits, need the full history
+        full_history_options = [x for x in history_options if x.startswith('--filter=')]
+        subprocess_get_output(['git', 'fetch', '--tags'] + full_history_options + ['origin'], cwd=local_dir, check_rc=True)
+        subprocess_get_output(['git', 'checkout', '--quiet', commit], cwd=local_dir, check_rc=True)
+    if reference is not None:
+        # Equivalent of clone --dissociate
+        subprocess_get_output(['git', 'repack', '-a', '-d', '-q'], cwd=local_dir, check_rc=True)
+        os.remove(alternates)
+
+@traced
 def install_database(database_type):
-    dispatch_map = {
-        'Ubuntu': install_database_debian,
-        'Debian gnu_linux': install_database_debian,
-        'Centos': install_database_redhat,
-        'Centos linux': install_database_redhat,
-        'Almalinux': install_database_redhat,
-        'Rocky linux': install_database_redhat,
-        'Opensuse ': install_database_suse,
-    }
-    try:
-        dispatch_map[get_distribution()](database_type)
-    except KeyError:
-        raise_not_implemented_for_distribution()
+    get_package_manager_backend().install_database(database_type)
 
 def install_database_debian(database_type):
     if database_type == 'postgres':
-        install_os_packages(['postgresql'])
+        with PackageTransaction() as transaction:
+            transaction.add_packages(['postgresql'])
     elif database_type == 'mysql':
         subprocess_get_output(['sudo', 'debconf-set-selections'], data='mysql-server mysql-server/root_password password password', check_rc=True)
         subprocess_get_output(['sudo', 'debconf-set-selections'], data='mysql-server mysql-server/root_password_again password password', check_rc=True)
-        install_os_packages(['mysql-server'])
-        subprocess_get_output(['sudo', 'su', '-', 'root', '-c', "echo '[mysqld]' > /etc/mysql/conf.d/irods.cnf"], check_rc=True)
-        subprocess_get_output(['sudo', 'su', '-', 'root', '-c', "echo 'log_bin_trust_function_creators=1' >> /etc/mysql/conf.d/irods.cnf"], check_rc=True)
-        subprocess_get_output(['sudo', 'service', 'mysql', 'restart'], check_rc=True)
-        install_mysql_pcre()
+        with PackageTransaction() as transaction:
+            transaction.add_packages(['mysql-server'])
+        edit_config_files({'/etc/mysql/conf.d/irods.cnf': [config_ini_option('mysqld', 'log_bin_trust_function_creators', '1')]})
+        initialize_mysql_server('mysql', set_root_password=False)
     elif database_type == 'oracle':
-        with tempfile.NamedTemporaryFile() as f:
-            f.write('''
-export LD_LIBRARY_PATH=/usr/lib/oracle/11.2/client64/lib:$LD_LIBRARY_PATH
-export ORACLE_HOME=/usr/lib/oracle/11.2/client64
-export PATH=$ORACLE_HOME/bin:$PATH
-''')
-            f.flush()
-            subprocess_get_output(['sudo', 'su', '-c', "cat '{0}' >> /etc/profile.d/oracle.sh".format(f.name)], check_rc=True)
-        subprocess_get_output(['sudo', 'su', '-c', "echo 'ORACLE_HOME=/usr/lib/oracle/11.2/client64' >> /etc/environment"], check_rc=True)
-        subprocess_get_output(['sudo', 'mkdir', '-p', '/usr/lib/oracle/11.2/client64/network/admin'], check_rc=True)
-        tns_contents = '''
-ICAT =
-  (DESCRIPTION =
-    (ADDRESS = (PROTOCOL = TCP)(HOST = default-cloud-hostname-oracle.example.org)(PORT = 1521))
-    (CONNECT_DATA =
-      (SERVER = DEDICATED)
-      (SERVICE_NAME = ICAT.example.org)
-    )
-  )
-'''
-        subprocess_get_output(['sudo', 'su', '-c', "echo '{0}' > /usr/lib/oracle/11.2/client64/network/admin/tnsnames.ora".format(tns_contents)], check_rc=True)
+        configure_oracle_client()
     else:
         raise NotImplementedError('install_database_debian not implemented for database type [{0}]'.format(database_type))
 
 def install_database_redhat(database_type):
     if database_type == 'postgres':
-        install_os_packages(['postgresql-server'])
-        subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'initdb'], check_rc=True)
+        with PackageTransaction() as transaction:
+            transaction.add_packages(['postgresql-server'])
+        initialize_postgres_data_directory()
         subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'pg_ctl -D /var/lib/pgsql/data -l logfile start'], check_rc=True)
-        time.sleep(5)
+        wait_for_postgres()
     elif database_type == 'mysql':
         if get_distribution_version_major() == '6':
-            install_os_packages(['mysql-server'])
-            subprocess_get_output(['sudo', 'service', 'mysqld', 'start'], check_rc=True)
-            subprocess_get_output(['mysqladmin', '-u', 'root', 'password', 'password'], check_rc=True)
-            subprocess_get_output(['sudo', 'sed', '-i', r's/\[mysqld\]/\[mysqld\]\nlog_bin_trust_function_creators=1/', '/etc/my.cnf'], check_rc=True)
-            subprocess_get_output(['sudo', 'service', 'mysqld', 'restart'], check_rc=True)
-            install_mysql_pcre()
+            with PackageTransaction() as transaction:
+                transaction.add_packages(['mysql-server'])
+            edit_config_files({'/etc/my.cnf': [config_ini_option('mysqld', 'log_bin_trust_function_creators', '1')]})
+            initialize_mysql_server('mysqld', set_root_password=True)
         elif get_distribution_version_major() == '7':
-            install_os_packages(['mariadb-server'])
-            subprocess_get_output(['sudo', 'systemctl', 'start', 'mariadb'], check_rc=True)
-            subprocess_get_output(['mysqladmin', '-u', 'root', 'password', 'password'], check_rc=True)
-            subprocess_get_output(['sudo', 'sed', '-i', r's/\[mysqld\]/\[mysqld\]\nlog_bin_trust_function_creators=1/', '/etc/my.cnf'], check_rc=True)
-            subprocess_get_output(['sudo', 'systemctl', 'restart', 'mariadb'], check_rc=True)
-            install_mysql_pcre()
+            with PackageTransaction() as transaction:
+                transaction.add_packages(['mariadb-server'])
+            edit_config_files({'/etc/my.cnf': [config_ini_option('mysqld', 'log_bin_trust_function_creators', '1')]})
+            initialize_mysql_server('mariadb', set_root_password=True)
         else:
             raise_not_implemented_for_distribution_major_version()
     elif database_type == 'oracle':
-        with tempfile.NamedTemporaryFile() as f:
-            f.write('''
-export LD_LIBRARY_PATH=/usr/lib/oracle/11.2/client64/lib:$LD_LIBRARY_PATH
-export ORACLE_HOME=/usr/lib/oracle/11.2/client64
-export PATH=$ORACLE_HOME/bin:$PATH
-''')
-            f.flush()
-            subprocess_get_output(['sudo', 'su', '-c', "cat '{0}' >> /etc/profile.d/oracle.sh".format(f.name)], check_rc=True)
-        subprocess_get_output(['sudo', 'su', '-c', "echo 'ORACLE_HOME=/usr/lib/oracle/11.2/client64' >> /etc/environment"], check_rc=True)
-        subprocess_get_output(['sudo', 'mkdir', '-p', '/usr/lib/oracle/11.2/client64/network/admin'], check_rc=True)
-        tns_contents = '''
+        configure_oracle_client()
+    else:
+        raise NotImplementedError('install_database_redhat not implemented for database type [{0}]'.format(database_type))
+
+def install_database_suse(database_type):
+    if database_type == 'postgres':
+        with PackageTransaction() as transaction:
+            transaction.add_packages(['postgresql-server'])
+        initialize_postgres_data_directory([config_key_value('standard_conforming_strings', 'off', separator=' = ')])
+        subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'pg_ctl -D /var/lib/pgsql/data -l logfile start'], check_rc=True)
+        wait_for_postgres()
+    elif database_type == 'mysql':
+        with PackageTransaction() as transaction:
+            transaction.add_packages(['mysql-community-server'])
+        edit_config_files({'/etc/my.cnf.d/irods.cnf': [config_ini_option('mysqld', 'log_bin_trust_function_creators', '1')]})
+        initialize_mysql_server('mysql', set_root_password=True)
+    else:
+        raise NotImplementedError('install_database_suse not implemented for database type [{0}]'.format(database_type))
+
+postgres_data_directory = '/var/lib/pgsql/data'
+
+mysql_data_directory = '/var/lib/mysql'
+
+def initialize_postgres_data_directory(configuration_edits=None):
+    # initdb, then configuration_edits to postgresql.conf; restored from a snapshot instead when database
+    # snapshots are enabled and one matches
+    from . import database_snapshots
+    def initialize():
+        subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'initdb'], check_rc=True)
+        if configuration_edits:
+            edit_config_files({os.path.join(postgres_data_directory, 'postgresql.conf'): configuration_edits})
+    def get_server_version():
+        return subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'initdb --version'], check_rc=True, stream=False)[1].strip()
+    database_snapshots.initialize_database_from_snapshot('postgres', get_server_version, postgres_data_directory, initialize)
+
+def initialize_mysql_server(service, set_root_password):
+    # First-time setup of the installed and configured server, leaving it running: the root password, unless
+    # the packages set it, and the pcre UDF. Restored from a snapshot instead when database snapshots are
+    # enabled and one matches.
+    from . import database_snapshots
+    def initialize():
+        subprocess_get_output(['sudo', 'service', service, 'restart'], check_rc=True)
+        wait_for_mysql()
+        if set_root_password:
+            subprocess_get_output(['mysqladmin', '-u', 'root', 'password', 'password'], check_rc=True)
+        install_mysql_pcre()
+    def stop():
+        subprocess_get_output(['sudo', 'service', service, 'stop'], check_rc=True)
+    def start():
+        # The UDF's functions are in the data directory; its library is not
+        install_mysql_pcre(load_functions=False)
+        subprocess_get_output(['sudo', 'service', service, 'start'], check_rc=True)
+        wait_for_mysql()
+    def get_server_version():
+        return subprocess_get_output(['mysql', '--version'], check_rc=True, stream=False)[1].strip()
+    database_snapshots.initialize_database_from_snapshot('mysql', get_server_version, mysql_data_directory, initialize, stop, start)
+
+oracle_client_home = '/usr/lib/oracle/11.2/client64'
+
+def configure_oracle_client():
+    tns_contents = '''
 ICAT =
   (DESCRIPTION =
     (ADDRESS = (PROTOCOL = TCP)(HOST = default-cloud-hostname-oracle.example.org)(PORT = 1521))
@@ -396,60 +1237,84 @@ ICAT =
     )
   )
 '''
-        subprocess_get_output(['sudo', 'su', '-c', "echo '{0}' > /usr/lib/oracle/11.2/client64/network/admin/tnsnames.ora".format(tns_contents)], check_rc=True)
-    else:
-        raise NotImplementedError('install_database_redhat not implemented for database type [{0}]'.format(database_type))
-
-def install_database_suse(database_type):
-    if database_type == 'postgres':
-        install_os_packages(['postgresql-server'])
-        subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'initdb'], check_rc=True)
-        subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', "echo 'standard_conforming_strings = off' >> /var/lib/pgsql/data/postgresql.conf"], check_rc=True)
-        subprocess_get_output(['sudo', 'su', '-', 'postgres', '-c', 'pg_ctl -D /var/lib/pgsql/data -l logfile start'], check_rc=True)
-        time.sleep(5)
-    elif self.icat_database_type == 'mysql':
-        install_os_packages(['mysql-community-server'])
-        subprocess_get_output(['sudo', 'su', '-', 'root', '-c', "echo '[mysqld]' > /etc/my.cnf.d/irods.cnf"], check_rc=True)
-        subprocess_get_output(['sudo', 'su', '-', 'root', '-c', "echo 'log_bin_trust_function_creators=1' >> /etc/my.cnf.d/irods.cnf"], check_rc=True)
-        subprocess_get_output(['sudo', 'service', 'mysql', 'restart'], check_rc=True)
-        subprocess_get_output(['mysqladmin', '-u', 'root', 'password', 'password'], check_rc=True)
-        subprocess_get_output(['sudo', 'service', 'mysql', 'restart'], check_rc=True)
-        subprocess_get_output(['libmysqlclient-devel', 'autoconf', 'git'], 'mysql')
-    else:
-        raise NotImplementedError('install_database_suse not implemented for database type [{0}]'.format(database_type))
+    edit_config_files({
+        '/etc/profile.d/oracle.sh': [
+            config_line('export LD_LIBRARY_PATH={0}/lib:$LD_LIBRARY_PATH'.format(oracle_client_home)),
+            config_line('export ORACLE_HOME={0}'.format(oracle_client_home)),
+            config_line('export PATH=$ORACLE_HOME/bin:$PATH'),
+        ],
+        '/etc/environment': [config_key_value('ORACLE_HOME', oracle_client_home)],
+        os.path.join(oracle_client_home, 'network', 'admin', 'tnsnames.ora'): [config_content(tns_contents)],
+    })
 
 def get_mysql_pcre_build_dependencies():
-    distribution = get_distribution()
-    if distribution in ['Ubuntu', 'Debian gnu_linux']:
-        return ['libpcre3-dev', 'libmysqlclient-dev', 'build-essential', 'libtool', 'autoconf', 'git']
-    if distribution in ['Centos', 'Centos linux', 'Almalinux', 'Rocky linux']:
-        return ['pcre-devel', 'gcc', 'make', 'automake', 'mysql-devel', 'autoconf', 'git']
-    if distribution == 'Opensuse ':
-        return ['libmysqlclient-devel', 'autoconf', 'git']
-    raise_not_implemented_for_distribution()
+    return list(get_package_manager_backend().mysql_pcre_build_dependencies)
 
 def get_mysql_service_name():
-    distribution = get_distribution()
-    if distribution in ['Ubuntu', 'Debian gnu_linux']:
-        return 'mysql'
-    if distribution == 'Centos':
+    # CentOS 6 shipped MySQL proper; later yum/dnf distributions ship MariaDB
+    if get_distribution() == 'Centos':
         return 'mysqld'
-    if distribution in ['Centos linux', 'Almalinux', 'Rocky linux']:
-        return 'mariadb'
-    if distribution == 'Opensuse ':
-        return 'mysql'
-    raise_not_implemented_for_distribution()
+    return get_package_manager_backend().mysql_service_name
+
+mysql_pcre_repository = 'https://github.com/mysqludf/lib_mysqludf_preg.git'
+mysql_pcre_tag = 'lib_mysqludf_preg-1.1'
 
-def install_mysql_pcre():
+def get_mysql_pcre_cache_directory():
+    # Builds depend on the platform, the MySQL/MariaDB the UDF is built against and the source tag
+    import hashlib
+    import platform
+    _, mysql_version, _ = subprocess_get_output(['mysql', '--version'], check_rc=True, stream=False)
+    key = '\n'.join([get_distribution(), get_distribution_version_major(), platform.machine(), mysql_version.strip(), mysql_pcre_tag])
+    return get_cache_directory('mysql_pcre', hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+def build_mysql_pcre(cache_directory):
+    # Builds the UDF in a scratch checkout and stores its installed files, as install.tar, and installdb.sql in cache_directory
+    import shutil
+    import tarfile
+    import tempfile
     install_os_packages(get_mysql_pcre_build_dependencies())
-    local_pcre_git_dir = os.path.expanduser('~/lib_mysqludf_preg')
-    subprocess_get_output(['git', 'clone', 'https://github.com/mysqludf/lib_mysqludf_preg.git', local_pcre_git_dir], check_rc=True)
-    subprocess_get_output(['git', 'checkout', 'lib_mysqludf_preg-1.1'], cwd=local_pcre_git_dir, check_rc=True)
-    subprocess_get_output(['autoreconf', '--force', '--install'], cwd=local_pcre_git_dir, check_rc=True)
-    subprocess_get_output(['sudo', './configure'], cwd=local_pcre_git_dir, check_rc=True)
-    subprocess_get_output(['sudo', 'make', 'install'], cwd=local_pcre_git_dir, check_rc=True)
-    subprocess_get_output('mysql --user=root --password="password" < installdb.sql', shell=True, cwd=local_pcre_git_dir, check_rc=True)
+    build_root = tempfile.mkdtemp()
+    try:
+        source_directory = git_clone(mysql_pcre_repository, mysql_pcre_tag, os.path.join(build_root, 'lib_mysqludf_preg'), depth=1, use_mirror_cache=True)
+        staging_directory = os.path.join(build_root, 'staging')
+        subprocess_get_output(['autoreconf', '--force', '--install'], cwd=source_directory, check_rc=True)
+        subprocess_get_output(['./configure'], cwd=source_directory, check_rc=True)
+        subprocess_get_output(['make', '-j{0}'.format(os.cpu_count() or 1)], cwd=source_directory, check_rc=True)
+        subprocess_get_output(['make', 'install', 'DESTDIR={0}'.format(staging_directory)], cwd=source_directory, check_rc=True)
+
+        mkdir_p(cache_directory)
+        shutil.copyfile(os.path.join(source_directory, 'installdb.sql'), os.path.join(cache_directory, 'installdb.sql'))
+        # Directories are left out so extracting into / does not touch existing ones; files are owned by root
+        def owned_by_root(tarinfo):
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = 'root'
+            return tarinfo
+        archive = os.path.join(cache_directory, 'install.tar')
+        with tarfile.open(archive + '.tmp', 'w') as tar:
+            for fullpath, relative_path in scan_files(staging_directory, lambda x: True, recursive=True):
+                tar.add(fullpath, relative_path, recursive=False, filter=owned_by_root)
+        # Written last: its presence marks a complete cache entry
+        os.replace(archive + '.tmp', archive)
+    finally:
+        shutil.rmtree(build_root, ignore_errors=True)
+
+@traced
+def install_mysql_pcre(load_functions=True):
+    # The built UDF is cached per platform and MySQL version, so later runs only install it and load installdb.sql,
+    # without its build dependencies. Without load_functions only the library is installed, e.g. while the server is stopped.
+    cache_directory = get_mysql_pcre_cache_directory()
+    archive = os.path.join(cache_directory, 'install.tar')
+    with file_lock(cache_directory + '.lock'):
+        cache_hit = os.path.exists(archive)
+        if not cache_hit:
+            build_mysql_pcre(cache_directory)
+    set_span_attribute('cache_hit', cache_hit)
+    subprocess_get_output(['sudo', 'tar', '--extract', '--no-overwrite-dir', '--file', archive, '--directory', '/'], check_rc=True)
+    if not load_functions:
+        return
+    subprocess_get_output('mysql --user=root --password="password" < installdb.sql', shell=True, cwd=cache_directory, check_rc=True)
     subprocess_get_output(['sudo', 'service', get_mysql_service_name(), 'restart'], check_rc=True)
+    wait_for_mysql()
 
 def mkdir_p(path):
     try:
@@ -460,15 +1325,150 @@ def mkdir_p(path):
         else:
             raise
 
-def gather_files_satisfying_predicate(source_directory, output_directory, predicate):
+def write_file_atomically(path, content, mode=0o644):
+    # Replaces path with content, str or bytes, by a rename, so readers see the old or the new file, never part of one
+    import tempfile
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    mkdir_p(os.path.dirname(path))
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(temporary_path, mode)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+def load_json_manifest(path, format_version):
+    # Returns the JSON object at path, or None if it is missing, unreadable or was written with another format_version
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('format') != format_version:
+        return None
+    return manifest
+
+def write_json_manifest(path, manifest, format_version):
+    write_file_atomically(path, json.dumps(dict(manifest, format=format_version), indent=1, sort_keys=True))
+
+GatheredFile = collections.namedtuple('GatheredFile', ['source', 'destination', 'method', 'error'])
+
+# linux/fs.h FICLONE
+FICLONE = 0x40049409
+
+def scan_files(source_directory, predicate, recursive=False):
+    # Yields (fullpath, path relative to source_directory) for regular files satisfying predicate
+    with os.scandir(source_directory) as entries:
+        subdirectories = []
+        for entry in entries:
+            if entry.is_file():
+                if predicate(entry.path):
+                    yield entry.path, entry.name
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry)
+    for entry in subdirectories:
+        for fullpath, relative_path in scan_files(entry.path, predicate, recursive):
+            yield fullpath, os.path.join(entry.name, relative_path)
+
+def copy_file_range_in_kernel(copy_chunk, fsrc, fdst):
+    # Returns True if copy_chunk(in_fd, out_fd, offset, count) copied all of fsrc into fdst
+    size = os.fstat(fsrc.fileno()).st_size
+    offset = 0
+    try:
+        while offset < size:
+            n = copy_chunk(fsrc.fileno(), fdst.fileno(), offset, size - offset)
+            if n == 0:
+                break
+            offset += n
+    except OSError:
+        pass
+    if offset == size:
+        return True
+    fdst.seek(0)
+    fdst.truncate()
+    return False
+
+def copy_file_fast(source, destination, allow_hardlink=False):
+    # Returns name of the method that produced destination: 'hardlink', 'reflink', 'copy_file_range', 'sendfile' or 'copy'.
+    # Metadata is preserved as with shutil.copy2.
+    import shutil
+    if os.path.lexists(destination):
+        if os.path.realpath(source) == os.path.realpath(destination):
+            raise shutil.SameFileError('{0} and {1} are the same file'.format(source, destination))
+        if allow_hardlink and os.path.exists(destination) and os.path.samefile(source, destination):
+            return 'hardlink'
+        # Never written in place: destination may be a hardlink to source, e.g. from an earlier gather
+        os.unlink(destination)
+    if allow_hardlink:
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError:
+            pass
+    kernel_copies = [('sendfile', lambda in_fd, out_fd, offset, count: os.sendfile(out_fd, in_fd, offset, count))]
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.insert(0, ('copy_file_range', lambda in_fd, out_fd, offset, count: os.copy_file_range(in_fd, out_fd, count, offset, offset)))
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except OSError:
+            for method, copy_chunk in kernel_copies:
+                if copy_file_range_in_kernel(copy_chunk, fsrc, fdst):
+                    break
+            else:
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+                method = 'copy'
+    shutil.copystat(source, destination)
+    return method
+
+@traced
+def gather_files(source_directory, output_directory, predicate, recursive=False, jobs=None, allow_hardlink=False):
+    # Returns a GatheredFile for each file satisfying predicate, in scan order. With recursive=True the
+    # layout below source_directory is reproduced in output_directory. Copy errors are reported, not raised.
     mkdir_p(output_directory)
+    candidates = scan_files(source_directory, predicate, recursive)
+    return copy_files([(source, os.path.join(output_directory, relative_path)) for source, relative_path in candidates], jobs, allow_hardlink)
+
+def copy_files(copies, jobs=None, allow_hardlink=False):
+    # Copies each (source, destination) pair with copy_file_fast() on jobs threads, creating missing parent
+    # directories, and returns a GatheredFile for each. Copy errors are reported, not raised.
+    import concurrent.futures
+    if jobs is None:
+        jobs = min(32, (os.cpu_count() or 1) * 4)
+    for directory in set(os.path.dirname(destination) for _, destination in copies):
+        mkdir_p(directory)
+
+    def copy(pair):
+        source, destination = pair
+        try:
+            return GatheredFile(source, destination, copy_file_fast(source, destination, allow_hardlink), None)
+        except (IOError, OSError) as e:
+            return GatheredFile(source, destination, None, e)
+
+    if jobs <= 1 or len(copies) <= 1:
+        return [copy(x) for x in copies]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(copy, copies))
+
+def gather_files_satisfying_predicate(source_directory, output_directory, predicate, incremental=False):
+    # With incremental=True, files output_directory already holds unchanged are not copied again; see artifact_sync.sync_files()
+    if incremental:
+        from . import artifact_sync
+        result = artifact_sync.sync_files(source_directory, output_directory, predicate)
+        for gathered_file in result.copied:
+            if gathered_file.error is not None:
+                raise gathered_file.error
+        return sorted([x.source for x in result.copied] + [os.path.join(source_directory, x) for x in result.unchanged])
     gathered_files = []
-    for basename in os.listdir(source_directory):
-        fullpath = os.path.join(source_directory, basename)
-        if os.path.isfile(fullpath):
-            if predicate(fullpath):
-                shutil.copy2(fullpath, output_directory)
-                gathered_files.append(fullpath)
+    for gathered_file in gather_files(source_directory, output_directory, predicate):
+        if gathered_file.error is not None:
+            raise gathered_file.error
+        gathered_files.append(gathered_file.source)
     return gathered_files
 
 def append_os_specific_directory(root_directory):
@@ -476,44 +1476,68 @@ def append_os_specific_directory(root_directory):
 
 def make_symbolic_link_as_root(target, link_name):
     if not os.path.lexists(link_name):
-        subprocess_get_output(['sudo', 'ln', '-s', target, link_name], check_rc=True)
+        helper = get_privileged_helper()
+        if helper is not None:
+            helper.symlink(target, link_name)
+        else:
+            subprocess_get_output(['sudo', 'ln', '-s', target, link_name], check_rc=True)
     else:
         existing_target = os.readlink(link_name)
         if existing_target != target:
             raise RuntimeError('link {0} already exists with target {1} instead of {2}'.format(link_name, existing_target, target))
 
-def install_irods_dev_and_runtime_packages(irods_packages_root_directory):
+@traced
+def install_irods_dev_and_runtime_packages(irods_packages_root_directory, irods_package_version=None, use_local_repository=False):
+    # Installs the newest irods-runtime and irods-dev(el) packages in the platform directory, or those of
+    # irods_package_version, e.g. '4.3.1'. With use_local_repository, the directory is made a package
+    # source and the packages are installed from it by name and version, instead of as files.
+    from . import artifact_index
     irods_packages_directory = append_os_specific_directory(irods_packages_root_directory)
-    runtime_package_basename = [x for x in os.listdir(irods_packages_directory) if 'irods-runtime' in x][0]
-    runtime_package = os.path.join(irods_packages_directory, runtime_package_basename)
-    install_os_packages_from_files([runtime_package])
-    dev_package_basename = [x for x in os.listdir(irods_packages_directory) if 'irods-dev' in x][0]
-    dev_package = os.path.join(irods_packages_directory, dev_package_basename)
-    install_os_packages_from_files([dev_package])
-
-def install_released_irods_dev_and_runtime_packages(irods_package_version):
-    # Install the latest version.
-    if irods_package_version is None:
-        install_os_packages([
-            'irods-runtime',
-            'irods-dev' if get_distribution() in ['Ubuntu', 'Debian gnu_linux'] else 'irods-devel'
-        ])
-        return
+    # The headers give each package's dependencies, so that irods-runtime is ordered before irods-dev(el);
+    # they are only read for packages that are new since the last call
+    index = artifact_index.get_artifact_index(irods_packages_directory, read_headers=True)
+    dev_package_name = 'irods-dev' if index.find('irods-dev') is not None else 'irods-devel'
+    packages = index.select(['irods-runtime', dev_package_name], irods_package_version, artifact_index.native_architectures(get_package_suffix()))
+    with PackageTransaction() as transaction:
+        if use_local_repository:
+            from . import local_repository
+            local_repository.update_local_repository(irods_packages_directory)
+            local_repository.register_local_repository(irods_packages_directory)
+            delimiter = '=' if get_package_suffix() == 'deb' else '-'
+            transaction.add_packages(['{0}{1}{2}'.format(x.name, delimiter, x.version) for x in packages])
+        else:
+            transaction.add_files([x.path for x in packages])
 
-    # Install the specified version.
+def get_released_irods_dev_and_runtime_packages(irods_package_version):
+    # The latest version if irods_package_version is None
     dev_package_name = 'irods-devel'
     delimiter = '-'
     if get_distribution() in ['Ubuntu', 'Debian gnu_linux']:
         dev_package_name = 'irods-dev'
         delimiter = '='
 
+    if irods_package_version is None:
+        return ['irods-runtime', dev_package_name]
     version_suffix = f'{delimiter}{irods_package_version}'
-    install_os_packages([
+    return [
         f'irods-runtime{version_suffix}',
         f'{dev_package_name}{version_suffix}'
-    ])
+    ]
+
+@traced
+def install_released_irods_dev_and_runtime_packages(irods_package_version, prefetch=None):
+    # prefetch is the handle returned by prefetch_released_irods_dev_and_runtime_packages() for the same version
+    packages = get_released_irods_dev_and_runtime_packages(irods_package_version)
+    if prefetch is None:
+        install_os_packages(packages)
+        return
+    if sorted(prefetch.packages) != sorted(packages):
+        raise RuntimeError('prefetched packages {0} do not match the packages of version [{1}]: {2}'.format(
+            prefetch.packages, irods_package_version, packages))
+    prefetch.install()
 
 def register_logging_stream_handler(stream, minimum_log_level):
+    import logging
     logging.getLogger().setLevel(minimum_log_level)
     logging_handler = logging.StreamHandler(stream)
     logging_handler.setFormatter(logging.Formatter(
@@ -524,8 +1548,85 @@ def register_logging_stream_handler(stream, minimum_log_level):
     logging.getLogger().addHandler(logging_handler)
 
 def copy_file_if_exists(source_file, dest_file_or_directory):
+    import shutil
     try:
         shutil.copy2(source_file, dest_file_or_directory)
     except IOError as e:
         if e.errno != errno.ENOENT:
             raise
+
+PackageManagerBackend = collections.namedtuple('PackageManagerBackend', [
+    'name',
+    'package_suffix',
+    'install_os_packages',
+    'install_os_packages_from_files',
+    'install_os_packages_and_files',
+    'install_irods_packages_repository',
+    'install_irods_core_dev_repository',
+    'install_database',
+    'mysql_service_name',
+    'mysql_pcre_build_dependencies',
+])
+
+package_manager_backends = {
+    'apt': PackageManagerBackend(
+        name='apt',
+        package_suffix='deb',
+        install_os_packages=install_os_packages_apt,
+        install_os_packages_from_files=install_os_packages_from_files_apt,
+        install_os_packages_and_files=install_os_packages_and_files_apt,
+        install_irods_packages_repository=install_irods_packages_repository_apt,
+        install_irods_core_dev_repository=install_irods_core_dev_repository_apt,
+        install_database=install_database_debian,
+        mysql_service_name='mysql',
+        mysql_pcre_build_dependencies=('libpcre3-dev', 'libmysqlclient-dev', 'build-essential', 'libtool', 'autoconf', 'git'),
+    ),
+    'yum': PackageManagerBackend(
+        name='yum',
+        package_suffix='rpm',
+        install_os_packages=install_os_packages_yum,
+        install_os_packages_from_files=install_os_packages_from_files_yum,
+        install_os_packages_and_files=install_os_packages_and_files_yum,
+        install_irods_packages_repository=install_irods_packages_repository_yum,
+        install_irods_core_dev_repository=install_irods_core_dev_repository_yum,
+        install_database=install_database_redhat,
+        mysql_service_name='mariadb',
+        mysql_pcre_build_dependencies=('pcre-devel', 'gcc', 'make', 'automake', 'mysql-devel', 'autoconf', 'git'),
+    ),
+    'dnf': PackageManagerBackend(
+        name='dnf',
+        package_suffix='rpm',
+        install_os_packages=install_os_packages_dnf,
+        install_os_packages_from_files=install_os_packages_from_files_dnf,
+        install_os_packages_and_files=install_os_packages_and_files_dnf,
+        # dnf reads the same .repo files as yum
+        install_irods_packages_repository=install_irods_packages_repository_yum,
+        install_irods_core_dev_repository=install_irods_core_dev_repository_yum,
+        install_database=install_database_redhat,
+        mysql_service_name='mariadb',
+        mysql_pcre_build_dependencies=('pcre-devel', 'gcc', 'make', 'automake', 'mysql-devel', 'autoconf', 'git'),
+    ),
+    'zypper': PackageManagerBackend(
+        name='zypper',
+        package_suffix='rpm',
+        install_os_packages=install_os_packages_zypper,
+        install_os_packages_from_files=install_os_packages_from_files_zypper,
+        install_os_packages_and_files=install_os_packages_and_files_zypper,
+        install_irods_packages_repository=install_irods_packages_repository_zypper,
+        install_irods_core_dev_repository=install_irods_core_dev_repository_zypper,
+        install_database=install_database_suse,
+        mysql_service_name='mysql',
+        mysql_pcre_build_dependencies=('libmysqlclient-devel', 'autoconf', 'git'),
+    ),
+}
+
+distribution_package_managers = {
+    'Ubuntu': 'apt',
+    'Debian gnu_linux': 'apt',
+    'Centos': 'yum',
+    'Centos linux': 'yum',
+    'Almalinux': 'dnf',
+    'Rocky linux': 'dnf',
+    'Opensuse ': 'zypper',
+    'Opensuse leap': 'zypper',
+}
@@ -0,0 +1,359 @@
+import gzip
+import hashlib
+import os
+import stat
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+from . import artifact_index
+from . import irods_python_ci_utilities as utilities
+from .tracing import traced
+
+# Turns a directory of .deb or .rpm files, e.g. the one returned by append_os_specific_directory(), into a
+# local package repository, so its packages install by name through the package manager's usual dependency
+# resolution. Package metadata is read in Python; only packages added or changed since the last update are read.
+#
+#   update_local_repository(append_os_specific_directory(packages_root))
+#   register_local_repository(append_os_specific_directory(packages_root))
+#   install_os_packages(['irods-runtime', 'irods-dev'])
+
+__all__ = [
+    'update_local_repository',
+    'register_local_repository',
+]
+
+# Metadata of the packages already indexed, kept in the repository directory
+STATE_BASENAME = '.irods_python_ci_utilities_repository.json'
+
+# Bump when the state layout or the generated metadata changes
+STATE_FORMAT = 2
+
+def gzip_deterministically(content):
+    # No timestamp in the gzip header, so unchanged metadata compresses to unchanged bytes
+    return gzip.compress(content, mtime=0)
+
+def file_digests(path, algorithms):
+    digests = [hashlib.new(x) for x in algorithms]
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            for digest in digests:
+                digest.update(chunk)
+    return [x.hexdigest() for x in digests]
+
+def load_state(directory):
+    state = utilities.load_json_manifest(os.path.join(directory, STATE_BASENAME), STATE_FORMAT)
+    return state['packages'] if state is not None else {}
+
+def index_packages(directory, package_suffix, describe):
+    # Returns (dict of basename to describe(path)'s metadata, list of names of the packages described now,
+    # whether the set of packages differs from the saved state's). Metadata of packages whose size and mtime
+    # match the saved state is reused.
+    previous = load_state(directory)
+    packages = {}
+    described = []
+    for entry in sorted(os.scandir(directory), key=lambda x: x.name):
+        if not entry.name.endswith('.' + package_suffix) or not entry.is_file():
+            continue
+        st = entry.stat()
+        old = previous.get(entry.name)
+        if old and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            packages[entry.name] = old
+            continue
+        try:
+            metadata = describe(entry.path, st)
+        except (ValueError, KeyError, IndexError) as e:
+            raise RuntimeError('cannot index [{0}]: {1}'.format(entry.path, e))
+        metadata.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+        packages[entry.name] = metadata
+        described.append(entry.name)
+    return packages, described, bool(described) or set(packages) != set(previous)
+
+def save_state(directory, packages):
+    utilities.write_json_manifest(os.path.join(directory, STATE_BASENAME), {'packages': packages}, STATE_FORMAT)
+
+# APT
+
+# The order dpkg-scanpackages writes the fields of a Packages stanza in; other fields follow, sorted by name
+packages_field_order = [
+    'Package', 'Package-Type', 'Source', 'Version', 'Kernel-Version', 'Built-For-Profiles', 'Auto-Built-Package',
+    'Architecture', 'Subarchitecture', 'Installer-Menu-Item', 'Build-Essential', 'Essential', 'Protected', 'Origin',
+    'Bugs', 'Maintainer', 'Installed-Size', 'Pre-Depends', 'Depends', 'Recommends', 'Suggests', 'Enhances',
+    'Conflicts', 'Breaks', 'Replaces', 'Provides', 'Built-Using', 'Static-Built-Using', 'Filename', 'Size',
+    'MD5sum', 'SHA1', 'SHA256', 'Section', 'Priority', 'Multi-Arch', 'Homepage', 'Description', 'Tag', 'Task',
+]
+
+def describe_deb(path, st):
+    fields = artifact_index.read_deb_control(path)
+    fields['Filename'] = './' + os.path.basename(path)
+    fields['Size'] = str(st.st_size)
+    fields['MD5sum'], fields['SHA1'], fields['SHA256'] = file_digests(path, ['md5', 'sha1', 'sha256'])
+    positions = dict((x.lower(), i) for i, x in enumerate(packages_field_order))
+    keys = sorted(fields, key=lambda x: (positions.get(x.lower(), len(positions)), x))
+    return {'package': fields['Package'], 'version': fields['Version'], 'stanza': ''.join('{0}: {1}\n'.format(key, fields[key]) for key in keys)}
+
+def update_apt_repository(directory):
+    # Writes a flat repository: Packages, Packages.gz and Release next to the .deb files
+    packages, described, changed = index_packages(directory, 'deb', describe_deb)
+    # Sorted by package name, then by version string, as dpkg-scanpackages sorts them
+    stanzas = [x['stanza'] for x in sorted(packages.values(), key=lambda x: (x['package'], x['version']))]
+    index = ''.join(x + '\n' for x in stanzas).encode('utf-8')
+    files = [('Packages', index), ('Packages.gz', gzip_deterministically(index))]
+    release = ['Origin: irods_python_ci_utilities', 'Label: {0}'.format(os.path.basename(os.path.abspath(directory))),
+               'Date: {0}'.format(time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime()))]
+    for field, algorithm in [('MD5Sum', 'md5'), ('SHA256', 'sha256')]:
+        release.append(field + ':')
+        release.extend(' {0} {1} {2}'.format(hashlib.new(algorithm, content).hexdigest(), len(content), name) for name, content in files)
+    if changed or not os.path.exists(os.path.join(directory, 'Release')):
+        for name, content in files:
+            utilities.write_file_atomically(os.path.join(directory, name), content)
+        utilities.write_file_atomically(os.path.join(directory, 'Release'), '\n'.join(release) + '\n')
+        save_state(directory, packages)
+    return described
+
+# RPM
+
+RPMTAG_SUMMARY = 1004
+RPMTAG_DESCRIPTION = 1005
+RPMTAG_BUILDTIME = 1006
+RPMTAG_BUILDHOST = 1007
+RPMTAG_SIZE = 1009
+RPMTAG_VENDOR = 1011
+RPMTAG_LICENSE = 1014
+RPMTAG_PACKAGER = 1015
+RPMTAG_GROUP = 1016
+RPMTAG_URL = 1020
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILEFLAGS = 1037
+RPMTAG_SOURCERPM = 1044
+RPMTAG_ARCHIVESIZE = 1046
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIREFLAGS = 1048
+RPMTAG_REQUIRENAME = 1049
+RPMTAG_REQUIREVERSION = 1050
+RPMTAG_CONFLICTFLAGS = 1053
+RPMTAG_CONFLICTNAME = 1054
+RPMTAG_CONFLICTVERSION = 1055
+RPMTAG_OBSOLETENAME = 1090
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+RPMTAG_OBSOLETEFLAGS = 1114
+RPMTAG_OBSOLETEVERSION = 1115
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_LONGSIZE = 5009
+RPMTAG_LONGARCHIVESIZE = 271
+
+RPMFILE_GHOST = 1 << 6
+
+# Dependency flags; see rpmds.h
+RPMSENSE_LESS = 1 << 1
+RPMSENSE_GREATER = 1 << 2
+RPMSENSE_EQUAL = 1 << 3
+RPMSENSE_PREREQ_MASK = (1 << 6) | (1 << 9) | (1 << 10) | (1 << 11) | (1 << 12)
+
+comparison_names = {
+    RPMSENSE_LESS: 'LT',
+    RPMSENSE_GREATER: 'GT',
+    RPMSENSE_EQUAL: 'EQ',
+    RPMSENSE_LESS | RPMSENSE_EQUAL: 'LE',
+    RPMSENSE_GREATER | RPMSENSE_EQUAL: 'GE',
+}
+
+def first_string(tags, tag):
+    value = tags.get(tag, '')
+    return value[0] if isinstance(value, list) else value
+
+def first_integer(tags, tags_to_try):
+    for tag in tags_to_try:
+        if tags.get(tag):
+            return tags[tag][0]
+    return 0
+
+def split_evr(evr):
+    # Returns (epoch, version, release) of [epoch:]version[-release], with None for absent parts
+    epoch, _, rest = evr.rpartition(':')
+    version, _, release = rest.partition('-')
+    return epoch or None, version or None, release or None
+
+def dependency_entries(tags, name_tag, flags_tag, version_tag, mark_prerequisites=False):
+    entries = []
+    seen = set()
+    names = tags.get(name_tag, [])
+    flags = tags.get(flags_tag, [0] * len(names))
+    versions = tags.get(version_tag, [''] * len(names))
+    for name, flag, evr in zip(names, flags, versions):
+        if name.startswith('rpmlib('):
+            continue
+        key = (name, flag & 0xf, evr)
+        if key in seen:
+            continue
+        seen.add(key)
+        attributes = [('name', name)]
+        comparison = comparison_names.get(flag & (RPMSENSE_LESS | RPMSENSE_GREATER | RPMSENSE_EQUAL))
+        if comparison and evr:
+            epoch, version, release = split_evr(evr)
+            attributes.append(('flags', comparison))
+            attributes.append(('epoch', epoch or '0'))
+            attributes.append(('ver', version))
+            if release:
+                attributes.append(('rel', release))
+        if mark_prerequisites and flag & RPMSENSE_PREREQ_MASK:
+            attributes.append(('pre', '1'))
+        entries.append('<rpm:entry {0}/>'.format(' '.join('{0}={1}'.format(k, quoteattr(v)) for k, v in attributes)))
+    return entries
+
+def file_elements(tags, primary_only):
+    basenames = tags.get(RPMTAG_BASENAMES, [])
+    dirnames = tags.get(RPMTAG_DIRNAMES, [])
+    dirindexes = tags.get(RPMTAG_DIRINDEXES, [])
+    modes = tags.get(RPMTAG_FILEMODES, [0] * len(basenames))
+    flags = tags.get(RPMTAG_FILEFLAGS, [0] * len(basenames))
+    elements = []
+    for basename, dirindex, mode, flag in zip(basenames, dirindexes, modes, flags):
+        path = dirnames[dirindex] + basename
+        # createrepo's selection of files worth resolving dependencies on from primary metadata alone
+        if primary_only and not (path.startswith('/etc/') or 'bin/' in path or path == '/usr/lib/sendmail'):
+            continue
+        kind = ''
+        if flag & RPMFILE_GHOST:
+            kind = ' type="ghost"'
+        elif stat.S_ISDIR(mode):
+            kind = ' type="dir"'
+        elements.append('<file{0}>{1}</file>'.format(kind, escape(path)))
+    return elements
+
+def describe_rpm(path, st):
+    tags, (header_start, header_end) = artifact_index.read_rpm_header(path)
+    sha256, = file_digests(path, ['sha256'])
+    name = tags[artifact_index.RPMTAG_NAME]
+    arch = tags.get(artifact_index.RPMTAG_ARCH, 'noarch')
+    if tags.get(RPMTAG_SOURCERPM) is None:
+        arch = 'src'
+    epoch = str(tags[artifact_index.RPMTAG_EPOCH][0]) if tags.get(artifact_index.RPMTAG_EPOCH) else '0'
+    version_element = '<version epoch={0} ver={1} rel={2}/>'.format(
+        quoteattr(epoch), quoteattr(tags[artifact_index.RPMTAG_VERSION]), quoteattr(tags[artifact_index.RPMTAG_RELEASE]))
+    package_attributes = 'pkgid={0} name={1} arch={2}'.format(quoteattr(sha256), quoteattr(name), quoteattr(arch))
+
+    format_elements = []
+    for tag, element in [(RPMTAG_LICENSE, 'license'), (RPMTAG_VENDOR, 'vendor'), (RPMTAG_GROUP, 'group'),
+                         (RPMTAG_BUILDHOST, 'buildhost'), (RPMTAG_SOURCERPM, 'sourcerpm')]:
+        format_elements.append('<rpm:{0}>{1}</rpm:{0}>'.format(element, escape(first_string(tags, tag))))
+    format_elements.append('<rpm:header-range start="{0}" end="{1}"/>'.format(header_start, header_end))
+    for element, names, flags, versions, prerequisites in [
+            ('provides', RPMTAG_PROVIDENAME, RPMTAG_PROVIDEFLAGS, RPMTAG_PROVIDEVERSION, False),
+            ('requires', RPMTAG_REQUIRENAME, RPMTAG_REQUIREFLAGS, RPMTAG_REQUIREVERSION, True),
+            ('conflicts', RPMTAG_CONFLICTNAME, RPMTAG_CONFLICTFLAGS, RPMTAG_CONFLICTVERSION, False),
+            ('obsoletes', RPMTAG_OBSOLETENAME, RPMTAG_OBSOLETEFLAGS, RPMTAG_OBSOLETEVERSION, False)]:
+        entries = dependency_entries(tags, names, flags, versions, prerequisites)
+        if entries:
+            format_elements.append('<rpm:{0}>{1}</rpm:{0}>'.format(element, ''.join(entries)))
+    format_elements.extend(file_elements(tags, primary_only=True))
+
+    primary = ''.join([
+        '<package type="rpm">',
+        '<name>{0}</name>'.format(escape(name)),
+        '<arch>{0}</arch>'.format(escape(arch)),
+        version_element,
+        '<checksum type="sha256" pkgid="YES">{0}</checksum>'.format(sha256),
+        '<summary>{0}</summary>'.format(escape(first_string(tags, RPMTAG_SUMMARY))),
+        '<description>{0}</description>'.format(escape(first_string(tags, RPMTAG_DESCRIPTION))),
+        '<packager>{0}</packager>'.format(escape(first_string(tags, RPMTAG_PACKAGER))),
+        '<url>{0}</url>'.format(escape(first_string(tags, RPMTAG_URL))),
+        '<time file="{0}" build="{1}"/>'.format(int(st.st_mtime), first_integer(tags, [RPMTAG_BUILDTIME])),
+        '<size package="{0}" installed="{1}" archive="{2}"/>'.format(
+            st.st_size, first_integer(tags, [RPMTAG_LONGSIZE, RPMTAG_SIZE]), first_integer(tags, [RPMTAG_LONGARCHIVESIZE, RPMTAG_ARCHIVESIZE])),
+        '<location href={0}/>'.format(quoteattr(os.path.basename(path))),
+        '<format>{0}</format>'.format(''.join(format_elements)),
+        '</package>',
+    ])
+    filelists = '<package {0}>{1}{2}</package>'.format(package_attributes, version_element, ''.join(file_elements(tags, primary_only=False)))
+    other = '<package {0}>{1}</package>'.format(package_attributes, version_element)
+    return {'primary': primary, 'filelists': filelists, 'other': other}
+
+rpm_metadata_files = [
+    ('primary', 'metadata', 'http://linux.duke.edu/metadata/common', ' xmlns:rpm="http://linux.duke.edu/metadata/rpm"'),
+    ('filelists', 'filelists', 'http://linux.duke.edu/metadata/filelists', ''),
+    ('other', 'otherdata', 'http://linux.duke.edu/metadata/other', ''),
+]
+
+def update_rpm_repository(directory):
+    # Writes repodata/ with primary, filelists and other metadata for the .rpm files in directory
+    packages, described, changed = index_packages(directory, 'rpm', describe_rpm)
+    repodata = os.path.join(directory, 'repodata')
+    if changed or not os.path.exists(os.path.join(repodata, 'repomd.xml')):
+        revision = int(time.time())
+        data_elements = []
+        for kind, root, namespace, extra_namespaces in rpm_metadata_files:
+            document = '<?xml version="1.0" encoding="UTF-8"?>\n<{0} xmlns="{1}"{2} packages="{3}">\n{4}\n</{0}>\n'.format(
+                root, namespace, extra_namespaces, len(packages), '\n'.join(packages[x][kind] for x in sorted(packages))).encode('utf-8')
+            compressed = gzip_deterministically(document)
+            location = 'repodata/{0}.xml.gz'.format(kind)
+            utilities.write_file_atomically(os.path.join(directory, location), compressed)
+            data_elements.append(''.join([
+                '<data type="{0}">'.format(kind),
+                '<checksum type="sha256">{0}</checksum>'.format(hashlib.sha256(compressed).hexdigest()),
+                '<open-checksum type="sha256">{0}</open-checksum>'.format(hashlib.sha256(document).hexdigest()),
+                '<location href="{0}"/>'.format(location),
+                '<timestamp>{0}</timestamp>'.format(revision),
+                '<size>{0}</size>'.format(len(compressed)),
+                '<open-size>{0}</open-size>'.format(len(document)),
+                '</data>',
+            ]))
+        repomd = '<?xml version="1.0" encoding="UTF-8"?>\n<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n<revision>{0}</revision>\n{1}\n</repomd>\n'.format(
+            revision, '\n'.join(data_elements))
+        # Written last, so readers never see it refer to metadata not yet written
+        utilities.write_file_atomically(os.path.join(repodata, 'repomd.xml'), repomd)
+        save_state(directory, packages)
+    return described
+
+@traced
+def update_local_repository(directory, package_suffix=None):
+    # Creates or updates the repository metadata for the package files in directory, by default those of
+    # this platform's package format; returns the names of the package files read by this call
+    if package_suffix is None:
+        package_suffix = utilities.get_package_suffix()
+    if package_suffix == 'deb':
+        return update_apt_repository(directory)
+    if package_suffix == 'rpm':
+        return update_rpm_repository(directory)
+    raise NotImplementedError('local repositories not implemented for package suffix [{0}]'.format(package_suffix))
+
+def register_local_repository_apt(directory, name):
+    lists_were_fresh = utilities.apt_package_lists_are_fresh(utilities.package_metadata_defaults['max_age'])
+    list_file = '{0}.list'.format(name)
+    utilities.write_file_as_root_if_changed(os.path.join('/etc/apt/sources.list.d', list_file),
+                                            'deb [trusted=yes] file:{0} ./\n'.format(os.path.abspath(directory)))
+    # Stale lists are refreshed, with this source, by the next install; fresh ones stay fresh and only this
+    # source is refreshed now
+    if not lists_were_fresh:
+        return
+    utilities.subprocess_get_output(['sudo', 'apt-get', 'update',
+                                     '-o', 'Dir::Etc::sourcelist=sources.list.d/{0}'.format(list_file),
+                                     '-o', 'Dir::Etc::sourceparts=-',
+                                     '-o', 'APT::Get::List-Cleanup=0'], check_rc=True)
+    utilities.apt_metadata_refreshed_at['time'] = time.time()
+
+def register_local_repository_rpm(directory, name, repos_directory, extra_options):
+    options = [
+        '[{0}]'.format(name),
+        'name={0}'.format(name),
+        'baseurl=file://{0}'.format(os.path.abspath(directory)),
+        'enabled=1',
+        'gpgcheck=0',
+        'metadata_expire=0',
+    ] + extra_options
+    utilities.write_file_as_root_if_changed(os.path.join(repos_directory, '{0}.repo'.format(name)), '\n'.join(options) + '\n')
+
+@traced
+def register_local_repository(directory, name='irods-local'):
+    # Adds directory, as written by update_local_repository(), as an unsigned package source named name
+    backend = utilities.get_package_manager_backend().name
+    if backend == 'apt':
+        register_local_repository_apt(directory, name)
+    elif backend in ['yum', 'dnf']:
+        register_local_repository_rpm(directory, name, '/etc/yum.repos.d', [])
+    elif backend == 'zypper':
+        register_local_repository_rpm(directory, name, '/etc/zypp/repos.d', ['type=rpm-md', 'autorefresh=1'])
+    else:
+        utilities.raise_not_implemented_for_distribution()
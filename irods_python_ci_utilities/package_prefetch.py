@@ -0,0 +1,186 @@
+import collections
+import os
+import threading
+import time
+
+from . import irods_python_ci_utilities as utilities
+from .tracing import traced
+
+# Downloads packages and their missing dependencies in the background, so the download overlaps with
+# other steps, e.g. git_clone() or building, and the later install only installs from the local cache.
+#
+#   prefetch = prefetch_os_packages(['irods-runtime', 'irods-dev'])
+#   git_clone(...)
+#   print(prefetch.progress())
+#   prefetch.install()
+#
+# apt downloads into a private archives directory without taking the dpkg lock, so it also overlaps with
+# other package manager transactions of this process. yum, dnf and zypper download into their own caches
+# and hold the package database lock while doing so, so installs wait for the download to finish.
+# If the download fails, install() installs the packages as install_os_packages() would.
+
+__all__ = [
+    'PackagePrefetch',
+    'PrefetchProgress',
+    'prefetch_os_packages',
+    'prefetch_released_irods_dev_and_runtime_packages',
+]
+
+# total_bytes is None while unknown; yum, dnf and zypper do not report it before downloading
+PrefetchProgress = collections.namedtuple('PrefetchProgress', ['downloaded_bytes', 'total_bytes', 'elapsed', 'done'])
+
+# Where yum, dnf and zypper keep downloaded packages
+rpm_package_caches = {
+    'yum': '/var/cache/yum',
+    'dnf': '/var/cache/dnf',
+    'zypper': '/var/cache/zypp/packages',
+}
+
+class PackagePrefetch(object):
+    # Handle of a background download started by prefetch_os_packages()
+    def __init__(self, packages, metadata_max_age=None):
+        self.packages = list(packages)
+        self.metadata_max_age = metadata_max_age
+        self.backend = utilities.get_package_manager_backend()
+        # Package files to install, for backends that download outside their own cache
+        self.files = []
+        self.download_directory = None
+        self.total_bytes = None
+        self.initial_sizes = {}
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.thread = None
+        # Set by the first install(), which removes what the download fetched
+        self.installed = False
+
+    def start(self):
+        self.started_at = time.monotonic()
+        if self.backend.name in rpm_package_caches:
+            self.initial_sizes = get_package_file_sizes(rpm_package_caches[self.backend.name], '.rpm')
+        self.thread = threading.Thread(target=self.run, name='irods_python_ci_utilities_prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            package_downloaders[self.backend.name](self)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished_at = time.monotonic()
+        if self.error is None:
+            print('prefetched {0} ({1:.1f} MB) in {2:.1f} seconds'.format(
+                ' '.join(self.packages), self.progress().downloaded_bytes / 1e6, self.finished_at - self.started_at))
+
+    def wait(self, timeout=None):
+        # Returns True if the download has finished, successfully or not
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def progress(self):
+        finished_at = self.finished_at
+        done = finished_at is not None
+        elapsed = (finished_at if done else time.monotonic()) - self.started_at
+        if self.download_directory is not None:
+            downloaded = sum(get_package_file_sizes(self.download_directory, '.deb').values())
+        elif self.backend.name in rpm_package_caches:
+            sizes = get_package_file_sizes(rpm_package_caches[self.backend.name], '.rpm')
+            downloaded = sum(size for path, size in sizes.items() if size != self.initial_sizes.get(path))
+        else:
+            downloaded = 0
+        total = self.total_bytes
+        if total is None and done and self.error is None:
+            total = downloaded
+        return PrefetchProgress(downloaded, total, elapsed, done)
+
+    @traced
+    def install(self):
+        # Waits for the download, then installs the packages from what it fetched. Later calls install
+        # the packages as install_os_packages() would.
+        self.wait()
+        if self.installed:
+            return self.backend.install_os_packages(self.packages)
+        self.installed = True
+        try:
+            if self.error is not None:
+                print('prefetching {0} failed, installing without it: {1}'.format(' '.join(self.packages), self.error))
+                return self.backend.install_os_packages(self.packages)
+            return self.backend.install_os_packages_and_files(self.packages, self.files, self.metadata_max_age)
+        finally:
+            if self.download_directory is not None:
+                # apt hands the partial directory to its _apt user
+                utilities.subprocess_get_output(['sudo', 'rm', '-rf', self.download_directory])
+                self.download_directory = None
+            self.files = []
+
+def get_package_file_sizes(directory, suffix):
+    # Returns dict of path to size of the package files under directory; unreadable parts are skipped
+    sizes = {}
+    for root, _, files in os.walk(directory):
+        for basename in files:
+            if basename.endswith(suffix):
+                path = os.path.join(root, basename)
+                try:
+                    sizes[path] = os.path.getsize(path)
+                except OSError:
+                    pass
+    return sizes
+
+def parse_apt_print_uris(out):
+    # Returns [(file name, size)] from apt-get --print-uris output lines: 'uri' filename size hash
+    downloads = []
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and fields[0].startswith("'") and fields[2].isdigit():
+            downloads.append((fields[1], int(fields[2])))
+    return downloads
+
+def download_packages_apt(prefetch):
+    import tempfile
+    packages = utilities.filter_satisfied_packages_apt(prefetch.packages)
+    if not packages:
+        return
+    def refresh(packages, files, metadata_max_age):
+        utilities.refresh_package_metadata_apt(metadata_max_age)
+    utilities.run_waiting_for_system_package_lock(refresh, [], [], prefetch.metadata_max_age)
+    download_directory = tempfile.mkdtemp(prefix='irods_python_ci_utilities_prefetch_')
+    os.chmod(download_directory, 0o755)
+    os.mkdir(os.path.join(download_directory, 'partial'))
+    prefetch.download_directory = download_directory
+    # A private archives directory is out of reach of DPkg::Post-Invoke cleanups, e.g. Docker's docker-clean,
+    # run by other installs, and downloading needs no lock on the package database
+    options = ['-o', 'Dir::Cache::Archives={0}/'.format(download_directory), '-o', 'Debug::NoLocking=1']
+    _, out, _ = utilities.subprocess_get_output(['apt-get', 'install', '-qq', '--print-uris'] + options + packages,
+                                                check_rc=True, stream=False)
+    downloads = parse_apt_print_uris(out)
+    prefetch.total_bytes = sum(size for _, size in downloads)
+    utilities.subprocess_get_output(['sudo', 'apt-get', 'install', '-y', '--download-only'] + options + packages, check_rc=True)
+    prefetch.files = [os.path.join(download_directory, name) for name, _ in downloads]
+
+def download_packages_rpm(download_args):
+    def download(prefetch):
+        packages = utilities.filter_satisfied_packages_rpm(prefetch.packages)
+        if not packages:
+            return
+        def run(packages, files, metadata_max_age):
+            return utilities.subprocess_get_output(download_args + packages, check_rc=True)
+        utilities.run_waiting_for_system_package_lock(run, packages, [], prefetch.metadata_max_age)
+    return download
+
+package_downloaders = {
+    'apt': download_packages_apt,
+    # Needs yum-plugin-downloadonly before EL 7
+    'yum': download_packages_rpm(['sudo', 'yum', 'install', '-y', '--downloadonly']),
+    'dnf': download_packages_rpm(['sudo', 'dnf', 'install', '-y', '--downloadonly']),
+    'zypper': download_packages_rpm(['sudo', 'zypper', '--non-interactive', 'install', '--download-only']),
+}
+
+def prefetch_os_packages(packages, metadata_max_age=None):
+    # Starts downloading packages in the background and returns the PackagePrefetch handle
+    return PackagePrefetch(packages, metadata_max_age).start()
+
+def prefetch_released_irods_dev_and_runtime_packages(irods_package_version):
+    # Pass the handle to install_released_irods_dev_and_runtime_packages()
+    return prefetch_os_packages(utilities.get_released_irods_dev_and_runtime_packages(irods_package_version))
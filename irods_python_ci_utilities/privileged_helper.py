@@ -0,0 +1,396 @@
+import base64
+import collections
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# A long-lived root process, started once through sudo, that runs commands and file operations sent
+# to it as JSON lines on its stdin. While enabled, subprocess_get_output() routes 'sudo ...' commands
+# to it, so each pays for a fork instead of a sudo session. 'su [-] user -c cmd' runs as the user's
+# login shell without going through su and PAM.
+#
+# The helper runs one command at a time, without streaming its output, and a command it runs cannot be
+# cancelled. So subprocess_get_output() only routes a command to it when the helper is idle and the
+# command neither streams nor runs in a SubprocessScope; otherwise it spawns sudo as usual, and
+# independent commands of several threads still run concurrently.
+#
+# This file also runs as the helper itself (python privileged_helper.py), so it only imports the
+# standard library.
+
+__all__ = [
+    'PrivilegedHelper',
+    'enable_privileged_helper',
+    'disable_privileged_helper',
+    'get_privileged_helper',
+]
+
+class PrivilegedHelper(object):
+    def __init__(self, sudo_command=('sudo',)):
+        args = list(sudo_command) + [sys.executable, '-I', os.path.abspath(__file__)]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.lock = threading.Lock()
+        # The last lines the helper, or sudo, wrote to stderr, reported if it exits
+        self.stderr_tail = collections.deque(maxlen=50)
+        self.stderr_reader = threading.Thread(target=self.read_stderr, name='irods_python_ci_utilities_privileged_helper_stderr')
+        self.stderr_reader.daemon = True
+        self.stderr_reader.start()
+
+    def read_stderr(self):
+        for line in iter(self.process.stderr.readline, b''):
+            self.stderr_tail.append(line.decode('utf-8', 'replace').rstrip('\n'))
+        self.process.stderr.close()
+
+    def exit_error(self):
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            pass
+        self.stderr_reader.join(1)
+        return RuntimeError('privileged helper exited unexpectedly with status {0}\nstderr:\n{1}'.format(
+            self.process.returncode, '\n'.join(self.stderr_tail)))
+
+    def request(self, request, blocking=True):
+        # The helper handles one request at a time. With blocking=False, returns None instead of waiting
+        # for a request of another thread to finish.
+        if not self.lock.acquire(blocking):
+            return None
+        try:
+            if self.process.poll() is not None:
+                raise self.exit_error()
+            try:
+                self.process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                raise self.exit_error()
+            line = self.process.stdout.readline()
+            if not line:
+                raise self.exit_error()
+        finally:
+            self.lock.release()
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError('privileged helper failed to handle {0}: {1}'.format(request.get('op'), response['error']))
+        return response
+
+    def batch(self, requests):
+        # Handles requests, as built by the *_request() functions, in one round trip; returns their responses.
+        # A request that fails is reported in its response's 'error' instead of raising.
+        return self.request({'op': 'batch', 'requests': requests})['responses']
+
+    def run(self, args, cwd=None, env=None, data=None, with_usage=False, blocking=True):
+        # Returns (returncode, stdout bytes, stderr bytes), with with_usage followed by a dict of the
+        # command's resource usage, or None if it could not be started. Returns None if blocking=False
+        # and the helper is busy.
+        response = self.request(run_request(args, cwd, env, data), blocking)
+        if response is None:
+            return None
+        result = response['returncode'], base64.b64decode(response['stdout']), base64.b64decode(response['stderr'])
+        if with_usage:
+            return result + (response.get('usage'),)
+        return result
+
+    def write_file(self, path, content, mode=0o644):
+        # Returns True if the file was written; an existing file with the same content and mode is left untouched
+        return self.request(write_file_request(path, content, mode))['changed']
+
+    def symlink(self, target, link_name):
+        self.request({'op': 'symlink', 'target': target, 'link_name': link_name})
+
+    def makedirs(self, path, mode=0o755):
+        self.request({'op': 'makedirs', 'path': path, 'mode': mode})
+
+    def close(self):
+        with self.lock:
+            if self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.wait()
+
+def run_request(args, cwd=None, env=None, data=None):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return {
+        'op': 'run',
+        'args': list(args),
+        'cwd': cwd,
+        'env': env,
+        'data': base64.b64encode(data).decode('ascii') if data is not None else None,
+    }
+
+def write_file_request(path, content, mode=0o644):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return {'op': 'write_file', 'path': path, 'content': base64.b64encode(content).decode('ascii'), 'mode': mode}
+
+def edit_file_request(path, edits, mode=0o644):
+    # edits as built by config_files; mode applies to a file the edits create
+    return {'op': 'edit_file', 'path': path, 'edits': list(edits), 'mode': mode}
+
+helper_state = {
+    'helper': None,
+}
+
+def enable_privileged_helper(sudo_command=('sudo',)):
+    if helper_state['helper'] is None:
+        helper_state['helper'] = PrivilegedHelper(sudo_command)
+    return helper_state['helper']
+
+def disable_privileged_helper():
+    helper, helper_state['helper'] = helper_state['helper'], None
+    if helper is not None:
+        helper.close()
+
+def get_privileged_helper():
+    return helper_state['helper']
+
+# Helper side
+
+def translate_su(args):
+    # Returns (args, user, login) running 'su [-|-l|--login] [user] -c command' through the user's shell,
+    # or (args, None, False) for other forms
+    import pwd
+    rest = args[1:]
+    login = False
+    if rest and rest[0] in ['-', '-l', '--login']:
+        login = True
+        rest = rest[1:]
+    user = 'root'
+    if rest and not rest[0].startswith('-'):
+        user = rest[0]
+        rest = rest[1:]
+    if len(rest) != 2 or rest[0] != '-c':
+        return args, None, False
+    pw = pwd.getpwnam(user)
+    shell = pw.pw_shell or '/bin/sh'
+    return [shell] + (['-l'] if login else []) + ['-c', rest[1]], pw, login
+
+def handle_run(request):
+    args = request['args']
+    env = request.get('env')
+    cwd = request.get('cwd')
+    preexec_fn = None
+    if args and args[0] == 'su':
+        args, pw, login = translate_su(args)
+        if pw is not None:
+            env = {
+                'HOME': pw.pw_dir,
+                'USER': pw.pw_name,
+                'LOGNAME': pw.pw_name,
+                'SHELL': pw.pw_shell or '/bin/sh',
+                'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+            }
+            if login and os.path.isdir(pw.pw_dir):
+                cwd = pw.pw_dir
+            if os.getuid() != pw.pw_uid:
+                def preexec_fn(pw=pw):
+                    os.initgroups(pw.pw_name, pw.pw_gid)
+                    os.setgid(pw.pw_gid)
+                    os.setuid(pw.pw_uid)
+    data = base64.b64decode(request['data']) if request.get('data') is not None else None
+    usage = None
+    try:
+        returncode, out, err, usage = run_and_measure(args, cwd, env, data, preexec_fn)
+    except OSError as e:
+        # As sudo reports it
+        returncode, out, err = 1, b'', 'sudo: {0}: {1}\n'.format(args[0], e.strerror).encode('utf-8')
+    return {
+        'returncode': returncode,
+        'stdout': base64.b64encode(out).decode('ascii'),
+        'stderr': base64.b64encode(err).decode('ascii'),
+        'usage': usage,
+    }
+
+def run_and_measure(args, cwd, env, data, preexec_fn):
+    # subprocess.run(), but reaping the command with wait4() for its resource usage, which is returned
+    # for resource_accounting as a dict of CommandUsage fields
+    start_time = time.monotonic()
+    p = subprocess.Popen(args, cwd=cwd, env=env, stdin=subprocess.PIPE if data is not None else subprocess.DEVNULL,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=preexec_fn)
+    outputs = {}
+    def read(name, pipe):
+        outputs[name] = pipe.read()
+        pipe.close()
+    readers = [threading.Thread(target=read, args=('stdout', p.stdout)), threading.Thread(target=read, args=('stderr', p.stderr))]
+    for reader in readers:
+        reader.start()
+    if data is not None:
+        try:
+            p.stdin.write(data)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+    for reader in readers:
+        reader.join()
+    # The helper runs as root, so the exited command's /proc/<pid>/io is readable until it is reaped
+    os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+    io = {}
+    try:
+        with open('/proc/{0}/io'.format(p.pid)) as f:
+            io = dict(line.split(': ', 1) for line in f.read().splitlines())
+    except (IOError, OSError):
+        pass
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        'wall_time': time.monotonic() - start_time,
+        'user_cpu': rusage.ru_utime,
+        'system_cpu': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'read_bytes': int(io['read_bytes']) if 'read_bytes' in io else None,
+        'write_bytes': int(io['write_bytes']) if 'write_bytes' in io else None,
+    }
+    return p.returncode, outputs['stdout'], outputs['stderr'], usage
+
+def handle_write_file(request):
+    path = request['path']
+    content = base64.b64decode(request['content'])
+    mode = request['mode']
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content and (os.stat(path).st_mode & 0o7777) == mode:
+                return {'changed': False}
+    except IOError:
+        pass
+    write_file_atomically(path, content, mode)
+    return {'changed': True}
+
+def write_file_atomically(path, content, mode, owner=None):
+    # owner is (uid, gid), by default root's
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary_path = '{0}.tmp.{1}'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        f.write(content)
+    if owner is not None:
+        os.chown(temporary_path, owner[0], owner[1])
+    os.chmod(temporary_path, mode)
+    os.replace(temporary_path, path)
+
+def handle_edit_file(request):
+    # An existing file keeps its owner and mode
+    path = request['path']
+    try:
+        with open(path, 'rb') as f:
+            current = f.read().decode('utf-8')
+            st = os.fstat(f.fileno())
+    except FileNotFoundError:
+        current, st = '', None
+    content = apply_config_edits(current, request['edits'])
+    if st is not None and content == current:
+        return {'changed': False}
+    if st is None:
+        write_file_atomically(path, content.encode('utf-8'), request['mode'])
+    else:
+        write_file_atomically(path, content.encode('utf-8'), st.st_mode & 0o7777, (st.st_uid, st.st_gid))
+    return {'changed': True}
+
+# Config file edits are applied here, rather than in config_files, so that files only root can read are
+# edited in the same pass as they are written. Unchanged text is returned as is.
+
+def apply_config_edits(text, edits):
+    for edit in edits:
+        text = config_edit_appliers[edit['kind']](text, edit)
+    return text
+
+def join_config_lines(lines):
+    return ''.join(x + '\n' for x in lines)
+
+def append_config_line(text, line):
+    if text and not text.endswith('\n'):
+        text += '\n'
+    return text + line + '\n'
+
+def assignment_key(line, separator):
+    # Returns the key assigned by line, or None for blank, comment and section lines
+    stripped = line.strip()
+    separator = separator.strip() or separator
+    if not stripped or stripped[0] in '#;[' or separator not in stripped:
+        return None
+    return stripped.split(separator, 1)[0].strip()
+
+def set_config_assignments(text, lines, indices, line):
+    if all(lines[i] == line for i in indices):
+        return text
+    for i in indices:
+        lines[i] = line
+    return join_config_lines(lines)
+
+def apply_content_edit(text, edit):
+    return edit['content']
+
+def apply_line_edit(text, edit):
+    if edit['line'] in text.splitlines():
+        return text
+    return append_config_line(text, edit['line'])
+
+def apply_key_value_edit(text, edit):
+    line = '{0}{1}{2}'.format(edit['key'], edit['separator'], edit['value'])
+    lines = text.splitlines()
+    indices = [i for i, x in enumerate(lines) if assignment_key(x, edit['separator']) == edit['key']]
+    if not indices:
+        return append_config_line(text, line)
+    return set_config_assignments(text, lines, indices, line)
+
+def apply_ini_option_edit(text, edit):
+    line = '{0}={1}'.format(edit['option'], edit['value'])
+    header = '[{0}]'.format(edit['section'])
+    lines = text.splitlines()
+    starts = [i for i, x in enumerate(lines) if x.strip() == header]
+    if not starts:
+        if lines and lines[-1].strip():
+            lines.append('')
+        return join_config_lines(lines + [header, line])
+    start = starts[0]
+    end = next((i for i in range(start + 1, len(lines)) if lines[i].strip().startswith('[')), len(lines))
+    indices = [i for i in range(start + 1, end) if assignment_key(lines[i], '=') == edit['option']]
+    if indices:
+        return set_config_assignments(text, lines, indices, line)
+    position = start + 1
+    for i in range(start + 1, end):
+        if lines[i].strip():
+            position = i + 1
+    lines.insert(position, line)
+    return join_config_lines(lines)
+
+config_edit_appliers = {
+    'content': apply_content_edit,
+    'line': apply_line_edit,
+    'key_value': apply_key_value_edit,
+    'ini_option': apply_ini_option_edit,
+}
+
+def handle_symlink(request):
+    os.symlink(request['target'], request['link_name'])
+    return {}
+
+def handle_makedirs(request):
+    os.makedirs(request['path'], request['mode'], exist_ok=True)
+    return {}
+
+def handle_batch(request):
+    return {'responses': [handle_safely(x) for x in request['requests']]}
+
+handlers = {
+    'run': handle_run,
+    'write_file': handle_write_file,
+    'edit_file': handle_edit_file,
+    'symlink': handle_symlink,
+    'makedirs': handle_makedirs,
+    'batch': handle_batch,
+}
+
+def handle_safely(request):
+    try:
+        return handlers[request['op']](request)
+    except Exception as e:
+        return {'error': '{0}: {1}'.format(type(e).__name__, e)}
+
+def serve(stdin, stdout):
+    for line in iter(stdin.readline, b''):
+        response = handle_safely(json.loads(line.decode('utf-8')))
+        stdout.write(json.dumps(response).encode('utf-8') + b'\n')
+        stdout.flush()
+
+if __name__ == '__main__':
+    serve(sys.stdin.buffer, sys.stdout.buffer)
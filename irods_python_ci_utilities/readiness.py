@@ -0,0 +1,86 @@
+import subprocess
+import time
+
+__all__ = [
+    'wait_until_ready',
+    'unix_socket_probe',
+    'tcp_port_probe',
+    'command_probe',
+    'any_probe',
+    'wait_for_postgres',
+    'wait_for_mysql',
+]
+
+postgres_socket_paths = ['/var/run/postgresql/.s.PGSQL.5432', '/tmp/.s.PGSQL.5432']
+
+mysql_socket_paths = ['/var/run/mysqld/mysqld.sock', '/run/mysqld/mysqld.sock', '/var/lib/mysql/mysql.sock', '/var/run/mysql/mysql.sock']
+
+def wait_until_ready(probe, timeout=60, initial_delay=0.05, max_delay=0.5, description=None):
+    # Polls probe() with exponential backoff until it returns True; returns seconds waited.
+    # Raises RuntimeError if the deadline passes first.
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = initial_delay
+    while True:
+        if probe():
+            return time.monotonic() - start
+        now = time.monotonic()
+        if now >= deadline:
+            raise RuntimeError('{0} not ready after {1} seconds'.format(description or probe, timeout))
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, max_delay)
+
+def unix_socket_probe(path):
+    import socket
+    def probe():
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+        finally:
+            s.close()
+    return probe
+
+def tcp_port_probe(host, port, timeout=1.0):
+    import socket
+    def probe():
+        try:
+            socket.create_connection((host, port), timeout=timeout).close()
+            return True
+        except OSError:
+            return False
+    return probe
+
+def command_probe(args):
+    # Ready when args exits with status 0; output is discarded
+    def probe():
+        try:
+            return subprocess.call(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+        except OSError:
+            return False
+    return probe
+
+def any_probe(probes):
+    def probe():
+        return any(p() for p in probes)
+    return probe
+
+def wait_for_postgres(timeout=60, port=5432):
+    # Waits for the server to accept connections, then for pg_isready to agree if it is installed
+    import shutil
+    socket_probe = any_probe([unix_socket_probe(x) for x in postgres_socket_paths] + [tcp_port_probe('localhost', port)])
+    waited = wait_until_ready(socket_probe, timeout, description='PostgreSQL')
+    if shutil.which('pg_isready'):
+        waited += wait_until_ready(command_probe(['pg_isready', '--quiet', '--port', str(port)]), max(timeout - waited, 1), description='PostgreSQL (pg_isready)')
+    return waited
+
+def wait_for_mysql(timeout=60, port=3306):
+    # Waits for the server to accept connections, then for mysqladmin ping to agree if it is installed
+    import shutil
+    socket_probe = any_probe([unix_socket_probe(x) for x in mysql_socket_paths] + [tcp_port_probe('localhost', port)])
+    waited = wait_until_ready(socket_probe, timeout, description='MySQL')
+    if shutil.which('mysqladmin'):
+        waited += wait_until_ready(command_probe(['mysqladmin', '--silent', 'ping']), max(timeout - waited, 1), description='MySQL (mysqladmin ping)')
+    return waited
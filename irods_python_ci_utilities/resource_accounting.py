@@ -0,0 +1,211 @@
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# Optional accounting of the CPU time, peak memory and disk I/O of the commands subprocess_get_output()
+# runs, aggregated per traced function (install_database, git_clone, ...). A function's totals include
+# the commands of the traced functions it calls. Budgets warn, or fail the call, when one invocation of
+# a function goes over its CPU seconds or peak RSS.
+#
+#   enable_resource_accounting()
+#   set_resource_budget('install_mysql_pcre', cpu_seconds=120, max_rss_kb=512 * 1024)
+#   ...
+#   print(format_resource_usage())
+#
+# CPU time and peak RSS come from wait4() and cover each command's whole process tree. Disk I/O is
+# sampled from /proc/<pid>/io, which is not readable for commands running as another user, e.g. under
+# sudo, unless this process runs as root.
+
+__all__ = [
+    'CommandUsage',
+    'FunctionUsage',
+    'ResourceBudgetExceeded',
+    'enable_resource_accounting',
+    'disable_resource_accounting',
+    'get_command_usages',
+    'get_resource_usage',
+    'format_resource_usage',
+    'set_resource_budget',
+]
+
+# read_bytes and write_bytes are None where /proc/<pid>/io could not be read
+CommandUsage = collections.namedtuple('CommandUsage', ['argv', 'functions', 'wall_time', 'user_cpu', 'system_cpu', 'max_rss_kb', 'read_bytes', 'write_bytes'])
+
+FunctionUsage = collections.namedtuple('FunctionUsage', ['calls', 'commands', 'wall_time', 'user_cpu', 'system_cpu', 'max_rss_kb', 'read_bytes', 'write_bytes'])
+
+class ResourceBudgetExceeded(RuntimeError):
+    pass
+
+state = {
+    'enabled': False,
+    'sample_interval': 0.5,
+}
+lock = threading.Lock()
+command_usages = []
+function_totals = {}
+budgets = {}
+local = threading.local()
+
+def enable_resource_accounting(sample_interval=0.5):
+    # sample_interval is the period, in seconds, of /proc/<pid>/io sampling for running commands
+    with lock:
+        state['enabled'] = True
+        state['sample_interval'] = sample_interval
+
+def disable_resource_accounting():
+    with lock:
+        state['enabled'] = False
+
+def is_enabled():
+    return state['enabled']
+
+def set_resource_budget(function_name, cpu_seconds=None, max_rss_kb=None, fail=False):
+    # Budget for one invocation of the traced function function_name. Going over it prints a warning,
+    # or with fail=True raises ResourceBudgetExceeded when the function returns.
+    budgets[function_name] = {'cpu_seconds': cpu_seconds, 'max_rss_kb': max_rss_kb, 'fail': fail}
+
+def get_command_usages():
+    with lock:
+        return list(command_usages)
+
+def get_resource_usage():
+    # Returns dict of function name to FunctionUsage; commands run outside any traced function are under None
+    with lock:
+        return dict((name, FunctionUsage(**totals)) for name, totals in function_totals.items())
+
+def format_resource_usage():
+    lines = ['{0:<50} {1:>6} {2:>9} {3:>9} {4:>9} {5:>12} {6:>10} {7:>10}'.format(
+        'function', 'calls', 'commands', 'user (s)', 'sys (s)', 'peak RSS kB', 'read MB', 'write MB')]
+    usage = get_resource_usage()
+    for name in sorted(usage, key=lambda x: usage[x].user_cpu + usage[x].system_cpu, reverse=True):
+        u = usage[name]
+        lines.append('{0:<50} {1:>6} {2:>9} {3:>9.2f} {4:>9.2f} {5:>12} {6:>10} {7:>10}'.format(
+            name or '(no traced function)', u.calls, u.commands, u.user_cpu, u.system_cpu, u.max_rss_kb,
+            '{0:.1f}'.format(u.read_bytes / 1e6) if u.read_bytes is not None else '-',
+            '{0:.1f}'.format(u.write_bytes / 1e6) if u.write_bytes is not None else '-'))
+    return '\n'.join(lines)
+
+def new_totals():
+    return {'calls': 0, 'commands': 0, 'wall_time': 0.0, 'user_cpu': 0.0, 'system_cpu': 0.0, 'max_rss_kb': 0, 'read_bytes': None, 'write_bytes': None}
+
+def add_usage(totals, usage):
+    totals['commands'] += 1
+    totals['wall_time'] += usage.wall_time
+    totals['user_cpu'] += usage.user_cpu
+    totals['system_cpu'] += usage.system_cpu
+    totals['max_rss_kb'] = max(totals['max_rss_kb'], usage.max_rss_kb)
+    for key in ['read_bytes', 'write_bytes']:
+        if getattr(usage, key) is not None:
+            totals[key] = (totals[key] or 0) + getattr(usage, key)
+
+@contextlib.contextmanager
+def function_scope(name):
+    # Attributes the commands run by this thread inside the block to name, then checks name's budget
+    stack = local.__dict__.setdefault('stack', [])
+    frame = {'name': name, 'totals': new_totals()}
+    stack.append(frame)
+    with lock:
+        function_totals.setdefault(name, new_totals())['calls'] += 1
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        stack.pop()
+        check_budget(name, frame['totals'], raise_on_failure=not failed)
+
+def check_budget(name, totals, raise_on_failure):
+    budget = budgets.get(name)
+    if budget is None:
+        return
+    problems = []
+    cpu_seconds = totals['user_cpu'] + totals['system_cpu']
+    if budget['cpu_seconds'] is not None and cpu_seconds > budget['cpu_seconds']:
+        problems.append('{0:.1f} CPU seconds, over the budget of {1}'.format(cpu_seconds, budget['cpu_seconds']))
+    if budget['max_rss_kb'] is not None and totals['max_rss_kb'] > budget['max_rss_kb']:
+        problems.append('peak RSS of {0} kB, over the budget of {1} kB'.format(totals['max_rss_kb'], budget['max_rss_kb']))
+    if not problems:
+        return
+    message = '{0} used {1}'.format(name, ' and '.join(problems))
+    if budget['fail'] and raise_on_failure:
+        raise ResourceBudgetExceeded(message)
+    print('warning: ' + message, file=sys.stderr)
+
+def read_proc_io(pid):
+    # Returns (read_bytes, write_bytes) of pid, including its reaped children, or None if unreadable
+    try:
+        with open('/proc/{0}/io'.format(pid)) as f:
+            fields = dict(line.split(': ', 1) for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+class IoSampler(object):
+    # Samples /proc/<pid>/io of the running accounted commands on one background thread; the last
+    # sample before a command exits stands for its total
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.thread = None
+
+    def watch(self, pid):
+        with self.lock:
+            self.samples[pid] = read_proc_io(pid)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='irods_python_ci_utilities_io_sampler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unwatch(self, pid):
+        # Returns the last sample of pid, taking a final one first
+        with self.lock:
+            sample = read_proc_io(pid) or self.samples.get(pid)
+            self.samples.pop(pid, None)
+            return sample
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.samples:
+                    self.thread = None
+                    return
+                pids = list(self.samples)
+            for pid in pids:
+                sample = read_proc_io(pid)
+                with self.lock:
+                    if sample is not None and pid in self.samples:
+                        self.samples[pid] = sample
+            time.sleep(state['sample_interval'])
+
+io_sampler = IoSampler()
+
+def started(p):
+    # Called when the accounted command p, a subprocess.Popen, has started
+    io_sampler.watch(p.pid)
+    return time.monotonic()
+
+def reap(p, argv, start_time):
+    # Waits for p to exit and reaps it with wait4() for its resource usage, setting p.returncode as
+    # p.wait() would; returns the CommandUsage
+    # Waiting without reaping first lets the final I/O sample be read from the zombie
+    os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+    io = io_sampler.unwatch(p.pid)
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return record_command(argv, time.monotonic() - start_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                          io[0] if io else None, io[1] if io else None)
+
+def record_command(argv, wall_time, user_cpu, system_cpu, max_rss_kb, read_bytes=None, write_bytes=None):
+    # Adds the usage of a command run by this thread to the traced functions it ran in; returns the CommandUsage
+    stack = getattr(local, 'stack', [])
+    usage = CommandUsage(argv, [x['name'] for x in stack], wall_time, user_cpu, system_cpu, max_rss_kb, read_bytes, write_bytes)
+    for frame in stack:
+        add_usage(frame['totals'], usage)
+    with lock:
+        command_usages.append(usage)
+        for name in set(x['name'] for x in stack) or set([None]):
+            add_usage(function_totals.setdefault(name, new_totals()), usage)
+    return usage
@@ -0,0 +1,129 @@
+import collections
+import concurrent.futures
+import time
+import traceback
+
+__all__ = [
+    'StepGraph',
+    'StepGraphError',
+    'StepResult',
+]
+
+# error is the exception a failed step raised; skipped_because says why a skipped step did not run
+StepResult = collections.namedtuple('StepResult', ['name', 'status', 'result', 'error', 'skipped_because', 'start_time', 'end_time'])
+
+class StepGraphError(RuntimeError):
+    def __init__(self, message, results):
+        super(StepGraphError, self).__init__(message)
+        self.results = results
+
+class StepGraph(object):
+    # Runs provisioning steps in a thread pool, each as soon as the steps it depends on have succeeded.
+    # Package manager invocations already go through package_manager_broker, so steps that install
+    # packages can be declared without dependencies on each other. A failed step skips everything
+    # that depends on it, directly or not; unrelated steps still run.
+    #
+    #   graph = StepGraph()
+    #   graph.add_step('repository', install_irods_core_dev_repository)
+    #   graph.add_step('database', install_database, 'postgres')
+    #   graph.add_step('clone', git_clone, 'https://github.com/irods/irods_client_icommands')
+    #   graph.add_step('packages', install_irods_dev_and_runtime_packages, packages_root, depends_on=['repository'])
+    #   results = graph.run()
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.steps = collections.OrderedDict()
+
+    def add_step(self, name, function, *args, **kwargs):
+        depends_on = kwargs.pop('depends_on', [])
+        if name in self.steps:
+            raise ValueError('step [{0}] already added'.format(name))
+        self.steps[name] = (function, args, kwargs, list(depends_on))
+        return name
+
+    def check(self):
+        for name, (_, _, _, depends_on) in self.steps.items():
+            for dependency in depends_on:
+                if dependency not in self.steps:
+                    raise ValueError('step [{0}] depends on unknown step [{1}]'.format(name, dependency))
+        visiting = set()
+        visited = set()
+        def visit(name, path):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError('dependency cycle: {0}'.format(' -> '.join(path + [name])))
+            visiting.add(name)
+            for dependency in self.steps[name][3]:
+                visit(dependency, path + [name])
+            visiting.remove(name)
+            visited.add(name)
+        for name in self.steps:
+            visit(name, [])
+
+    def run(self, raise_on_failure=True):
+        # Returns OrderedDict of step name to StepResult, in the order the steps were added.
+        # Raises StepGraphError, carrying the same results, if any step failed and raise_on_failure is set.
+        self.check()
+        results = {}
+        pending = collections.OrderedDict((name, set(step[3])) for name, step in self.steps.items())
+        dependents = collections.defaultdict(list)
+        for name, step in self.steps.items():
+            for dependency in step[3]:
+                dependents[dependency].append(name)
+
+        def run_step(name):
+            function, args, kwargs, _ = self.steps[name]
+            start_time = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                return StepResult(name, 'failed', None, e, None, start_time, time.time())
+            return StepResult(name, 'succeeded', result, None, None, start_time, time.time())
+
+        def skip(name, reason):
+            if name in results:
+                return
+            pending.pop(name, None)
+            now = time.time()
+            results[name] = StepResult(name, 'skipped', None, None, reason, now, now)
+            for dependent in dependents[name]:
+                skip(dependent, reason)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                for name in [x for x, unmet in pending.items() if not unmet]:
+                    del pending[name]
+                    running[executor.submit(run_step, name)] = name
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result = future.result()
+                    results[name] = result
+                    if result.status == 'succeeded':
+                        for dependent in dependents[name]:
+                            if dependent in pending:
+                                pending[dependent].discard(name)
+                    else:
+                        for dependent in dependents[name]:
+                            skip(dependent, 'dependency [{0}] failed'.format(name))
+
+        ordered_results = collections.OrderedDict((name, results[name]) for name in self.steps)
+        failed = [x for x in ordered_results.values() if x.status == 'failed']
+        if failed and raise_on_failure:
+            raise StepGraphError(format_step_report(ordered_results), ordered_results)
+        return ordered_results
+
+def format_step_report(results):
+    lines = ['provisioning steps:']
+    for result in results.values():
+        line = '  {0:<9} {1} ({2:.1f}s)'.format(result.status, result.name, result.end_time - result.start_time)
+        if result.status == 'skipped':
+            line += ': ' + result.skipped_because
+        lines.append(line)
+    for result in results.values():
+        if result.status == 'failed':
+            lines.append('')
+            lines.append('step [{0}] failed:'.format(result.name))
+            lines.append(''.join(traceback.format_exception(type(result.error), result.error, result.error.__traceback__)).rstrip())
+    return '\n'.join(lines)
@@ -0,0 +1,136 @@
+import atexit
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from . import resource_accounting
+
+__all__ = [
+    'enable_tracing',
+    'disable_tracing',
+    'get_spans',
+    'format_slowest_spans',
+    'set_span_attribute',
+    'trace_span',
+    'traced',
+]
+
+# Setting this to a path enables tracing to that JSON-lines file when the package is imported
+TRACE_ENVIRONMENT_VARIABLE = 'IRODS_PYTHON_CI_UTILITIES_TRACE'
+
+state = {
+    'enabled': False,
+    'sink': None,
+    'summary_registered': False,
+}
+spans = []
+lock = threading.Lock()
+span_ids = itertools.count(1)
+# Innermost open span; per thread and per asyncio task
+current_span = contextvars.ContextVar('irods_python_ci_utilities_current_span', default=None)
+
+def enable_tracing(path=None, summary_at_exit=True, summary_stream=None, summary_count=10):
+    # Records a span for each traced call. Spans are appended to path as JSON lines if given, and the
+    # slowest summary_count of them are printed to summary_stream (default stderr) when the process exits.
+    disable_tracing()
+    with lock:
+        state['enabled'] = True
+        state['sink'] = open(path, 'a') if path else None
+        if summary_at_exit and not state['summary_registered']:
+            atexit.register(print_summary, summary_stream, summary_count)
+            state['summary_registered'] = True
+
+def disable_tracing():
+    with lock:
+        state['enabled'] = False
+        if state['sink'] is not None:
+            state['sink'].close()
+            state['sink'] = None
+
+def get_spans():
+    with lock:
+        return list(spans)
+
+def print_summary(stream=None, count=10):
+    if spans:
+        print(format_slowest_spans(count), file=stream or sys.stderr)
+
+def format_slowest_spans(count=10):
+    finished = sorted(get_spans(), key=lambda x: x['duration'], reverse=True)[:count]
+    by_id = dict((x['id'], x) for x in get_spans())
+    lines = ['slowest provisioning steps:']
+    for s in finished:
+        description = s['name']
+        if 'argv' in s['attributes']:
+            description += ' ' + ' '.join(str(x) for x in s['attributes']['argv']).replace('\n', '\\n')
+        parent = by_id.get(s['parent_id'])
+        if parent is not None:
+            description += ' (in {0})'.format(parent['name'])
+        lines.append('  {0:8.2f}s  {1}'.format(s['duration'], description))
+    return '\n'.join(lines)
+
+@contextlib.contextmanager
+def trace_span(name, **attributes):
+    # Yields the span's attribute dict, which the body may add to, e.g. a return code
+    if not state['enabled']:
+        yield attributes
+        return
+    parent = current_span.get()
+    record = {
+        'id': next(span_ids),
+        'parent_id': parent['id'] if parent is not None else None,
+        'name': name,
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+        'attributes': attributes,
+    }
+    token = current_span.set(record)
+    record['start'] = time.time()
+    start = time.monotonic()
+    try:
+        yield attributes
+    except BaseException as e:
+        record['error'] = '{0}: {1}'.format(type(e).__name__, e).splitlines()[0]
+        raise
+    finally:
+        record['duration'] = time.monotonic() - start
+        record['end'] = record['start'] + record['duration']
+        current_span.reset(token)
+        finish(record)
+
+def set_span_attribute(key, value):
+    # Sets an attribute of the innermost open span of the calling thread or task, if any
+    record = current_span.get()
+    if record is not None:
+        record['attributes'][key] = value
+
+def finish(record):
+    with lock:
+        spans.append(record)
+        if state['sink'] is not None:
+            state['sink'].write(json.dumps(record, default=str) + '\n')
+            state['sink'].flush()
+
+def traced(function):
+    # Also scopes resource accounting, when enabled, to the function; see resource_accounting
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        accounting = resource_accounting.is_enabled()
+        if not state['enabled'] and not accounting:
+            return function(*args, **kwargs)
+        with contextlib.ExitStack() as scopes:
+            if accounting:
+                scopes.enter_context(resource_accounting.function_scope(function.__qualname__))
+            if state['enabled']:
+                scopes.enter_context(trace_span(function.__qualname__, args=[repr(x) for x in args]))
+            return function(*args, **kwargs)
+    return wrapper
+
+if os.environ.get(TRACE_ENVIRONMENT_VARIABLE):
+    enable_tracing(os.environ[TRACE_ENVIRONMENT_VARIABLE])
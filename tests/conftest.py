@@ -0,0 +1,32 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from irods_python_ci_utilities import irods_python_ci_utilities as utilities
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path, monkeypatch):
+    # Every test gets its own, empty cache directory
+    path = tmp_path / 'cache'
+    monkeypatch.setenv(utilities.CACHE_DIRECTORY_ENVIRONMENT_VARIABLE, str(path))
+    return path
+
+
+def build_deb(directory, package, version, architecture='amd64', **fields):
+    # Builds a minimal .deb with dpkg-deb and returns its path; fields are extra control fields, e.g. Depends='a, b'
+    if shutil.which('dpkg-deb') is None:
+        pytest.skip('dpkg-deb is not installed')
+    source = os.path.join(str(directory), 'source-{0}-{1}'.format(package, version))
+    os.makedirs(os.path.join(source, 'DEBIAN'))
+    control = [('Package', package), ('Version', version), ('Architecture', architecture), ('Maintainer', 'iRODS Consortium <packages@irods.org>')]
+    control += [(key.replace('_', '-'), value) for key, value in fields.items()]
+    control.append(('Description', 'test package {0}'.format(package)))
+    with open(os.path.join(source, 'DEBIAN', 'control'), 'w') as f:
+        f.write(''.join('{0}: {1}\n'.format(key, value) for key, value in control))
+    path = os.path.join(str(directory), '{0}_{1}_{2}.deb'.format(package, version.replace(':', '%3a'), architecture))
+    subprocess.check_call(['dpkg-deb', '--build', source, path], stdout=subprocess.DEVNULL)
+    shutil.rmtree(source)
+    return path
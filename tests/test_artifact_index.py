@@ -0,0 +1,187 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from conftest import build_deb
+from irods_python_ci_utilities import artifact_index
+from irods_python_ci_utilities.artifact_index import ArtifactIndex, ArtifactPackage
+
+debian_version_pairs = [
+    ('1.0', '1.0'),
+    ('1.0', '1.1'),
+    ('1.0-1', '1.0-2'),
+    ('1.0', '1.0-0'),
+    ('1:1.0', '2.0'),
+    ('0:1.0', '1.0'),
+    ('1.0~rc1', '1.0'),
+    ('1.0~rc1', '1.0~~'),
+    ('1.0~', '1.0'),
+    ('1.0a', '1.0'),
+    ('1.0a', '1.0+'),
+    ('1.0+dfsg', '1.0.1'),
+    ('1.0.1', '1.0-1'),
+    ('4.3.1-0~jammy', '4.3.1-0~focal'),
+    ('4.3.10-0~jammy', '4.3.9-0~jammy'),
+    ('4.3.1-0~jammy', '4.3.1-1~jammy'),
+    ('1.01', '1.1'),
+    ('1.001', '1.0a'),
+    ('2.0-1ubuntu1', '2.0-1'),
+    ('2.0-1ubuntu1', '2.0-1+deb12u1'),
+    ('1.2.3-a.b', '1.2.3-a+b'),
+    ('a', 'A'),
+    ('1:0', '0:99'),
+    ('10', '9'),
+]
+
+rpm_version_cases = [
+    # From rpm's own rpmvercmp tests
+    ('1.0', '1.0', 0),
+    ('1.0', '2.0', -1),
+    ('2.0.1', '2.0', 1),
+    ('2.0.1a', '2.0.1', 1),
+    ('5.5p1', '5.5p2', -1),
+    ('5.5p10', '5.5p1', 1),
+    ('10xyz', '10.1xyz', -1),
+    ('xyz10', 'xyz10.1', -1),
+    ('xyz.4', '8', -1),
+    ('8', 'xyz.4', 1),
+    ('6.0.rc1', '6.0', 1),
+    ('10b2', '10a1', 1),
+    ('1.0aa', '1.0a', 1),
+    ('10.0001', '10.1', 0),
+    ('4.999.9', '5.0', -1),
+    ('2.0', '2_0', 0),
+    ('+a', '_a', 0),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('1.0~rc1~git123', '1.0~rc1', -1),
+    ('1.0^', '1.0', 1),
+    ('1.0^git1', '1.0^git2', -1),
+    ('1.0^git1', '1.01', -1),
+    ('1.0^20160101', '1.0.1', -1),
+    ('1.0^20160101^git1', '1.0^20160101', 1),
+    ('1.0~rc1^git1', '1.0~rc1', 1),
+    ('1.0^git1~pre', '1.0^git1', -1),
+    # Epochs and releases
+    ('1:1.0-1', '2.0-1', 1),
+    ('4.3.1-0.el8', '4.3.1-1.el8', -1),
+    ('4.3.10-0.el8', '4.3.9-0.el8', 1),
+]
+
+
+def dpkg_compare(a, b):
+    for relation, result in [('lt', -1), ('eq', 0), ('gt', 1)]:
+        if subprocess.call(['dpkg', '--compare-versions', a, relation, b]) == 0:
+            return result
+    raise AssertionError('dpkg cannot order {0} and {1}'.format(a, b))
+
+
+@pytest.mark.skipif(shutil.which('dpkg') is None, reason='dpkg is not installed')
+@pytest.mark.parametrize('a, b', debian_version_pairs)
+def test_debian_versions_compare_as_dpkg_does(a, b):
+    expected = dpkg_compare(a, b)
+    assert artifact_index.compare_debian_versions(a, b) == expected
+    assert artifact_index.compare_debian_versions(b, a) == -expected
+
+
+@pytest.mark.parametrize('a, b, expected', rpm_version_cases)
+def test_rpm_versions_compare_as_rpm_does(a, b, expected):
+    assert artifact_index.compare_rpm_versions(a, b) == expected
+    assert artifact_index.compare_rpm_versions(b, a) == -expected
+
+
+@pytest.mark.parametrize('basename, expected', [
+    ('irods-runtime_4.3.1-0~jammy_amd64.deb', ('irods-runtime', '4.3.1-0~jammy', 'amd64')),
+    ('irods-dev_1%3a4.3.1-0_amd64.deb', ('irods-dev', '1:4.3.1-0', 'amd64')),
+    ('irods-runtime-4.3.1-0.el8.x86_64.rpm', ('irods-runtime', '4.3.1-0.el8', 'x86_64')),
+    ('irods-runtime-4.3.1-0.el8.src.rpm', None),
+    ('irods-runtime.deb', None),
+    ('README', None),
+])
+def test_package_file_names_are_parsed(basename, expected):
+    assert artifact_index.parse_package_file_name(basename) == expected
+
+
+@pytest.mark.parametrize('version, requested, expected', [
+    ('4.3.1-0~jammy', '4.3.1', True),
+    ('4.3.1-0~jammy', '4.3.1-0~jammy', True),
+    ('1:4.3.1-0~jammy', '4.3.1', True),
+    ('1:4.3.1-0~jammy', '1:4.3.1-0~jammy', True),
+    ('4.3.10-0~jammy', '4.3.1', False),
+    ('4.3.1-0~jammy', '4.3', False),
+])
+def test_version_matches(version, requested, expected):
+    assert artifact_index.version_matches(version, requested) is expected
+
+
+def make_index(*packages):
+    return ArtifactIndex('/packages', [ArtifactPackage('/packages/{0}_{1}_{2}.deb'.format(name, version, arch), name, version, arch, depends, None)
+                                       for name, version, arch, depends in packages])
+
+
+def test_find_returns_the_newest_version():
+    index = make_index(('irods-runtime', '4.3.9-0', 'amd64', None), ('irods-runtime', '4.3.10-0', 'amd64', None), ('irods-runtime', '4.3.10~rc1-0', 'amd64', None))
+    assert index.find('irods-runtime').version == '4.3.10-0'
+
+
+def test_find_returns_the_newest_of_the_requested_version():
+    index = make_index(('irods-runtime', '4.3.1-0', 'amd64', None), ('irods-runtime', '4.3.1-2', 'amd64', None), ('irods-runtime', '4.3.10-0', 'amd64', None))
+    assert index.find('irods-runtime', '4.3.1').version == '4.3.1-2'
+    assert index.find('irods-runtime', '4.3.2') is None
+    assert index.find('irods-dev') is None
+
+
+def test_find_prefers_the_given_architectures():
+    index = make_index(('irods-runtime', '4.3.2-0', 'arm64', None), ('irods-runtime', '4.3.1-0', 'amd64', None))
+    assert index.find('irods-runtime', architectures=['amd64', 'all']).arch == 'amd64'
+    assert index.find('irods-runtime', architectures=['i386']).arch == 'arm64'
+
+
+def test_select_orders_packages_after_their_dependencies():
+    index = make_index(
+        ('irods-server', '4.3.1-0', 'amd64', ('irods-runtime', 'libc6')),
+        ('irods-dev', '4.3.1-0', 'amd64', ('irods-runtime',)),
+        ('irods-runtime', '4.3.1-0', 'amd64', ()),
+    )
+    selected = index.select(['irods-dev', 'irods-server', 'irods-runtime'])
+    assert [x.name for x in selected] == ['irods-runtime', 'irods-dev', 'irods-server']
+
+
+def test_select_keeps_the_order_of_a_dependency_cycle():
+    index = make_index(('a', '1', 'amd64', ('b',)), ('b', '1', 'amd64', ('a',)))
+    assert [x.name for x in index.select(['a', 'b'])] == ['b', 'a']
+
+
+def test_select_raises_for_a_missing_package():
+    index = make_index(('irods-runtime', '4.3.1-0', 'amd64', ()))
+    with pytest.raises(RuntimeError, match=r'no package \[irods-dev\] of version \[4.3.1\]'):
+        index.select(['irods-runtime', 'irods-dev'], '4.3.1')
+
+
+def test_index_is_built_from_file_names(tmp_path):
+    for basename in ['irods-runtime_4.3.1-0_amd64.deb', 'irods-runtime_4.3.2-0_amd64.deb', 'irods-dev_4.3.2-0_amd64.deb', 'notes.txt']:
+        (tmp_path / basename).write_bytes(b'')
+    index = artifact_index.get_artifact_index(str(tmp_path))
+    assert sorted((x.name, x.version) for x in index.packages) == [('irods-dev', '4.3.2-0'), ('irods-runtime', '4.3.1-0'), ('irods-runtime', '4.3.2-0')]
+    assert index.find('irods-runtime').path == os.path.join(str(tmp_path), 'irods-runtime_4.3.2-0_amd64.deb')
+
+
+def test_index_follows_changes_to_the_directory(tmp_path):
+    (tmp_path / 'irods-runtime_4.3.1-0_amd64.deb').write_bytes(b'')
+    assert artifact_index.get_artifact_index(str(tmp_path)).find('irods-runtime').version == '4.3.1-0'
+    (tmp_path / 'irods-runtime_4.3.2-0_amd64.deb').write_bytes(b'')
+    os.utime(str(tmp_path), ns=(0, os.stat(str(tmp_path)).st_mtime_ns + 1000000000))
+    assert artifact_index.get_artifact_index(str(tmp_path)).find('irods-runtime').version == '4.3.2-0'
+
+
+def test_index_reads_deb_headers(tmp_path):
+    # The file name is misleading on purpose; the headers win
+    path = build_deb(tmp_path, 'irods-dev', '1:4.3.1-0~jammy', Depends='irods-runtime (= 1:4.3.1-0~jammy), libc6 (>= 2.34) | libc6.1', Provides='irods-devel')
+    os.rename(path, os.path.join(str(tmp_path), 'renamed_0_amd64.deb'))
+    index = artifact_index.get_artifact_index(str(tmp_path), read_headers=True)
+    package, = index.packages
+    assert (package.name, package.version, package.arch) == ('irods-dev', '1:4.3.1-0~jammy', 'amd64')
+    assert package.depends == ('irods-runtime', 'libc6', 'libc6.1')
+    assert package.provides == ('irods-devel',)
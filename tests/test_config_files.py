@@ -0,0 +1,79 @@
+import os
+import stat
+
+import pytest
+
+from irods_python_ci_utilities import config_files
+from irods_python_ci_utilities.config_files import config_content, config_ini_option, config_key_value, config_line, edit_config_files
+from irods_python_ci_utilities.privileged_helper import apply_config_edits
+
+
+@pytest.mark.parametrize('text, edit, expected', [
+    ('old\n', config_content('new\n'), 'new\n'),
+    ('', config_line('export A=1'), 'export A=1\n'),
+    ('export B=2', config_line('export A=1'), 'export B=2\nexport A=1\n'),
+    ('export A=1\nexport B=2\n', config_line('export A=1'), 'export A=1\nexport B=2\n'),
+    ('', config_key_value('ORACLE_HOME', '/opt/oracle'), 'ORACLE_HOME=/opt/oracle\n'),
+    ('PATH=/bin\nORACLE_HOME=/old\n', config_key_value('ORACLE_HOME', '/opt/oracle'), 'PATH=/bin\nORACLE_HOME=/opt/oracle\n'),
+    ('ORACLE_HOME=/a\n# ORACLE_HOME=/commented\nORACLE_HOME = /b\n', config_key_value('ORACLE_HOME', '/opt/oracle'),
+     'ORACLE_HOME=/opt/oracle\n# ORACLE_HOME=/commented\nORACLE_HOME=/opt/oracle\n'),
+    ("#standard_conforming_strings = on\nmax_connections = 100\n", config_key_value('standard_conforming_strings', 'off', separator=' = '),
+     '#standard_conforming_strings = on\nmax_connections = 100\nstandard_conforming_strings = off\n'),
+    ('standard_conforming_strings = on\n', config_key_value('standard_conforming_strings', 'off', separator=' = '), 'standard_conforming_strings = off\n'),
+    ('', config_ini_option('mysqld', 'log_bin_trust_function_creators', 1), '[mysqld]\nlog_bin_trust_function_creators=1\n'),
+    ('[client]\nport=3306\n', config_ini_option('mysqld', 'a', 1), '[client]\nport=3306\n\n[mysqld]\na=1\n'),
+    ('[mysqld]\nport=3306\n\n[client]\nport=3306\n', config_ini_option('mysqld', 'a', 1), '[mysqld]\nport=3306\na=1\n\n[client]\nport=3306\n'),
+    ('[client]\na=0\n[mysqld]\na = 0\n', config_ini_option('mysqld', 'a', 1), '[client]\na=0\n[mysqld]\na=1\n'),
+])
+def test_edit_is_applied(text, edit, expected):
+    assert apply_config_edits(text, [edit]) == expected
+
+
+@pytest.mark.parametrize('text, edit', [
+    ('export A=1\n', config_line('export A=1')),
+    ('PATH=/bin\nORACLE_HOME=/opt/oracle', config_key_value('ORACLE_HOME', '/opt/oracle')),
+    ('[mysqld]\nlog_bin_trust_function_creators=1', config_ini_option('mysqld', 'log_bin_trust_function_creators', 1)),
+])
+def test_satisfied_edit_leaves_the_text_untouched(text, edit):
+    # Not even a missing final newline is added, so the file is not rewritten
+    assert apply_config_edits(text, [edit]) is text
+
+
+def test_edits_apply_in_order():
+    edits = [config_content('[mysqld]\n'), config_ini_option('mysqld', 'a', 1), config_line('!includedir /etc/mysql/conf.d/')]
+    assert apply_config_edits('anything', edits) == '[mysqld]\na=1\n!includedir /etc/mysql/conf.d/\n'
+
+
+@pytest.fixture
+def sudo_on_path(tmp_path, monkeypatch):
+    # A sudo that runs its command as the current user, so the one-shot helper can run without privileges
+    if os.geteuid() != 0:
+        pytest.skip('the helper hands created files to root')
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    sudo = bin_directory / 'sudo'
+    sudo.write_text('#!/bin/sh\nexec "$@"\n')
+    sudo.chmod(0o755)
+    monkeypatch.setenv('PATH', '{0}{1}{2}'.format(bin_directory, os.pathsep, os.environ['PATH']))
+    monkeypatch.setattr(config_files, 'get_privileged_helper', lambda: None)
+
+
+def test_edit_config_files_writes_only_changed_files(tmp_path, sudo_on_path):
+    existing = tmp_path / 'etc' / 'my.cnf'
+    existing.parent.mkdir()
+    existing.write_text('[mysqld]\nport=3306\n')
+    existing.chmod(0o600)
+    satisfied = tmp_path / 'etc' / 'environment'
+    satisfied.write_text('ORACLE_HOME=/opt/oracle\n')
+    created = tmp_path / 'etc' / 'profile.d' / 'oracle.sh'
+    written = edit_config_files({
+        str(existing): [config_ini_option('mysqld', 'log_bin_trust_function_creators', 1)],
+        str(satisfied): [config_key_value('ORACLE_HOME', '/opt/oracle')],
+        str(created): [config_line('export ORACLE_HOME=/opt/oracle')],
+    })
+    assert sorted(written) == sorted([str(existing), str(created)])
+    assert existing.read_text() == '[mysqld]\nport=3306\nlog_bin_trust_function_creators=1\n'
+    assert stat.S_IMODE(existing.stat().st_mode) == 0o600
+    assert created.read_text() == 'export ORACLE_HOME=/opt/oracle\n'
+    assert stat.S_IMODE(created.stat().st_mode) == 0o644
+    assert edit_config_files({str(existing): [config_ini_option('mysqld', 'log_bin_trust_function_creators', 1)]}) == []
@@ -0,0 +1,136 @@
+import http.server
+import threading
+
+import pytest
+
+from irods_python_ci_utilities import fetch_cache
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers), self.client_address))
+        if server.status >= 500:
+            self.send_response(server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        validators = [(self.headers.get('If-None-Match'), server.etag), (self.headers.get('If-Modified-Since'), server.last_modified)]
+        if server.revalidate and any(sent is not None and sent == current for sent, current in validators):
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = server.body + self.path.encode('utf-8')
+        self.send_response(200)
+        if server.etag:
+            self.send_header('ETag', server.etag)
+        if server.last_modified:
+            self.send_header('Last-Modified', server.last_modified)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    s = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    s.requests = []
+    s.status = 200
+    s.revalidate = True
+    s.body = b'content of '
+    s.etag = '"1"'
+    s.last_modified = 'Mon, 05 Oct 2026 10:00:00 GMT'
+    thread = threading.Thread(target=s.serve_forever, daemon=True)
+    thread.start()
+    return s
+
+
+@pytest.fixture
+def server():
+    s = start_server()
+    yield s
+    s.shutdown()
+    s.server_close()
+    fetch_cache.close_connections()
+
+
+@pytest.fixture
+def other_server():
+    s = start_server()
+    yield s
+    s.shutdown()
+    s.server_close()
+
+
+def url(server, path):
+    return 'http://127.0.0.1:{0}{1}'.format(server.server_address[1], path)
+
+
+def test_fresh_entry_is_served_without_a_request(server, tmp_path):
+    assert fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path)) == b'content of /a'
+    assert fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path)) == b'content of /a'
+    assert len(server.requests) == 1
+
+
+@pytest.mark.parametrize('etag, last_modified, header', [
+    ('"1"', None, 'If-None-Match'),
+    (None, 'Mon, 05 Oct 2026 10:00:00 GMT', 'If-Modified-Since'),
+])
+def test_stale_entry_is_revalidated(server, tmp_path, etag, last_modified, header):
+    server.etag = etag
+    server.last_modified = last_modified
+    fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path))
+    server.body = b'changed '
+    assert fetch_cache.fetch_url(url(server, '/a'), max_age=0, cache_directory=str(tmp_path)) == b'content of /a'
+    assert header in server.requests[1][1]
+    # The 304 refreshed the entry, so it is fresh again
+    assert fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path)) == b'content of /a'
+    assert len(server.requests) == 2
+
+
+def test_changed_content_replaces_the_entry(server, tmp_path):
+    fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path))
+    server.revalidate = False
+    server.body = b'changed '
+    assert fetch_cache.fetch_url(url(server, '/a'), max_age=0, cache_directory=str(tmp_path)) == b'changed /a'
+    assert fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path)) == b'changed /a'
+
+
+def test_server_error_falls_back_to_the_stale_entry(server, tmp_path):
+    fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path))
+    server.status = 503
+    assert fetch_cache.fetch_url(url(server, '/a'), max_age=0, cache_directory=str(tmp_path)) == b'content of /a'
+
+
+def test_server_error_without_an_entry_fails(server, tmp_path):
+    server.status = 503
+    with pytest.raises(RuntimeError):
+        fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path))
+
+
+def test_unreachable_server_falls_back_to_the_stale_entry(server, tmp_path):
+    fetch_cache.fetch_url(url(server, '/a'), cache_directory=str(tmp_path))
+    unreachable = url(server, '/a')
+    server.shutdown()
+    server.server_close()
+    fetch_cache.close_connections()
+    assert fetch_cache.fetch_url(unreachable, max_age=0, cache_directory=str(tmp_path), timeout=1) == b'content of /a'
+
+
+def test_urls_of_one_server_share_a_connection(server, tmp_path):
+    urls = [url(server, '/a'), url(server, '/b'), url(server, '/c')]
+    assert fetch_cache.fetch_urls(urls, cache_directory=str(tmp_path)) == [b'content of /a', b'content of /b', b'content of /c']
+    assert len(set(client_address for _, _, client_address in server.requests)) == 1
+
+
+def test_urls_of_several_servers_keep_their_order(server, other_server, tmp_path):
+    urls = [url(server, '/a'), url(other_server, '/b'), url(server, '/c'), url(other_server, '/d')]
+    assert fetch_cache.fetch_urls(urls, cache_directory=str(tmp_path)) == [b'content of /a', b'content of /b', b'content of /c', b'content of /d']
+    for s in [server, other_server]:
+        assert len(s.requests) == 2
+        assert len(set(client_address for _, _, client_address in s.requests)) == 1
@@ -0,0 +1,27 @@
+import importlib.util
+import os
+
+import pytest
+
+# The checks of benchmarks/import_time.py, run as tests
+spec = importlib.util.spec_from_file_location('import_time', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'import_time.py'))
+import_time = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(import_time)
+
+
+@pytest.fixture(scope='module')
+def measurements():
+    return [import_time.measure_import() for _ in range(5)]
+
+
+def test_import_is_within_budget(measurements):
+    assert min(x[0] for x in measurements) / 1000.0 <= import_time.default_budget_ms
+
+
+@pytest.mark.parametrize('module', import_time.lazily_loaded_modules)
+def test_module_is_not_imported_eagerly(measurements, module):
+    assert module not in measurements[0][1]
+
+
+def test_lazy_names_match_submodule_exports():
+    assert import_time.check_lazy_names() == []
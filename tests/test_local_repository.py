@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from conftest import build_deb
+from irods_python_ci_utilities import local_repository
+
+
+def scan_packages(directory):
+    if shutil.which('dpkg-scanpackages') is None:
+        pytest.skip('dpkg-scanpackages is not installed')
+    return subprocess.check_output(['dpkg-scanpackages', '-m', '.'], cwd=str(directory), stderr=subprocess.DEVNULL)
+
+
+def read(directory, name):
+    with open(os.path.join(str(directory), name), 'rb') as f:
+        return f.read()
+
+
+def parse_release(content):
+    # Returns {field: [(digest, size, name)]} for the checksum fields of a Release file
+    checksums = {}
+    field = None
+    for line in content.decode('utf-8').splitlines():
+        if line.startswith(' ') and field is not None:
+            digest, size, name = line.split()
+            checksums[field].append((digest, int(size), name))
+        elif line.endswith(':'):
+            field = line[:-1]
+            checksums[field] = []
+        else:
+            field = None
+    return checksums
+
+
+@pytest.fixture
+def repository(tmp_path):
+    directory = tmp_path / 'repository'
+    directory.mkdir()
+    build_deb(directory, 'irods-runtime', '4.3.1-0~jammy', Depends='libc6 (>= 2.34), libssl3', Section='libs', Priority='optional', Installed_Size='1024')
+    build_deb(directory, 'irods-runtime', '4.3.10-0~jammy', Depends='libc6 (>= 2.34), libssl3', Section='libs', Priority='optional')
+    build_deb(directory, 'irods-dev', '4.3.1-0~jammy', Depends='irods-runtime (= 4.3.1-0~jammy)', Provides='irods-devel', Homepage='https://irods.org', X_Custom='kept')
+    # Sorts before irods-dev by file name, after it by package name
+    build_deb(directory, 'irods-dev-tools', '4.3.1-0~jammy', architecture='all')
+    return directory
+
+
+def test_packages_match_dpkg_scanpackages(repository):
+    described = local_repository.update_apt_repository(str(repository))
+    assert len(described) == 4
+    assert read(repository, 'Packages') == scan_packages(repository)
+    assert gzip.decompress(read(repository, 'Packages.gz')) == read(repository, 'Packages')
+
+
+def test_release_lists_the_index_files(repository):
+    local_repository.update_apt_repository(str(repository))
+    checksums = parse_release(read(repository, 'Release'))
+    for field, algorithm in [('MD5Sum', 'md5'), ('SHA256', 'sha256')]:
+        assert sorted(x[2] for x in checksums[field]) == ['Packages', 'Packages.gz']
+        for digest, size, name in checksums[field]:
+            content = read(repository, name)
+            assert (digest, size) == (hashlib.new(algorithm, content).hexdigest(), len(content))
+
+
+def test_unchanged_repository_is_not_rewritten(repository):
+    local_repository.update_apt_repository(str(repository))
+    before = dict((x, os.stat(os.path.join(str(repository), x)).st_mtime_ns) for x in ['Packages', 'Packages.gz', 'Release'])
+    assert local_repository.update_apt_repository(str(repository)) == []
+    assert before == dict((x, os.stat(os.path.join(str(repository), x)).st_mtime_ns) for x in before)
+
+
+def test_only_added_packages_are_read(repository):
+    local_repository.update_apt_repository(str(repository))
+    build_deb(repository, 'irods-server', '4.3.1-0~jammy', Depends='irods-runtime')
+    assert local_repository.update_apt_repository(str(repository)) == ['irods-server_4.3.1-0~jammy_amd64.deb']
+    assert read(repository, 'Packages') == scan_packages(repository)
+
+
+def test_removed_packages_leave_the_index(repository):
+    local_repository.update_apt_repository(str(repository))
+    os.remove(os.path.join(str(repository), 'irods-dev_4.3.1-0~jammy_amd64.deb'))
+    assert local_repository.update_apt_repository(str(repository)) == []
+    assert read(repository, 'Packages') == scan_packages(repository)
+    assert b'Package: irods-dev\n' not in read(repository, 'Packages')
+
+
+def test_unreadable_package_is_reported(repository):
+    (repository / 'broken_1.0_amd64.deb').write_bytes(b'!<arch>\nnot a package')
+    with pytest.raises(RuntimeError, match='cannot index'):
+        local_repository.update_apt_repository(str(repository))
@@ -0,0 +1,188 @@
+import threading
+import time
+
+import pytest
+
+from irods_python_ci_utilities import irods_python_ci_utilities as utilities
+
+
+class Recorder(object):
+    # A package manager stand-in; each call blocks until release() while block is set
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.block = False
+        # Transactions including any of these packages fail
+        self.failing = set()
+
+    def __call__(self, packages, files, metadata_max_age=None):
+        self.calls.append((list(packages), list(files)))
+        self.started.set()
+        if self.block:
+            while not self.released.wait(0.01):
+                if utilities.subprocess_scope_cancelled():
+                    raise RuntimeError('cancelled')
+        if self.failing.intersection(packages):
+            raise RuntimeError('cannot install {0}'.format(' '.join(sorted(self.failing.intersection(packages)))))
+        return 0, ' '.join(packages + files), ''
+
+    def release(self):
+        self.block = False
+        self.released.set()
+
+
+def start(function, *args):
+    outcome = {}
+    def run():
+        try:
+            outcome['result'] = function(*args)
+        except Exception as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def wait_for_pending(broker, count):
+    deadline = time.monotonic() + 5
+    while len(broker.pending) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def broker():
+    return utilities.PackageManagerBroker()
+
+
+def queue_behind_a_running_transaction(broker, recorder, requests):
+    # Starts a transaction that blocks, queues requests, each (function, packages, files), behind it and
+    # lets it finish; returns the (thread, outcome) of each request
+    recorder.block = True
+    leader, _ = start(broker.install, recorder, ['first'], [])
+    recorder.started.wait(5)
+    waiters = [start(broker.install, function, packages, files) for function, packages, files in requests]
+    wait_for_pending(broker, len(requests))
+    recorder.release()
+    leader.join(5)
+    for thread, _ in waiters:
+        thread.join(5)
+        assert not thread.is_alive()
+    return waiters
+
+
+def test_queued_requests_are_merged(broker):
+    recorder = Recorder()
+    waiters = queue_behind_a_running_transaction(broker, recorder, [(recorder, ['a', 'b'], []), (recorder, ['b', 'c'], [])])
+    assert recorder.calls == [(['first'], []), (['a', 'b', 'c'], [])]
+    for _, outcome in waiters:
+        assert outcome['result'] == (0, 'a b c', '')
+
+
+def test_package_files_are_merged_only_with_package_files(broker):
+    recorder = Recorder()
+    waiters = queue_behind_a_running_transaction(broker, recorder, [
+        (recorder, ['a'], []),
+        (recorder, [], ['/p/x.deb']),
+        (recorder, ['b'], []),
+        (recorder, ['c'], ['/p/y.deb']),
+    ])
+    assert sorted(recorder.calls[1:]) == [(['a', 'b'], []), (['c'], ['/p/x.deb', '/p/y.deb'])]
+    assert [x['result'][1] for _, x in waiters] == ['a b', 'c /p/x.deb /p/y.deb', 'a b', 'c /p/x.deb /p/y.deb']
+
+
+def test_requests_of_different_functions_are_not_merged(broker):
+    recorder = Recorder()
+    other = Recorder()
+    queue_behind_a_running_transaction(broker, recorder, [(recorder, ['a'], []), (other, ['b'], [])])
+    assert recorder.calls == [(['first'], []), (['a'], [])]
+    assert other.calls == [(['b'], [])]
+
+
+def test_failed_merged_transaction_is_retried_per_request(broker):
+    recorder = Recorder()
+    recorder.failing = {'broken'}
+    waiters = queue_behind_a_running_transaction(broker, recorder, [(recorder, ['a'], []), (recorder, ['broken'], []), (recorder, ['b'], [])])
+    assert recorder.calls[1:] == [(['a', 'broken', 'b'], []), (['a'], []), (['broken'], []), (['b'], [])]
+    (_, a), (_, broken), (_, b) = waiters
+    assert a['result'] == (0, 'a', '')
+    assert b['result'] == (0, 'b', '')
+    assert str(broken['error']) == 'cannot install broken'
+
+
+def test_failed_single_request_is_not_retried(broker):
+    recorder = Recorder()
+    recorder.failing = {'broken'}
+    with pytest.raises(RuntimeError, match='cannot install broken'):
+        broker.install(recorder, ['broken'], [])
+    assert recorder.calls == [(['broken'], [])]
+
+
+def test_nested_requests_run_directly(broker):
+    recorder = Recorder()
+    def outer(packages, files, metadata_max_age=None):
+        return broker.install(recorder, ['inner'], [])
+    assert broker.install(outer, ['outer'], []) == (0, 'inner', '')
+    assert recorder.calls == [(['inner'], [])]
+
+
+def test_package_lock_is_waited_for(monkeypatch):
+    monkeypatch.setitem(utilities.system_package_lock_defaults, 'initial_delay', 0.01)
+    attempts = []
+    def locked_twice(packages, files, metadata_max_age=None):
+        attempts.append(packages)
+        if len(attempts) < 3:
+            raise RuntimeError('E: Could not get lock /var/lib/dpkg/lock-frontend')
+        return 0, '', ''
+    assert utilities.run_waiting_for_system_package_lock(locked_twice, ['a'], [], None) == (0, '', '')
+    assert len(attempts) == 3
+
+
+def test_cancelled_waiter_stops_waiting(broker):
+    recorder = Recorder()
+    recorder.block = True
+    leader, _ = start(broker.install, recorder, ['a'], [])
+    recorder.started.wait(5)
+    scope = utilities.SubprocessScope()
+    waiter, outcome = start(scope.run, broker.install, recorder, ['b'], [])
+    wait_for_pending(broker, 1)
+    scope.cancel()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert 'cancelled' in str(outcome['error'])
+    recorder.release()
+    leader.join(5)
+    assert broker.pending == []
+    assert recorder.calls == [(['a'], [])]
+
+
+def test_cancelled_leader_queues_the_other_requests_again(broker):
+    recorder = Recorder()
+    recorder.block = True
+    own = utilities.PackageManagerRequest(recorder, ['a'], [], None)
+    other = utilities.PackageManagerRequest(recorder, ['b'], [], None)
+    scope = utilities.SubprocessScope()
+    thread, _ = start(scope.run, broker.run_batch, [own, other], own)
+    recorder.started.wait(5)
+    scope.cancel()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert own.done and 'cancelled' in str(own.error)
+    assert not other.done and other.error is None
+    assert broker.pending == [other]
+
+
+def test_cancellation_interrupts_the_package_lock_backoff(monkeypatch):
+    monkeypatch.setitem(utilities.system_package_lock_defaults, 'initial_delay', 60)
+    def locked(packages, files, metadata_max_age=None):
+        raise RuntimeError('E: Could not get lock /var/lib/dpkg/lock-frontend')
+    scope = utilities.SubprocessScope()
+    thread, outcome = start(scope.run, utilities.run_waiting_for_system_package_lock, locked, ['a'], [], None)
+    time.sleep(0.1)
+    start_time = time.monotonic()
+    scope.cancel()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert time.monotonic() - start_time < 5
+    assert 'cancelled' in str(outcome['error'])
@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from irods_python_ci_utilities.step_graph import StepGraph, StepGraphError
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def test_steps_run_after_their_dependencies():
+    order = []
+    lock = threading.Lock()
+    def record(name):
+        with lock:
+            order.append(name)
+        return name
+    graph = StepGraph(max_workers=4)
+    graph.add_step('packages', record, 'packages', depends_on=['repository'])
+    graph.add_step('repository', record, 'repository')
+    graph.add_step('tests', record, 'tests', depends_on=['packages', 'database'])
+    graph.add_step('database', record, 'database')
+    results = graph.run()
+    assert list(results) == ['packages', 'repository', 'tests', 'database']
+    assert all(x.status == 'succeeded' and x.result == x.name for x in results.values())
+    assert order.index('repository') < order.index('packages') < order.index('tests')
+    assert order.index('database') < order.index('tests')
+
+
+def test_independent_steps_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    graph = StepGraph(max_workers=2)
+    graph.add_step('a', barrier.wait)
+    graph.add_step('b', barrier.wait)
+    assert all(x.status == 'succeeded' for x in graph.run().values())
+
+
+def test_failure_skips_dependents_only():
+    graph = StepGraph()
+    graph.add_step('repository', fail, 'no network')
+    graph.add_step('packages', lambda: None, depends_on=['repository'])
+    graph.add_step('tests', lambda: None, depends_on=['packages'])
+    graph.add_step('clone', lambda: 'cloned')
+    results = graph.run(raise_on_failure=False)
+    assert results['repository'].status == 'failed'
+    assert isinstance(results['repository'].error, RuntimeError)
+    assert results['repository'].skipped_because is None
+    for name in ['packages', 'tests']:
+        assert results[name].status == 'skipped'
+        assert results[name].error is None
+        assert results[name].skipped_because == 'dependency [repository] failed'
+    assert results['clone'].status == 'succeeded'
+    assert results['clone'].result == 'cloned'
+
+
+def test_failure_raises_with_the_results():
+    graph = StepGraph()
+    graph.add_step('repository', fail, 'no network')
+    graph.add_step('packages', lambda: None, depends_on=['repository'])
+    with pytest.raises(StepGraphError) as e:
+        graph.run()
+    assert set(e.value.results) == {'repository', 'packages'}
+    message = str(e.value)
+    assert 'skipped   packages' in message and 'dependency [repository] failed' in message
+    assert 'step [repository] failed:' in message and 'RuntimeError: no network' in message
+
+
+@pytest.mark.parametrize('dependencies, cycle', [
+    ({'a': ['a']}, 'a -> a'),
+    ({'a': ['b'], 'b': ['a']}, 'a -> b -> a'),
+    ({'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': []}, 'a -> b -> c -> a'),
+])
+def test_cycles_are_rejected_before_anything_runs(dependencies, cycle):
+    ran = []
+    graph = StepGraph()
+    for name, depends_on in dependencies.items():
+        graph.add_step(name, ran.append, name, depends_on=depends_on)
+    with pytest.raises(ValueError, match='dependency cycle: ' + cycle):
+        graph.run()
+    assert ran == []
+
+
+def test_unknown_dependency_is_rejected():
+    graph = StepGraph()
+    graph.add_step('packages', lambda: None, depends_on=['repository'])
+    with pytest.raises(ValueError, match=r'step \[packages\] depends on unknown step \[repository\]'):
+        graph.run()
+
+
+def test_step_names_are_unique():
+    graph = StepGraph()
+    graph.add_step('a', lambda: None)
+    with pytest.raises(ValueError):
+        graph.add_step('a', lambda: None)